@@ -9,10 +9,20 @@ import time
 from zstacklib.utils import jsonobject
 from zstacklib.utils import log
 from zstacklib.utils import http
-import inventory
+from zstacklib.utils import waiter
 
 logger = log.get_logger(__name__)
 
+# results of async calls are polled from the first interval up to the interval given by
+# the caller, doubling while nothing completes and restarting from the first when something
+# did. The polls reuse the keep-alive connections of http.json_post
+POLL_MIN_INTERVAL = 0.05
+# async calls of a batch posted to the management node and not completed yet
+BATCH_CONCURRENCY = 50
+DEFAULT_API_TIMEOUT = 1800000
+# inventories fetched by a query call of iter_query()
+QUERY_PAGE_SIZE = 1000
+
 
 class ApiError(Exception):
     ''' Api failure '''
@@ -24,6 +34,7 @@ class Api(object):
     '''
 
     def set_session_to_api_message(self, apicmd, session_uuid):
+        import inventory
         session = inventory.Session()
         session.uuid = session_uuid
         apicmd.session = session
@@ -58,6 +69,8 @@ class Api(object):
 
 
     def _check_not_none_field(self, apicmd):
+        # imported on use, a client like zstack-cli starts without the thousands of classes
+        import inventory
         for k, v in apicmd.__dict__.items():
             if isinstance(v, inventory.NotNoneField):
                 err = 'field[%s] of %s cannot be None' % (k, apicmd.FULL_NAME)
@@ -77,6 +90,7 @@ class Api(object):
                 raise ApiError(err)
 
     def login_as_admin(self):
+        import inventory
         apicmd = inventory.APILogInByAccountMsg()
         apicmd.timeout = 15000
         apicmd.accountName = inventory.INITIAL_SYSTEM_ADMIN_NAME
@@ -88,6 +102,7 @@ class Api(object):
         return reply.inventory.uuid
 
     def log_out(self, session_uuid):
+        import inventory
         apicmd = inventory.APILogOutMsg()
         apicmd.timeout = 15000
         apicmd.sessionUuid = session_uuid
@@ -96,40 +111,109 @@ class Api(object):
             logger.warn(
                 'Logout session[uuid:%s] failed because %s' % (session_uuid, self._error_code_to_string(reply.error)))
 
-    def async_call_wait_for_complete(self, apicmd, exception_on_error=True, interval=500, fail_soon=False):
+    def _check_event(self, name, event, exception_on_error):
+        if exception_on_error and not event.success:
+            raise ApiError('API call[%s] failed because %s' % (name, self._error_code_to_string(event.error)))
+
+    def _post_async(self, apicmd, fail_soon):
         self._check_not_none_field(apicmd)
-        timeout = apicmd.timeout
-        if not timeout:
-            timeout = 1800000
         cmd = {apicmd.FULL_NAME: apicmd}
         logger.debug("async call[url: %s, request: %s]" % (self.api_url, jsonobject.dumps(cmd)))
         jstr = http.json_dump_post(self.api_url, cmd, fail_soon=fail_soon)
-        rsp = jsonobject.loads(jstr)
-        if rsp.state == 'Done':
-            logger.debug("async call[url: %s, response: %s]" % (self.api_url, rsp.result))
-            reply = jsonobject.loads(rsp.result)
-            (name, event) = (reply.__dict__.items()[0])
-            if exception_on_error and not event.success:
-                raise ApiError('API call[%s] failed because %s' % (name, self._error_code_to_string(event.error)))
-            return name, event
-
-        curr = 0
-        finterval = float(float(interval) / float(1000))
-        ret_uuid = rsp.uuid
-        while rsp.state != 'Done' and curr < timeout:
-            time.sleep(finterval)
-            rsp = self._get_response(ret_uuid)
-            curr += interval
-
-        if curr >= timeout:
-            raise ApiError('API call[%s] timeout after %dms' % (apicmd.FULL_NAME, curr))
-
-        logger.debug("async call[url: %s, response: %s] after %dms" % (self.api_url, rsp.result, curr))
-        reply = jsonobject.loads(rsp.result)
-        (name, event) = (reply.__dict__.items()[0])
-        if exception_on_error and not event.success:
-            raise ApiError('API call[%s] failed because %s' % (name, self._error_code_to_string(event.error)))
-        return name, event
+        return jsonobject.loads(jstr)
+
+    def iter_async_calls(self, apicmds, exception_on_error=True, interval=500, fail_soon=False,
+                         concurrency=BATCH_CONCURRENCY):
+        '''
+        posts the async calls, at most concurrency of them in flight, and polls their results together
+
+        :return: a generator of (index of the apicmd, event name, event) in the order the calls complete
+        '''
+        apicmds = list(apicmds)
+        max_interval = float(interval) / 1000
+        # result uuid -> (index, apicmd, start time, timeout in seconds)
+        pending = {}
+        next_index = 0
+        backoff = waiter.Backoff(POLL_MIN_INTERVAL)
+
+        while next_index < len(apicmds) or pending:
+            while next_index < len(apicmds) and len(pending) < concurrency:
+                apicmd = apicmds[next_index]
+                start = time.time()
+                rsp = self._post_async(apicmd, fail_soon)
+                if rsp.state == 'Done':
+                    logger.debug("async call[url: %s, response: %s]" % (self.api_url, rsp.result))
+                    (name, event) = (jsonobject.loads(rsp.result).__dict__.items()[0])
+                    self._check_event(name, event, exception_on_error)
+                    yield next_index, name, event
+                else:
+                    timeout = apicmd.timeout if apicmd.timeout else DEFAULT_API_TIMEOUT
+                    pending[rsp.uuid] = (next_index, apicmd, start, float(timeout) / 1000)
+                next_index += 1
+
+            if not pending:
+                continue
+
+            backoff.wait(max_interval)
+            completed = False
+            for ret_uuid, (index, apicmd, start, timeout) in pending.items():
+                elapsed = time.time() - start
+                rsp = self._get_response(ret_uuid)
+                if rsp.state != 'Done':
+                    if elapsed >= timeout:
+                        raise ApiError('API call[%s] timeout after %dms' % (apicmd.FULL_NAME, elapsed * 1000))
+                    continue
+
+                del pending[ret_uuid]
+                completed = True
+                logger.debug("async call[url: %s, response: %s] after %dms" % (self.api_url, rsp.result, elapsed * 1000))
+                (name, event) = (jsonobject.loads(rsp.result).__dict__.items()[0])
+                self._check_event(name, event, exception_on_error)
+                yield index, name, event
+
+            if completed:
+                backoff = waiter.Backoff(POLL_MIN_INTERVAL)
+
+    def async_call_batch(self, apicmds, exception_on_error=True, interval=500, fail_soon=False,
+                         concurrency=BATCH_CONCURRENCY):
+        '''
+        :return: [(event name, event)] in the order of apicmds
+        '''
+        apicmds = list(apicmds)
+        results = [None] * len(apicmds)
+        for index, name, event in self.iter_async_calls(apicmds, exception_on_error, interval, fail_soon, concurrency):
+            results[index] = (name, event)
+        return results
+
+    def async_call_wait_for_complete(self, apicmd, exception_on_error=True, interval=500, fail_soon=False):
+        return self.async_call_batch([apicmd], exception_on_error, interval, fail_soon)[0]
+
+    def iter_query(self, apicmd, page_size=QUERY_PAGE_SIZE, fail_soon=False):
+        '''
+        pages through the results of a query message by start/limit, from apicmd.start and
+        at most apicmd.limit inventories if they are set. Give sortBy for pages not to
+        overlap when resources are created or deleted meanwhile
+
+        :return: a generator of inventories, holding one page at a time
+        '''
+        start = int(getattr(apicmd, 'start', None) or 0)
+        remaining = getattr(apicmd, 'limit', None)
+        remaining = int(remaining) if remaining is not None else None
+
+        while remaining is None or remaining > 0:
+            limit = page_size if remaining is None else min(page_size, remaining)
+            apicmd.start = start
+            apicmd.limit = limit
+            (name, reply) = self.async_call_wait_for_complete(apicmd, fail_soon=fail_soon)
+            inventories = reply.inventories if reply.inventories else []
+            for inv in inventories:
+                yield inv
+
+            if len(inventories) < limit:
+                return
+            start += len(inventories)
+            if remaining is not None:
+                remaining -= len(inventories)
 
     def sync_call(self, apicmd, exception_on_error=True, fail_soon=False):
         self._check_not_none_field(apicmd)
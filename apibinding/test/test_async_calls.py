@@ -0,0 +1,106 @@
+'''
+
+@author: frank
+'''
+import unittest
+from apibinding import api
+from zstacklib.utils import jsonobject
+
+
+class FakeCmd(object):
+    FULL_NAME = 'org.zstack.header.vm.APIStartVmInstanceMsg'
+
+    def __init__(self, polls, success=True, timeout=None):
+        # polls before the call is done, 0 for done when posted, None for never
+        self.polls = polls
+        self.success = success
+        self.timeout = timeout
+
+
+class FakeRsp(object):
+    def __init__(self, uuid, done, success):
+        self.uuid = uuid
+        self.state = 'Done' if done else 'Processing'
+        event = {'success': success}
+        if not success:
+            event['error'] = {'code': 'SYS.1000', 'description': 'an internal error', 'details': 'vm is gone'}
+        self.result = jsonobject.dumps({'APIStartVmInstanceEvent': event})
+
+
+class FakeApi(api.Api):
+    def __init__(self):
+        super(FakeApi, self).__init__()
+        self.calls = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def _post_async(self, apicmd, fail_soon):
+        uuid = str(len(self.calls))
+        self.calls[uuid] = apicmd
+        if apicmd.polls == 0:
+            return FakeRsp(uuid, True, apicmd.success)
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return FakeRsp(uuid, False, apicmd.success)
+
+    def _get_response(self, ret_uuid):
+        apicmd = self.calls[ret_uuid]
+        if apicmd.polls is None:
+            return FakeRsp(ret_uuid, False, apicmd.success)
+
+        apicmd.polls -= 1
+        if apicmd.polls > 0:
+            return FakeRsp(ret_uuid, False, apicmd.success)
+
+        self.in_flight -= 1
+        return FakeRsp(ret_uuid, True, apicmd.success)
+
+
+class TestAsyncCalls(unittest.TestCase):
+    def test_finish_order(self):
+        binding = FakeApi()
+        results = list(binding.iter_async_calls([FakeCmd(3), FakeCmd(0), FakeCmd(1)], interval=100))
+        self.assertEqual([1, 2, 0], [index for index, _, _ in results])
+        self.assertEqual(['APIStartVmInstanceEvent'] * 3, [name for _, name, _ in results])
+
+        binding = FakeApi()
+        results = binding.async_call_batch([FakeCmd(3), FakeCmd(0), FakeCmd(1)], interval=100)
+        self.assertEqual(3, len(results))
+        self.assertTrue(results[0][1].success)
+
+    def test_concurrency(self):
+        binding = FakeApi()
+        cmds = [FakeCmd(i % 3 + 1) for i in range(10)]
+        indexes = [index for index, _, _ in binding.iter_async_calls(cmds, interval=100, concurrency=3)]
+        self.assertEqual(range(10), sorted(indexes))
+        self.assertEqual(3, binding.max_in_flight)
+
+    def test_failure(self):
+        cmds = [FakeCmd(1), FakeCmd(2, success=False)]
+        try:
+            list(FakeApi().iter_async_calls(cmds, interval=100))
+            self.fail('the failed call should raise')
+        except api.ApiError as e:
+            self.assertIn('vm is gone', str(e))
+
+        cmds = [FakeCmd(1), FakeCmd(2, success=False)]
+        results = list(FakeApi().iter_async_calls(cmds, exception_on_error=False, interval=100))
+        self.assertEqual([True, False], [event.success for _, _, event in results])
+
+    def test_timeout(self):
+        binding = FakeApi()
+        cmds = [FakeCmd(1), FakeCmd(None, timeout=200)]
+        results = []
+        try:
+            for result in binding.iter_async_calls(cmds, interval=100):
+                results.append(result)
+            self.fail('the call never done should time out')
+        except api.ApiError as e:
+            self.assertIn('timeout', str(e))
+        # the finished call was still yielded before the timeout
+        self.assertEqual([0], [index for index, _, _ in results])
+
+
+if __name__ == "__main__":
+    unittest.main()
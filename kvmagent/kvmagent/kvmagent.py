@@ -171,3 +171,5 @@ class KvmDaemon(daemon.Daemon):
 
 SEND_COMMAND_URL = 'SEND_COMMAND_URL'
 HOST_UUID = 'HOST_UUID'
+# the management node takes vm state changes in batch
+BATCH_VM_STATE_REPORT = 'BATCH_VM_STATE_REPORT'
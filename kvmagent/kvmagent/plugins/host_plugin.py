@@ -475,6 +475,11 @@ class HostPlugin(kvmagent.KvmAgent):
         self.host_uuid = cmd.hostUuid
         self.config[kvmagent.HOST_UUID] = self.host_uuid
         self.config[kvmagent.SEND_COMMAND_URL] = cmd.sendCommandUrl
+        self.config[kvmagent.BATCH_VM_STATE_REPORT] = cmd.batchVmStateReport is True
+        if cmd.shellForkServer is True:
+            shell.enable_fork_server()
+        if cmd.shellInlineCommands is True:
+            shell.inlinecmd = True
         Report.serverUuid = self.host_uuid
         Report.url = cmd.sendCommandUrl
         logger.debug(http.path_msg(self.CONNECT_PATH, 'host[uuid: %s] connected' % cmd.hostUuid))
@@ -1,11 +1,16 @@
 __author__ = 'frank'
 
+import Queue
 import os.path
+import subprocess
+import threading
+import time
 import traceback
 
 import zstacklib.utils.uuidhelper as uuidhelper
 from kvmagent import kvmagent
 from kvmagent.plugins.imagestore import ImageStoreClient
+from zstacklib.utils import filedigest
 from zstacklib.utils import jsonobject
 from zstacklib.utils import linux
 from zstacklib.utils import shell
@@ -14,6 +19,155 @@ from zstacklib.utils.report import *
 
 logger = log.get_logger(__name__)
 
+# files of a volume and its snapshots hashed in parallel
+MD5_HASH_WORKERS = 4
+# files of a volume and its snapshots copied in parallel
+COPY_BITS_WORKERS = 4
+# rsync keeps interrupted files here on the destination and resumes them next time
+RSYNC_PARTIAL_DIR = '.zstack-rsync-partial'
+SSHPASS = '/usr/bin/sshpass'
+
+class ChainTransfer(object):
+    '''
+    copies files to the same path on a remote host by parallel rsync, all sessions go through one
+    multiplexed ssh connection. Files already on the remote host with the same size and mtime are
+    skipped, which is the rsync quick check done in one round trip
+    '''
+    def __init__(self, paths, ip, port, user, password_file, workers=COPY_BITS_WORKERS):
+        self.paths = paths
+        self.ip = ip
+        self.workers = workers
+        self.sizes = dict([(p, os.path.getsize(p)) for p in paths])
+        self.total = sum(self.sizes.values())
+        # Fixes ZSTAC-13430: handle extremely complex password like ~ ` !@#$%^&*()_+-=[]{}|?<>;:'"/ .
+        # sshpass reads the password from a file, it never goes through a shell command line
+        self.ssh = ('%s -f%s ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null'
+                    ' -o ControlPath=/tmp/zs-ssh-%s -p %s -l %s' %
+                    (SSHPASS, password_file, uuidhelper.uuid()[:8], port, user))
+        self.lock = threading.Lock()
+        # bytes of the finished files, and of the files being copied
+        self.finished_bytes = 0
+        self.copying = {}
+        self.skipped = []
+        self.errors = []
+        self.start_time = None
+
+    def transferred(self):
+        with self.lock:
+            return self.finished_bytes + sum(self.copying.values())
+
+    def throughput(self):
+        elapsed = time.time() - self.start_time if self.start_time else 0
+        return self.transferred() / elapsed if elapsed > 0 else 0
+
+    def _start_master(self):
+        # the sessions share the connection of this master, which logs in once and goes to background.
+        # ssh before 8.x keeps the stdio it got after going to background, which must not be the pipes
+        # of shell.call or the call would wait for the master to exit
+        shell.call('%s -fN -o ControlMaster=yes %s </dev/null >/dev/null 2>&1' % (self.ssh, self.ip))
+        shell.call('%s -O check %s' % (self.ssh, self.ip))
+
+    def _stop_master(self):
+        shell.run('%s -O exit %s' % (self.ssh, self.ip))
+
+    def _remote(self, command):
+        return shell.call('%s %s %s' % (self.ssh, self.ip, linux.shellquote(command)))
+
+    def _find_copied(self):
+        # stat fails for the missing files, the output of others is still there
+        o = self._remote("stat -c '%%s %%Y %%n' %s 2>/dev/null; true" %
+                         ' '.join([linux.shellquote(p) for p in self.paths]))
+        copied = []
+        for l in o.splitlines():
+            size, mtime, path = l.split(' ', 2)
+            if path in self.sizes and long(size) == self.sizes[path] and long(mtime) == long(os.path.getmtime(path)):
+                copied.append(path)
+        return copied
+
+    def _rsync(self, path):
+        cmd = 'rsync -a --progress --relative --partial --partial-dir=%s %s --rsh=%s %s:/' % \
+              (RSYNC_PARTIAL_DIR, linux.shellquote(path), linux.shellquote(self.ssh), self.ip)
+        logger.debug(cmd)
+        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
+
+        # rsync rewrites its progress line with \r, the first field is bytes copied like 1,238,099
+        output = []
+        pending = ''
+        while True:
+            data = p.stdout.read(4096)
+            if not data:
+                break
+
+            lines = (pending + data).replace('\r', '\n').split('\n')
+            pending = lines.pop()
+            for l in lines:
+                fields = l.split()
+                if fields and fields[0].replace(',', '').isdigit():
+                    with self.lock:
+                        self.copying[path] = long(fields[0].replace(',', ''))
+                elif l.strip():
+                    output.append(l)
+        p.wait()
+
+        with self.lock:
+            self.copying.pop(path, None)
+            if p.returncode == 0:
+                self.finished_bytes += self.sizes[path]
+
+        if p.returncode != 0:
+            raise Exception('failed to copy %s to %s, %s' % (path, self.ip, '\n'.join(output[-20:])))
+
+    def _copy(self):
+        copied = self._find_copied()
+        self.skipped = copied
+        with self.lock:
+            self.finished_bytes = sum([self.sizes[p] for p in copied])
+
+        todo = Queue.Queue()
+        for p in self.paths:
+            if p not in copied:
+                todo.put(p)
+
+        def work():
+            while not self.errors:
+                try:
+                    path = todo.get_nowait()
+                except Queue.Empty:
+                    return
+
+                try:
+                    self._rsync(path)
+                except Exception as e:
+                    logger.warn(str(e))
+                    self.errors.append(e)
+
+        threads = [threading.Thread(target=work) for _ in range(max(min(self.workers, todo.qsize()), 1))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+        to_sync = [p for p in self.paths if p not in copied]
+        if to_sync:
+            self._remote('/bin/sync %s' % ' '.join([linux.shellquote(p) for p in to_sync]))
+        return copied
+
+    def run(self):
+        self.start_time = time.time()
+        self._start_master()
+        try:
+            copied = self._copy()
+        finally:
+            self._stop_master()
+
+        logger.debug('copied %s files(%s bytes) to %s in %.1fs, %.1f MB/s, skipped %s files already there' %
+                     (len(self.paths) - len(copied), self.total - sum([self.sizes[p] for p in copied]), self.ip,
+                      time.time() - self.start_time, float(self.throughput()) / 1024 / 1024, len(copied)))
+
 class AgentResponse(object):
     def __init__(self):
         self.totalCapacity = None
@@ -262,6 +416,27 @@ class LocalStoragePlugin(kvmagent.KvmAgent):
 
         return jsonobject.dumps(rsp)
 
+    def _hash_files(self, cmd, paths, report, start, end):
+        progress = filedigest.Progress(sum([os.path.getsize(p) for p in paths]))
+
+        def _get_progress(synced):
+            percent = int(round(float(progress.percent()) * (end - start) / 100) + start)
+            if percent != synced:
+                report.progress_report(str(percent), "report")
+            return percent
+
+        # digestAlgorithm lets both hosts agree on a cheaper checksum than md5
+        algorithm = cmd.digestAlgorithm or filedigest.MD5
+        watch_thread = WatchThread_1(_get_progress)
+        watch_thread.start()
+        try:
+            digests = filedigest.hash_files(paths, algorithm, MD5_HASH_WORKERS, progress, direct=cmd.directIo is True)
+        finally:
+            watch_thread.stop()
+
+        # md5sum printed a new line after the digest, hosts running older agents compare it verbatim
+        return [d + '\n' for d in digests]
+
     @kvmagent.replyerror
     def get_md5(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
@@ -272,50 +447,27 @@ class LocalStoragePlugin(kvmagent.KvmAgent):
             Report.url = cmd.sendCommandUrl
         report = Report(cmd.threadContext, cmd.threadContextStack)
         report.processType = "LocalStorageMigrateVolume"
-        PFILE = shell.call('mktemp /tmp/tmp-XXXXXX').strip()
-
-        total = 0
-        written = 0
-        for to in cmd.md5s:
-            total = total + os.path.getsize(to.path)
 
         start = 0
         end = 10
         if cmd.stage:
             start, end = get_scale(cmd.stage)
 
-
-        def _get_progress(synced):
-            logger.debug("getProgress in get_md5")
-            if not os.path.exists(PFILE):
-                return synced
-            last = linux.tail_1(PFILE).strip()
-            if not last or not last.isdigit():
-                return synced
-            percent = int(round((float(written) * 100 + os.path.getsize(to.path) * float(last)) / total * (end - start) / 100) + start)
-            report.progress_report(str(percent), "report")
-            return synced
-
         report.resourceUuid = cmd.volumeUuid
         if start == 0:
             report.progress_report("0", "start")
         else:
             report.progress_report(str(start), "report")
 
-        for to in cmd.md5s:
-            _, md5, _ = bash_progress_1("pv -n %s 2>%s | md5sum | cut -d ' ' -f 1" % (to.path, PFILE), _get_progress)
+        md5s = self._hash_files(cmd, [to.path for to in cmd.md5s], report, start, end)
+        for to, md5 in zip(cmd.md5s, md5s):
             rsp.md5s.append({
                 'resourceUuid': to.resourceUuid,
                 'path': to.path,
                 'md5': md5
             })
-            written += os.path.getsize(to.path)
-            percent = int(round(float(written) / float(total) * (end - start) + start))
-            report.progress_report(percent, "report")
-
-        if os.path.exists(PFILE):
-            os.remove(PFILE)
 
+        report.progress_report(end, "report")
         return jsonobject.dumps(rsp)
 
     @kvmagent.replyerror
@@ -326,41 +478,18 @@ class LocalStoragePlugin(kvmagent.KvmAgent):
 
         report = Report(cmd.threadContext, cmd.threadContextStack)
         report.processType = "LocalStorageMigrateVolume"
-        PFILE = shell.call('mktemp /tmp/tmp-XXXXXX').strip()
-        total = 0
-        written = 0
 
         start = 90
         end = 100
         if cmd.stage:
             start, end = get_scale(cmd.stage)
-        for to in cmd.md5s:
-            total = total + os.path.getsize(to.path)
-
-        def _get_progress(synced):
-            logger.debug("getProgress in check_md5")
-            if not os.path.exists(PFILE):
-                return synced
-            last = linux.tail_1(PFILE).strip()
-            if not last or not last.isdigit():
-                return synced
-            percent = int(round((float(written) * 100 + os.path.getsize(to.path) * float(last)) / total * (end - start) / 100) + start)
-            report.progress_report(percent, "report")
-            return synced
 
         report.resourceUuid = cmd.volumeUuid
-        for to in cmd.md5s:
-            _, dst_md5, _ = bash_progress_1("pv -n %s 2>%s | md5sum | cut -d ' ' -f 1" % (to.path, PFILE), _get_progress)
-
-            if dst_md5 != to.md5:
+        dst_md5s = self._hash_files(cmd, [to.path for to in cmd.md5s], report, start, end)
+        for to, dst_md5 in zip(cmd.md5s, dst_md5s):
+            if dst_md5.strip() != to.md5.strip():
                 raise Exception("MD5 unmatch. The file[uuid:%s, path:%s]'s md5 (src host:%s, dst host:%s)" %
                                 (to.resourceUuid, to.path, to.md5, dst_md5))
-            written += os.path.getsize(to.path)
-            percent = int(round(float(written) / float(total) * (end - start) + start))
-            report.progress_report(percent, "report")
-
-        if os.path.exists(PFILE):
-            os.remove(PFILE)
 
         rsp = AgentResponse()
         if end == 100:
@@ -390,66 +519,36 @@ class LocalStoragePlugin(kvmagent.KvmAgent):
         report.processType = "LocalStorageMigrateVolume"
         report.resourceUuid = cmd.volumeUuid
 
-        PFILE = shell.call('mktemp /tmp/tmp-XXXXXX').strip()
-        PASSWORD_FILE = linux.write_to_temp_file(cmd.dstPassword)
-
         start = 10
         end = 90
         if cmd.stage:
             start, end = get_scale(cmd.stage)
 
-        total = 0
-        for path in set(chain):
-            total = total + os.path.getsize(path)
-
-        written = 0
+        password_file = linux.write_to_temp_file(cmd.dstPassword)
+        transfer = ChainTransfer(list(set(chain)), cmd.dstIp, cmd.dstPort or "22", cmd.dstUsername, password_file,
+                                 cmd.parallelism or COPY_BITS_WORKERS)
 
         def _get_progress(synced):
-            logger.debug("getProgress in localstorage-agent, synced: %s, total: %s" % (synced, total))
-            if not os.path.exists(PFILE):
-                return synced
-            fpread = open(PFILE, 'r')
-            lines = fpread.readlines()
-            if not lines:
-                fpread.close()
-                return synced
-            last = str(lines[-1]).strip().split('\r')[-1]
-            if not last or len(last.split()) < 1:
-                fpread.close()
-                return synced
-            line = last.split()[0]
-            if not line.isdigit():
-                return synced
-            if total > 0:
-                synced = long(line)
-                if synced < total:
-                    percent = int(round(float(written + synced) / float(total) * (end - start) + start))
+            if transfer.total > 0:
+                percent = int(round(float(transfer.transferred()) / float(transfer.total) * (end - start) + start))
+                if percent != synced:
                     report.progress_report(percent, "report")
-                    synced = written
-            fpread.close()
+                    logger.debug("copying bits to %s, %s/%s bytes, %.1f MB/s" % (
+                        cmd.dstIp, transfer.transferred(), transfer.total, float(transfer.throughput()) / 1024 / 1024))
+                synced = percent
             return synced
 
-        for path in set(chain):
-            PATH = path
-            USER = cmd.dstUsername
-            IP = cmd.dstIp
-            PORT = (cmd.dstPort and cmd.dstPort or "22")
-            DIR = os.path.dirname(path)
-            _, _, err = bash_progress_1(
-                # Fixes ZSTAC-13430: handle extremely complex password like ~ ` !@#$%^&*()_+-=[]{}|?<>;:'"/ .
-                'rsync -av --progress --relative {{PATH}} --rsh="/usr/bin/sshpass -f{{PASSWORD_FILE}} ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -p {{PORT}} -l {{USER}}" {{IP}}:/ 1>{{PFILE}}', _get_progress, False)
-            if err:
-                linux.rm_file_force(PASSWORD_FILE)
-                linux.rm_file_force(PFILE)
-                raise Exception('fail to migrate vm to host, because %s' % str(err))
-
-            written += os.path.getsize(path)
-            bash_errorout('/usr/bin/sshpass -f{{PASSWORD_FILE}} ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -p {{PORT}} {{USER}}@{{IP}} "/bin/sync {{PATH}}"')
-            percent = int(round(float(written) / float(total) * (end - start) + start))
-            report.progress_report(percent, "report")
-
-        linux.rm_file_force(PASSWORD_FILE)
-        linux.rm_file_force(PFILE)
+        watch_thread = WatchThread_1(_get_progress)
+        watch_thread.start()
+        try:
+            transfer.run()
+        except Exception as e:
+            raise Exception('fail to migrate vm to host, because %s' % str(e))
+        finally:
+            watch_thread.stop()
+            linux.rm_file_force(password_file)
+
+        report.progress_report(end, "report")
         rsp = AgentResponse()
         rsp.totalCapacity, rsp.availableCapacity = self._get_disk_capacity(cmd.storagePath)
         return jsonobject.dumps(rsp)
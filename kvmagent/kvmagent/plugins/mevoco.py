@@ -14,6 +14,7 @@ from zstacklib.utils import ebtables
 from zstacklib.utils import lock
 from zstacklib.utils.bash import *
 from zstacklib.utils import ip
+from zstacklib.utils import waiter
 import os.path
 import re
 import threading
@@ -1084,7 +1085,7 @@ mimetype.assign = (
 
         #restart lighttpd to load new configration
         shell.call('ip netns exec %s lighttpd -f %s' % (to.namespaceName, conf_path))
-        if not linux.wait_callback_success(check, None, 5):
+        if not linux.wait_callback_success(check, None, 5, events=waiter.Backoff()):
             raise Exception('lighttpd[conf-file:%s] is not running after being started %s seconds' % (conf_path, 5))
 
 
@@ -1532,7 +1533,7 @@ tag:{{o.tag}},option6:domain-search,{{o.domainList}}
             pid = linux.find_process_by_cmdline([conf_file_path])
             return pid is not None
 
-        if not linux.wait_callback_success(check, None, 5):
+        if not linux.wait_callback_success(check, None, 5, events=waiter.Backoff()):
             raise Exception('dnsmasq[conf-file:%s] is not running after being started %s seconds' % (conf_file_path, 5))
 
     def _refresh_dnsmasq(self, ns_name, conf_file_path):
@@ -1,4 +1,5 @@
 from kvmagent import kvmagent
+from kvmagent.plugins import vm_plugin
 from zstacklib.utils import jsonobject
 from zstacklib.utils import http
 from zstacklib.utils import lock
@@ -7,32 +8,144 @@ from zstacklib.utils.bash import *
 from zstacklib.utils import linux
 from zstacklib.utils import thread
 from zstacklib.utils import lvm
+from zstacklib.utils import shell
 from zstacklib.utils.ip import get_nic_supported_max_speed
 from jinja2 import Template
 import os.path
+import libvirt
 import re
+import threading
 import time
 import traceback
-from prometheus_client.core import GaugeMetricFamily,REGISTRY
+from prometheus_client.core import GaugeMetricFamily,HistogramMetricFamily,REGISTRY
 from prometheus_client import start_http_server
 
 logger = log.get_logger(__name__)
 
-def collect_host_network_statistics():
-
-    all_eths = bash_o("ls /sys/class/net/").split()
-    virtual_eths = bash_o("ls /sys/devices/virtual/net/").split()
+# zstack used capacity is expensive to calculate (du over big directories),
+# so it's refreshed in background and scrapes read the cached value
+DIR_USAGE_CACHE_TTL = 300
+
+
+class SysfsReader(object):
+    '''
+    reads sysfs/procfs attributes without forking, the files are kept open
+    and re-read from offset 0 so each read costs a single read() syscall
+    '''
+
+    def __init__(self):
+        self.fds = {}
+        self.touched = set()
+        self.lock = threading.Lock()
+
+    def _close(self, path):
+        fd = self.fds.pop(path, None)
+        if fd is not None:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _read_once(self, path):
+        fd = self.fds.get(path)
+        if fd is None:
+            fd = os.open(path, os.O_RDONLY)
+            self.fds[path] = fd
+
+        os.lseek(fd, 0, os.SEEK_SET)
+        return os.read(fd, 4096)
+
+    def read(self, path):
+        with self.lock:
+            self.touched.add(path)
+            try:
+                return self._read_once(path)
+            except OSError:
+                # the device may be gone and come back with the same name, retry with a fresh fd
+                self._close(path)
+                return self._read_once(path)
+
+    def read_int(self, path, default=0):
+        try:
+            return int(self.read(path).strip())
+        except (OSError, ValueError):
+            return default
+
+    def sweep(self):
+        # close fds of attributes not read since last sweep, e.g. removed interfaces
+        with self.lock:
+            for path in self.fds.keys():
+                if path not in self.touched:
+                    self._close(path)
+            self.touched = set()
+
+
+class DirectoryUsageCache(object):
+    def __init__(self, ttl=DIR_USAGE_CACHE_TTL):
+        self.ttl = ttl
+        self.usages = {}
+        self.refreshing = False
+        self.last_refresh = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _du(path):
+        r, o = bash_ro("du -bs %s" % path)
+        if r != 0 and not o.strip():
+            return 0
+        return int(o.split()[0])
+
+    def _refresh(self, dirs):
+        try:
+            usages = {}
+            for d in dirs:
+                if os.path.exists(d):
+                    usages[d] = self._du(d)
+
+            with self.lock:
+                self.usages = usages
+                self.last_refresh = time.time()
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def get(self, dirs):
+        with self.lock:
+            first_time = self.last_refresh == 0 and not self.refreshing
+            expired = time.time() - self.last_refresh > self.ttl
+            refresh = expired and not self.refreshing
+            if refresh:
+                self.refreshing = True
+
+        if first_time:
+            # nothing cached yet, calculate it once in place
+            self._refresh(dirs)
+        elif refresh:
+            thread.ThreadFacade.run_in_thread(self._refresh, (dirs,))
+
+        with self.lock:
+            return sum(self.usages.get(d, 0) for d in dirs)
+
+
+sysfs_reader = SysfsReader()
+dir_usage_cache = DirectoryUsageCache()
+
+
+def get_physical_interfaces():
+    virtual_eths = os.listdir('/sys/devices/virtual/net/')
 
     interfaces = []
-    for eth in all_eths:
-        eth = eth.strip(' \t\n\r')
-        if eth in virtual_eths: continue
-        if eth == 'bonding_masters':
+    for eth in os.listdir('/sys/class/net/'):
+        if eth in virtual_eths:
             continue
-        elif not eth:
+        if eth == 'bonding_masters':
             continue
-        else:
-            interfaces.append(eth)
+        interfaces.append(eth)
+    return interfaces
+
+
+def collect_host_network_statistics():
+    interfaces = get_physical_interfaces()
 
     all_in_bytes = 0
     all_in_packets = 0
@@ -41,23 +154,13 @@ def collect_host_network_statistics():
     all_out_packets = 0
     all_out_errors = 0
     for intf in interfaces:
-        res = bash_o("cat /sys/class/net/{}/statistics/rx_bytes".format(intf))
-        all_in_bytes += int(res)
-
-        res = bash_o("cat /sys/class/net/{}/statistics/rx_packets".format(intf))
-        all_in_packets += int(res)
-
-        res = bash_o("cat /sys/class/net/{}/statistics/rx_errors".format(intf))
-        all_in_errors += int(res)
-
-        res = bash_o("cat /sys/class/net/{}/statistics/tx_bytes".format(intf))
-        all_out_bytes += int(res)
-
-        res = bash_o("cat /sys/class/net/{}/statistics/tx_packets".format(intf))
-        all_out_packets += int(res)
-
-        res = bash_o("cat /sys/class/net/{}/statistics/tx_errors".format(intf))
-        all_out_errors += int(res)
+        stat_path = '/sys/class/net/%s/statistics/' % intf
+        all_in_bytes += sysfs_reader.read_int(stat_path + 'rx_bytes')
+        all_in_packets += sysfs_reader.read_int(stat_path + 'rx_packets')
+        all_in_errors += sysfs_reader.read_int(stat_path + 'rx_errors')
+        all_out_bytes += sysfs_reader.read_int(stat_path + 'tx_bytes')
+        all_out_packets += sysfs_reader.read_int(stat_path + 'tx_packets')
+        all_out_errors += sysfs_reader.read_int(stat_path + 'tx_errors')
 
     metrics = {
         'host_network_all_in_bytes': GaugeMetricFamily('host_network_all_in_bytes',
@@ -99,14 +202,7 @@ def collect_host_capacity_statistics():
                                                            'ZStack used capacity in bytes')
     }
 
-    zstack_used_capacity = 0
-    for dir in zstack_dir:
-        if not os.path.exists(dir):
-            continue
-        cmd = "du -bs %s | awk {\'print $1\'}" % dir
-        res = bash_o(cmd)
-        zstack_used_capacity += int(res)
-
+    zstack_used_capacity = dir_usage_cache.get(zstack_dir)
     metrics['zstack_used_capacity_in_bytes'].add_metric([], float(zstack_used_capacity))
     return metrics.values()
 
@@ -222,13 +318,130 @@ def collect_equipment_state():
 
     metrics['ipmi_status'].add_metric([], bash_r("ipmitool mc info"))
 
-    nics = bash_o("find /sys/class/net -type l -not -lname '*virtual*' -printf '%f\\n'").splitlines()
-    if len(nics) != 0:
-        for nic in nics:
-            nic = nic.strip()
-            status = bash_r("grep 1 /sys/class/net/%s/carrier" % nic)
-            speed = str(get_nic_supported_max_speed(nic))
-            metrics['physical_network_interface'].add_metric([nic, speed], status)
+    for nic in get_physical_interfaces():
+        # the same as the exit code of 'grep 1 carrier', 0 for link up
+        status = 0 if sysfs_reader.read_int('/sys/class/net/%s/carrier' % nic) == 1 else 1
+        speed = str(get_nic_supported_max_speed(nic))
+        metrics['physical_network_interface'].add_metric([nic, speed], status)
+
+    return metrics.values()
+
+
+VM_STAT_METRICS = (
+    # (metric name, help, libvirt stats key, labels, scale)
+    ('vm_cpu_time_in_seconds', 'VM total cpu time in seconds', 'cpu.time', [], 1e-9),
+    ('vm_cpu_user_time_in_seconds', 'VM user cpu time in seconds', 'cpu.user', [], 1e-9),
+    ('vm_cpu_system_time_in_seconds', 'VM system cpu time in seconds', 'cpu.system', [], 1e-9),
+    ('vm_vcpu_count', 'VM current vcpu number', 'vcpu.current', [], 1),
+    ('vm_memory_current_in_bytes', 'VM current memory in bytes', 'balloon.current', [], 1024),
+    ('vm_memory_maximum_in_bytes', 'VM maximum memory in bytes', 'balloon.maximum', [], 1024),
+    ('vm_memory_rss_in_bytes', 'VM resident memory in bytes', 'balloon.rss', [], 1024),
+    ('vm_memory_unused_in_bytes', 'VM unused memory reported by guest in bytes', 'balloon.unused', [], 1024),
+    ('vm_memory_available_in_bytes', 'VM available memory reported by guest in bytes', 'balloon.available', [], 1024),
+    ('vm_block_read_requests', 'VM block device read requests', 'block.%d.rd.reqs', ['device'], 1),
+    ('vm_block_read_bytes', 'VM block device read bytes', 'block.%d.rd.bytes', ['device'], 1),
+    ('vm_block_read_time_in_seconds', 'VM block device read time in seconds', 'block.%d.rd.times', ['device'], 1e-9),
+    ('vm_block_write_requests', 'VM block device write requests', 'block.%d.wr.reqs', ['device'], 1),
+    ('vm_block_write_bytes', 'VM block device write bytes', 'block.%d.wr.bytes', ['device'], 1),
+    ('vm_block_write_time_in_seconds', 'VM block device write time in seconds', 'block.%d.wr.times', ['device'], 1e-9),
+    ('vm_block_allocation_in_bytes', 'VM block device allocation in bytes', 'block.%d.allocation', ['device'], 1),
+    ('vm_block_capacity_in_bytes', 'VM block device capacity in bytes', 'block.%d.capacity', ['device'], 1),
+    ('vm_network_in_bytes', 'VM nic inbound traffic in bytes', 'net.%d.rx.bytes', ['device'], 1),
+    ('vm_network_in_packages', 'VM nic inbound traffic in packages', 'net.%d.rx.pkts', ['device'], 1),
+    ('vm_network_in_errors', 'VM nic inbound traffic errors', 'net.%d.rx.errs', ['device'], 1),
+    ('vm_network_in_dropped', 'VM nic inbound dropped packages', 'net.%d.rx.drop', ['device'], 1),
+    ('vm_network_out_bytes', 'VM nic outbound traffic in bytes', 'net.%d.tx.bytes', ['device'], 1),
+    ('vm_network_out_packages', 'VM nic outbound traffic in packages', 'net.%d.tx.pkts', ['device'], 1),
+    ('vm_network_out_errors', 'VM nic outbound traffic errors', 'net.%d.tx.errs', ['device'], 1),
+    ('vm_network_out_dropped', 'VM nic outbound dropped packages', 'net.%d.tx.drop', ['device'], 1),
+)
+
+
+def get_all_domain_stats():
+    stats = libvirt.VIR_DOMAIN_STATS_CPU_TOTAL | libvirt.VIR_DOMAIN_STATS_BALLOON | \
+            libvirt.VIR_DOMAIN_STATS_VCPU | libvirt.VIR_DOMAIN_STATS_INTERFACE | libvirt.VIR_DOMAIN_STATS_BLOCK
+
+    @vm_plugin.LibvirtAutoReconnect
+    def call_libvirt(conn):
+        # one RPC for all running domains instead of several per domain
+        return conn.getAllDomainStats(stats, libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+
+    return call_libvirt()
+
+
+def collect_shell_call_statistics():
+    metrics = {
+        'shell_calls': GaugeMetricFamily('shell_calls',
+                                         'Shell commands run by the agent', None, ['executable', 'mode']),
+        'shell_failures': GaugeMetricFamily('shell_failures',
+                                            'Shell commands exited with non-zero code', None, ['executable']),
+        'shell_seconds': HistogramMetricFamily('shell_seconds',
+                                               'Wall time of shell commands run by the agent', labels=['executable']),
+    }
+
+    for exe, stats in shell.get_call_stats().items():
+        for mode in (shell.INLINE, shell.FORK_SERVER, shell.FORK):
+            metrics['shell_calls'].add_metric([exe, mode], stats[mode])
+        metrics['shell_failures'].add_metric([exe], stats['failures'])
+        metrics['shell_seconds'].add_metric([exe], stats['time']['buckets'], stats['time']['sum'])
+
+    return metrics.values()
+
+
+def collect_http_uri_statistics():
+    metrics = {
+        'agent_http_queue_seconds': HistogramMetricFamily('agent_http_queue_seconds',
+                                                          'Seconds requests wait in the async pool', labels=['uri']),
+        'agent_http_handler_seconds': HistogramMetricFamily('agent_http_handler_seconds',
+                                                            'Seconds spent in the handler', labels=['uri']),
+        'agent_http_callback_seconds': HistogramMetricFamily('agent_http_callback_seconds',
+                                                             'Seconds spent posting the callback', labels=['uri']),
+        'agent_http_in_flight': GaugeMetricFamily('agent_http_in_flight',
+                                                  'Requests queued or running', None, ['uri']),
+        'agent_http_errors': GaugeMetricFamily('agent_http_errors',
+                                               'Requests failed in the handler', None, ['uri']),
+        'agent_http_callback_errors': GaugeMetricFamily('agent_http_callback_errors',
+                                                        'Callbacks failed to post', None, ['uri']),
+        'agent_http_rejected': GaugeMetricFamily('agent_http_rejected',
+                                                 'Requests rejected by a full async pool', None, ['uri']),
+    }
+
+    for uri, stats in kvmagent.get_http_server().get_uri_stats().items():
+        for name, key in (('agent_http_queue_seconds', 'queue_time'), ('agent_http_handler_seconds', 'handler_time'),
+                          ('agent_http_callback_seconds', 'callback_time')):
+            metrics[name].add_metric([uri], stats[key]['buckets'], stats[key]['sum'])
+        metrics['agent_http_in_flight'].add_metric([uri], stats['in_flight'])
+        metrics['agent_http_errors'].add_metric([uri], stats['errors'])
+        metrics['agent_http_callback_errors'].add_metric([uri], stats['callback_errors'])
+        metrics['agent_http_rejected'].add_metric([uri], stats['rejected'])
+
+    return metrics.values()
+
+
+def collect_vm_statistics():
+    metrics = {}
+    for name, help, _, labels, _ in VM_STAT_METRICS:
+        metrics[name] = GaugeMetricFamily(name, help, None, ['vm_uuid'] + labels)
+
+    for dom, stats in get_all_domain_stats():
+        vm_uuid = dom.name()
+        if vm_uuid.startswith("guestfs-") or vm_uuid == "ZStack Management Node VM":
+            continue
+
+        for name, _, key, labels, scale in VM_STAT_METRICS:
+            if not labels:
+                value = stats.get(key)
+                if value is not None:
+                    metrics[name].add_metric([vm_uuid], float(value) * scale)
+                continue
+
+            dev_type = key.split('.', 1)[0]
+            for i in xrange(stats.get('%s.count' % dev_type, 0)):
+                value = stats.get(key % i)
+                dev_name = stats.get('%s.%d.name' % (dev_type, i))
+                if value is None or dev_name is None:
+                    continue
+                metrics[name].add_metric([vm_uuid, dev_name], float(value) * scale)
 
     return metrics.values()
 
@@ -238,6 +451,8 @@ kvmagent.register_prometheus_collector(collect_host_capacity_statistics)
 kvmagent.register_prometheus_collector(collect_lvm_capacity_statistics)
 kvmagent.register_prometheus_collector(collect_raid_state)
 kvmagent.register_prometheus_collector(collect_equipment_state)
+kvmagent.register_prometheus_collector(collect_shell_call_statistics)
+kvmagent.register_prometheus_collector(collect_http_uri_statistics)
 
 
 class PrometheusPlugin(kvmagent.KvmAgent):
@@ -262,8 +477,8 @@ LoadPlugin disk
 LoadPlugin interface
 LoadPlugin memory
 LoadPlugin network
-LoadPlugin virt
-
+{% if VIRT_PLUGIN %}LoadPlugin virt
+{% endif %}
 <Plugin aggregation>
 	<Aggregation>
 		#Host "unspecified"
@@ -309,7 +524,7 @@ LoadPlugin virt
 	ValuesPercentage false
 </Plugin>
 
-<Plugin virt>
+{% if VIRT_PLUGIN %}<Plugin virt>
 	Connection "qemu:///system"
 	RefreshInterval {{INTERVAL}}
 	HostnameFormat name
@@ -318,7 +533,7 @@ LoadPlugin virt
     IgnoreSelected true
 </Plugin>
 
-<Plugin network>
+{% endif %}<Plugin network>
 	Server "localhost" "25826"
 </Plugin>
 
@@ -328,6 +543,8 @@ LoadPlugin virt
             conf = tmpt.render({
                 'INTERVAL': cmd.interval,
                 'INTERFACES': interfaces,
+                # VmCollector exports the vm metrics, the virt plugin would scrape every vm again
+                'VIRT_PLUGIN': cmd.collectdVirtPlugin is True,
             })
 
             need_restart_collectd = False
@@ -414,6 +631,7 @@ LoadPlugin virt
                     for c in kvmagent.metric_collectors:
                         ret.extend(c())
 
+                    sysfs_reader.sweep()
                     return ret
                 except Exception as e:
                     content = traceback.format_exc()
@@ -421,7 +639,18 @@ LoadPlugin virt
                     logger.warn(err)
                     return []
 
+        class VmCollector(object):
+            def collect(self):
+                try:
+                    return collect_vm_statistics()
+                except Exception as e:
+                    content = traceback.format_exc()
+                    err = '%s\n%s\n' % (str(e), content)
+                    logger.warn(err)
+                    return []
+
         REGISTRY.register(Collector())
+        REGISTRY.register(VmCollector())
 
     def start(self):
         http_server = kvmagent.get_http_server()
@@ -17,6 +17,7 @@ from zstacklib.utils import iptables
 from zstacklib.utils import misc
 import os.path
 import re
+import time
 
 logger = log.get_logger(__name__)
 
@@ -69,6 +70,22 @@ class CheckDefaultSecurityGroupResponse(kvmagent.AgentResponse):
     def __init__(self):
         super(CheckDefaultSecurityGroupResponse, self).__init__()
 
+class ApplyPhaseTimer(object):
+    '''
+    records how long each phase of applying security group changes took
+    '''
+    def __init__(self):
+        self.phases = []
+        self._last = time.time()
+
+    def phase(self, name):
+        now = time.time()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    def __str__(self):
+        return ', '.join(['%s: %.3fs' % p for p in self.phases])
+
 class SecurityGroupPlugin(kvmagent.KvmAgent):
     
     SECURITY_GROUP_APPLY_RULE_PATH = "/securitygroup/applyrules"
@@ -101,6 +118,9 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
     IPV4 = 4
     IPV6 = 6
     ZSTACK_IPSET_FAMILYS = {4: "inet", 6: "inet6"}
+    CONNTRACK_FAMILYS = {4: "ipv4", 6: "ipv6"}
+    # conntrack commands run in one shell
+    CONNTRACK_BATCH_SIZE = 100
     
     def _make_in_chain_name(self, vif_name):
         return '%s-in' % vif_name
@@ -333,50 +353,10 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
             default_chain.delete()
             logger.debug('deleted default chain')
 
-        ipt.iptable_restore()
-
-    @bash.in_bash
-    def _apply_rules_on_vnic_chain(self, ipt, ipset_mn, rto):
-        self._delete_vnic_chain(ipt, rto.vmNicInternalName)
-
-        rules = self._create_rule_from_setting(rto, ipset_mn, self.IPV4)
-
-        for r in rules:
-            ipt.add_rule(r)
-
-    def _apply_rules_on_vnic_chain_ip6(self, ipt, ipset_mn, rto):
-        self._delete_vnic_chain(ipt, rto.vmNicInternalName)
-
-        rules = self._create_rule_from_setting(rto, ipset_mn, self.IPV6)
-
-        for r in rules:
-            ipt.add_rule(r)
-            
-    def _delete_vnic_in_chain(self, ipt, nic_name):
-        in_chain_name = self._make_in_chain_name(nic_name)
-        ipt.delete_chain(in_chain_name)
-        ipt.remove_rule(self._start_ingress_rule(nic_name, in_chain_name))
-        ipt.remove_rule(self._end_ingress_rule(in_chain_name))
-        ipt.remove_rule(self._end_ingress_rule(in_chain_name, self.DEFAULT_POLICY_DROP))
-        default_chain = ipt.get_chain(self.ZSTACK_DEFAULT_CHAIN)
-        for r in default_chain.children:
-            if ipt.is_target_in_rule(r.identity, in_chain_name):
-                r.delete()
-                
-    def _delete_vnic_out_chain(self, ipt, nic_name):
-        out_chain_name = self._make_out_chain_name(nic_name)
-        ipt.delete_chain(out_chain_name)
-        ipt.remove_rule(self._start_egress_rule(nic_name, out_chain_name))
-        ipt.remove_rule(self._end_egress_rule(out_chain_name))
-        default_chain = ipt.get_chain(self.ZSTACK_DEFAULT_CHAIN)
-        for r in default_chain.children:
-            if ipt.is_target_in_rule(r.identity, out_chain_name):
-                r.delete()
-
-    @bash.in_bash
-    def _delete_vnic_chain(self, ipt, nic_name):
-        self._delete_vnic_in_chain(ipt, nic_name)
-        self._delete_vnic_out_chain(ipt, nic_name)
+    def _delete_vnic_chains(self, ipt, nic_names):
+        chain_names = [self._make_in_chain_name(n) for n in nic_names]
+        chain_names.extend([self._make_out_chain_name(n) for n in nic_names])
+        ipt.delete_chains(chain_names)
 
     def _cleanup_iptable_chains(self, chain, data):
         if 'vnic' not in chain.name:
@@ -399,89 +379,92 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
             shell.run("sudo conntrack -D")
             logger.debug('clean up conntrack -D')
 
+    @misc.ignoreerror
+    def _cleanup_conntrack_in_batch(self, ips_of_versions):
+        '''
+        :param ips_of_versions: [(ip_version, [ip, ...]), ...]
+        '''
+        cmds = []
+        for ip_version, ips in ips_of_versions:
+            for ip in ips or []:
+                cmds.append("sudo conntrack -d %s -f %s -D" % (ip, self.CONNTRACK_FAMILYS[ip_version]))
+
+        # conntrack -D fails if no entry matched, so don't stop on errors
+        for i in range(0, len(cmds), self.CONNTRACK_BATCH_SIZE):
+            shell.run('; '.join(cmds[i:i + self.CONNTRACK_BATCH_SIZE]))
+        logger.debug('clean up conntrack of %s ips' % len(cmds))
+
+    def _is_zstack_ipset(self, name):
+        return name.startswith(self.ZSTACK_IPSET_NAME_FORMAT)
+
     @bash.in_bash
-    def _apply_rules_using_iprange_match(self, cmd, iptable=None, ipset_mn=None):
-        if not iptable:
-            ipt = iptables.from_iptables_save()
-        else:
-            ipt = iptable
+    def _apply_rules_in_batch(self, cmd, timer, delete_all_chains=False):
+        '''
+        builds the vnic chains of all ruleTOs in cmd, then applies them in one ipset restore
+        and one iptables-restore per ip version
+        '''
+        all_nics = linux.get_all_ethernet_device_names()
+        ipts = []
+        ips_mns = []
+        conntrack_ips = []
+        vnic_num = 0
 
-        if not ipset_mn:
-            ips_mn = ipset.IPSetManager()
-        else:
-            ips_mn = ipset_mn
+        for ip_version, rtos in [(self.IPV4, cmd.ruleTOs), (self.IPV6, cmd.ipv6RuleTOs)]:
+            if rtos is None:
+                continue
 
-        self._create_default_rules(ipt)
-        
-        for rto in cmd.ruleTOs:
-            if rto.actionCode == self.ACTION_CODE_DELETE_CHAIN:
-                self._delete_vnic_chain(ipt, rto.vmNicInternalName)
-            elif rto.actionCode == self.ACTION_CODE_APPLY_RULE:
-                self._apply_rules_on_vnic_chain(ipt, ips_mn, rto)
+            if ip_version == self.IPV4:
+                ipt = iptables.from_iptables_save()
             else:
-                raise Exception('unknown action code: %s' % rto.actionCode)
-            self._cleanup_conntrack(rto.vmNicIp)
-
-        default_accept_rule = "-A %s -j ACCEPT" % self.ZSTACK_DEFAULT_CHAIN
-        ipt.remove_rule(default_accept_rule)
-        ipt.add_rule(default_accept_rule)
-        self._cleanup_stale_chains(ipt)
-
-        ips_mn.refresh_my_ipsets()
-        ipt.iptable_restore()
-        used_ipset = ipt.list_used_ipset_name()
-
-        def match_set_name(name):
-            return name.startswith(self.ZSTACK_IPSET_NAME_FORMAT)
-        ips_mn.cleanup_other_ipset(match_set_name, used_ipset)
-
-    def _apply_rules_using_iprange_match_ip6(self, cmd, iptable=None, ipset_mn=None):
-        if not iptable:
-            ipt = iptables.from_ip6tables_save()
-        else:
-            ipt = iptable
+                ipt = iptables.from_ip6tables_save()
+            timer.phase('ipv%s save' % ip_version)
 
-        if not ipset_mn:
-            ips_mn = ipset.IPSetManager()
-        else:
-            ips_mn = ipset_mn
+            if delete_all_chains:
+                self._delete_all_chains(ipt)
 
-        self._create_default_rules_ip6(ipt)
-
-        for rto in cmd.ipv6RuleTOs:
-            if rto.actionCode == self.ACTION_CODE_DELETE_CHAIN:
-                self._delete_vnic_chain(ipt, rto.vmNicInternalName)
-            elif rto.actionCode == self.ACTION_CODE_APPLY_RULE:
-                self._apply_rules_on_vnic_chain_ip6(ipt, ips_mn, rto)
+            if ip_version == self.IPV4:
+                self._create_default_rules(ipt)
             else:
-                raise Exception('unknown action code: %s' % rto.actionCode)
-            self._cleanup_conntrack(rto.vmNicIp, "ipv6")
-
-        default_accept_rule = "-A %s -j ACCEPT" % self.ZSTACK_DEFAULT_CHAIN
-        ipt.remove_rule(default_accept_rule)
-        ipt.add_rule(default_accept_rule)
-        self._cleanup_stale_chains(ipt)
+                self._create_default_rules_ip6(ipt)
 
-        ips_mn.refresh_my_ipsets()
-        ipt.iptable_restore()
-        used_ipset = ipt.list_used_ipset_name()
-
-        def match_set_name(name):
-            return name.startswith(self.ZSTACK_IPSET_NAME_FORMAT)
+            ips_mn = ipset.IPSetManager()
+            self._delete_vnic_chains(ipt, [rto.vmNicInternalName for rto in rtos])
+            for rto in rtos:
+                if rto.actionCode == self.ACTION_CODE_APPLY_RULE:
+                    for r in self._create_rule_from_setting(rto, ips_mn, ip_version):
+                        ipt.add_rule(r)
+                elif rto.actionCode != self.ACTION_CODE_DELETE_CHAIN:
+                    raise Exception('unknown action code: %s' % rto.actionCode)
+                conntrack_ips.append((ip_version, rto.vmNicIp))
+
+            default_accept_rule = "-A %s -j ACCEPT" % self.ZSTACK_DEFAULT_CHAIN
+            ipt.remove_rule(default_accept_rule)
+            ipt.add_rule(default_accept_rule)
+            ipt.cleanup_unused_chain(self._cleanup_iptable_chains, data=all_nics)
+
+            ipts.append(ipt)
+            ips_mns.append(ips_mn)
+            vnic_num += len(rtos)
+            timer.phase('ipv%s build' % ip_version)
+
+        if not ipts:
+            return
+
+        ipset.refresh_ipsets(ips_mns)
+        timer.phase('ipset restore')
+
+        used_ipset = []
+        for ipt in ipts:
+            ipt.iptable_restore()
+            used_ipset.extend(ipt.list_used_ipset_name())
+        timer.phase('iptables restore')
 
-        ips_mn.cleanup_other_ipset(match_set_name, used_ipset)
+        ips_mns[0].cleanup_other_ipset(self._is_zstack_ipset, used_ipset)
+        timer.phase('ipset cleanup')
 
-    @bash.in_bash
-    def _refresh_rules_on_host_using_iprange_match(self, cmd):
-        if cmd.ruleTOs is not None:
-            ipt = iptables.from_iptables_save()
-            self._delete_all_chains(ipt)
-            self._apply_rules_using_iprange_match(cmd, ipt)
-
-        if cmd.ipv6RuleTOs is not None:
-            ip6t = iptables.from_ip6tables_save()
-            self._delete_all_chains(ip6t)
-            self._apply_rules_using_iprange_match_ip6(cmd, ip6t)
+        self._cleanup_conntrack_in_batch(conntrack_ips)
+        timer.phase('conntrack cleanup')
+        logger.debug('applied security group rules of %s vnics, %s' % (vnic_num, timer))
 
     @lock.file_lock('/run/xtables.lock')
     @kvmagent.replyerror
@@ -490,13 +473,7 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
         rsp = ApplySecurityGroupRuleResponse()
 
         try:
-            if cmd.ruleTOs is not None:
-                ipt = iptables.from_iptables_save()
-                self._apply_rules_using_iprange_match(cmd, ipt)
-
-            if cmd.ipv6RuleTOs is not None:
-                ip6t = iptables.from_ip6tables_save()
-                self._apply_rules_using_iprange_match_ip6(cmd, ip6t)
+            self._apply_rules_in_batch(cmd, ApplyPhaseTimer())
         except iptables.IPTablesError as e:
             err_log = linux.get_exception_stacktrace()
             logger.warn(err_log)
@@ -510,7 +487,7 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
         rsp = RefreshAllRulesOnHostResponse()
         try:
-            self._refresh_rules_on_host_using_iprange_match(cmd)
+            self._apply_rules_in_batch(cmd, ApplyPhaseTimer(), delete_all_chains=True)
         except iptables.IPTablesError as e:
             err_log = linux.get_exception_stacktrace()
             logger.warn(err_log)
@@ -554,53 +531,44 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
         rsp = UpdateGroupMemberResponse()
 
-        utos4 = []
-        utos6 = []
+        timer = ApplyPhaseTimer()
+        ips_mns = {self.IPV4: ipset.IPSetManager(), self.IPV6: ipset.IPSetManager()}
+        to_del_ipset_names = {self.IPV4: [], self.IPV6: []}
         for uto in cmd.updateGroupTOs:
-            if int(uto.ipVersion) == 4:
-                utos4.append(uto)
-            else:
-                utos6.append(uto)
-
-        ips_mn = ipset.IPSetManager()
-        ipt = iptables.from_iptables_save()
-        to_del_ipset_names = []
-        for uto in utos4:
+            ip_version = int(uto.ipVersion)
+            if ip_version != self.IPV4:
+                ip_version = self.IPV6
+            set_name = self._make_security_group_ipset_name(uto.securityGroupUuid)
             if uto.actionCode == self.ACTION_CODE_DELETE_GROUP:
-                to_del_ipset_names.append(self._make_security_group_ipset_name(uto.securityGroupUuid))
+                to_del_ipset_names[ip_version].append(set_name)
             elif uto.actionCode == self.ACTION_CODE_UPDATE_GROUP_MEMBER:
-                set_name = self._make_security_group_ipset_name(uto.securityGroupUuid)
-                ip_version = self.ZSTACK_IPSET_FAMILYS[int(uto.ipVersion)]
-                ips_mn.create_set(name=set_name, match_ips=uto.securityGroupVmIps, ip_version=ip_version)
-
-        ips_mn.refresh_my_ipsets()
-        if len(to_del_ipset_names) > 0:
-            to_del_rules = ipt.list_reference_ipset_rules(to_del_ipset_names)
-            for rule in to_del_rules:
-                ipt.remove_rule(str(rule))
+                ips_mns[ip_version].create_set(name=set_name, match_ips=uto.securityGroupVmIps,
+                                               ip_version=self.ZSTACK_IPSET_FAMILYS[ip_version])
+
+        ipset.refresh_ipsets([ips_mns[self.IPV4], ips_mns[self.IPV6]])
+        timer.phase('ipset restore')
+
+        for ip_version in [self.IPV4, self.IPV6]:
+            if not to_del_ipset_names[ip_version]:
+                continue
+
+            if ip_version == self.IPV4:
+                ipt = iptables.from_iptables_save()
+            else:
+                ipt = iptables.from_ip6tables_save()
+            for rule in ipt.list_reference_ipset_rules(to_del_ipset_names[ip_version]):
+                rule.delete()
             ipt.iptable_restore()
-            ips_mn.clean_ipsets(to_del_ipset_names)
+            timer.phase('ipv%s restore' % ip_version)
 
-        ip6s_mn = ipset.IPSetManager()
-        ip6t = iptables.from_ip6tables_save()
-        to_del_ipset_names = []
-        for uto in utos6:
-            if uto.actionCode == self.ACTION_CODE_DELETE_GROUP:
-                to_del_ipset_names.append(self._make_security_group_ipset_name(uto.securityGroupUuid))
-            elif uto.actionCode == self.ACTION_CODE_UPDATE_GROUP_MEMBER:
-                set_name = self._make_security_group_ipset_name(uto.securityGroupUuid)
-                ip_version = self.ZSTACK_IPSET_FAMILYS[int(uto.ipVersion)]
-                ip6s_mn.create_set(name=set_name, match_ips=uto.securityGroupVmIps, ip_version=ip_version)
-
-        ip6s_mn.refresh_my_ipsets()
-        if len(to_del_ipset_names) > 0:
-            to_del_rules = ip6t.list_reference_ipset_rules(to_del_ipset_names)
-            for rule in to_del_rules:
-                ip6t.remove_rule(str(rule))
-            ip6t.iptable_restore()
-            ip6s_mn.clean_ipsets(to_del_ipset_names)
+        to_del = to_del_ipset_names[self.IPV4] + to_del_ipset_names[self.IPV6]
+        if to_del:
+            ipset.IPSetManager.clean_ipsets(to_del)
+            timer.phase('ipset destroy')
 
         self._cleanup_conntrack()
+        timer.phase('conntrack cleanup')
+        logger.debug('updated %s security group members, %s' % (len(cmd.updateGroupTOs), timer))
 
         return jsonobject.dumps(rsp)
 
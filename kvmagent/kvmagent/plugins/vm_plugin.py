@@ -34,6 +34,7 @@ from zstacklib.utils import lvm
 from zstacklib.utils import shell
 from zstacklib.utils import thread
 from zstacklib.utils import uuidhelper
+from zstacklib.utils import waiter
 from zstacklib.utils import xmlobject
 from zstacklib.utils import misc
 from zstacklib.utils.report import *
@@ -295,10 +296,20 @@ class ReportVmStateCmd(object):
         self.hostUuid = None
         self.vmUuid = None
         self.vmState = None
+        self.seq = None
 
 class ReportVmShutdownEventCmd(object):
     def __init__(self):
         self.vmUuid = None
+        self.seq = None
+
+class ReportVmStatesCmd(object):
+    def __init__(self):
+        self.hostUuid = None
+        # [{'vmUuid': , 'vmState': , 'seq': }], a vm appears once with its latest state
+        self.vmStates = []
+        # [{'vmUuid': , 'seq': }]
+        self.shutdownEvents = []
 
 class CheckVmStateRsp(kvmagent.AgentResponse):
     def __init__(self):
@@ -597,6 +608,9 @@ class LibvirtAutoReconnect(object):
 
     libvirt_event_callbacks = {}
 
+    # wakes waits for domain state changes
+    domain_events = waiter.Notifier()
+
     def __init__(self, func):
         self.func = func
         self.exception = None
@@ -627,6 +641,7 @@ class LibvirtAutoReconnect(object):
                                                          None)
 
         def lifecycle_callback(conn, dom, event, detail, opaque):
+            LibvirtAutoReconnect.domain_events.notify()
             cbs = LibvirtAutoReconnect.libvirt_event_callbacks.get(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE)
             if not cbs:
                 return
@@ -686,6 +701,7 @@ class LibvirtAutoReconnect(object):
             logger.warn('failed reconnected to the libvirt, cause: ' + ex)
             raise ex
         logger.debug('successfully reconnected to the libvirt')
+        domain_cache.invalidate()
 
         # old_conn = LibvirtAutoReconnect.conn
         # LibvirtAutoReconnect.conn = libvirt.open('qemu:///system')
@@ -730,6 +746,309 @@ class LibvirtAutoReconnect(object):
                 raise
 
 
+class DomainRecord(object):
+    def __init__(self, vm_uuid, state, cpu_num, memory):
+        self.uuid = vm_uuid
+        self.state = state
+        self.cpu_num = cpu_num
+        self.memory = memory
+
+    @staticmethod
+    def from_virt_domain(domain):
+        # info() returns [state, maxMem(KiB), memory(KiB), nrVirtCpu, cpuTime]. For an active domain
+        # memory is the current balloon size, which libvirt also reports as currentMemory in the
+        # live XML used by Vm.get_memory(); they may only differ while the guest is ballooning
+        (state, _, memory, cpu_num, _) = domain.info()
+        return DomainRecord(domain.name(), Vm.power_state[state], cpu_num, long(memory) * 1024)
+
+
+class DomainStateCache(object):
+    '''
+    in-memory table of active libvirt domains, kept up to date by lifecycle events
+    and reconciled against listAllDomains() periodically in case an event is lost
+    '''
+    RECONCILE_INTERVAL = 60
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.records = {}
+        self.seeded = False
+        self.listening = False
+        # uuid -> sequence of the last event, used to avoid overwriting fresher
+        # event data with an older snapshot taken by a concurrent seed
+        self.event_seqs = {}
+        self.seq = 0
+
+    def start(self):
+        if self.listening:
+            return
+
+        LibvirtAutoReconnect.add_libvirt_callback(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._lifecycle_event)
+        self.listening = True
+
+        def reconcile():
+            self.seed(reconcile=True)
+            return True
+
+        thread.timer(self.RECONCILE_INTERVAL, reconcile, stop_on_exception=False).start()
+
+    def invalidate(self):
+        with self.lock:
+            self.seeded = False
+
+    @staticmethod
+    def _load_active_domains():
+        @LibvirtAutoReconnect
+        def call_libvirt(conn):
+            return conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+
+        records = {}
+        for domain in call_libvirt():
+            try:
+                r = DomainRecord.from_virt_domain(domain)
+            except libvirt.libvirtError as ex:
+                if ex.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+                    continue
+                raise ex
+            records[r.uuid] = r
+        return records
+
+    def seed(self, reconcile=False):
+        with self.lock:
+            start_seq = self.seq
+
+        records = self._load_active_domains()
+
+        with self.lock:
+            if reconcile and self.seeded:
+                self._log_divergence(records)
+
+            for vm_uuid, seq in self.event_seqs.items():
+                if seq <= start_seq:
+                    continue
+                # an event arrived while we were listing, it is fresher than the snapshot
+                if vm_uuid in self.records:
+                    records[vm_uuid] = self.records[vm_uuid]
+                else:
+                    records.pop(vm_uuid, None)
+
+            self.records = records
+            self.event_seqs = {}
+            self.seeded = self.listening
+
+    def _log_divergence(self, records):
+        for vm_uuid, r in records.items():
+            cached = self.records.get(vm_uuid)
+            if not cached:
+                logger.warn('domain cache missed vm[uuid:%s, state:%s], an event may be lost' % (vm_uuid, r.state))
+            elif cached.state != r.state:
+                logger.warn('domain cache has vm[uuid:%s] in state %s but libvirt reports %s' %
+                            (vm_uuid, cached.state, r.state))
+
+        for vm_uuid in self.records:
+            if vm_uuid not in records:
+                logger.warn('domain cache has stale vm[uuid:%s] which is no longer active' % vm_uuid)
+
+    def refresh(self, vm_uuid):
+        @LibvirtAutoReconnect
+        def call_libvirt(conn):
+            return conn.lookupByName(vm_uuid)
+
+        try:
+            domain = call_libvirt()
+            r = DomainRecord.from_virt_domain(domain) if domain.isActive() else None
+        except libvirt.libvirtError as ex:
+            if ex.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                raise ex
+            r = None
+
+        self._update(vm_uuid, r)
+
+    def _update(self, vm_uuid, record):
+        with self.lock:
+            self.seq += 1
+            self.event_seqs[vm_uuid] = self.seq
+            if record:
+                self.records[vm_uuid] = record
+            else:
+                self.records.pop(vm_uuid, None)
+
+    def _lifecycle_event(self, conn, dom, event, detail, opaque):
+        vm_uuid = dom.name()
+        if event in (libvirt.VIR_DOMAIN_EVENT_STOPPED, libvirt.VIR_DOMAIN_EVENT_UNDEFINED):
+            self._update(vm_uuid, None)
+            return
+
+        if event == libvirt.VIR_DOMAIN_EVENT_DEFINED:
+            # a definition change doesn't change the running state
+            return
+
+        try:
+            r = DomainRecord.from_virt_domain(dom) if dom.isActive() else None
+        except libvirt.libvirtError as ex:
+            if ex.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                raise ex
+            r = None
+
+        self._update(vm_uuid, r)
+
+    def _current(self):
+        if not self.listening:
+            # nobody feeds the cache with events, always go to libvirt
+            return self._load_active_domains()
+
+        if not self.seeded:
+            self.seed()
+
+        with self.lock:
+            return dict(self.records)
+
+    def get_records(self):
+        return self._current().values()
+
+    def get_state(self, vm_uuid):
+        if not self.listening:
+            r = self._current().get(vm_uuid)
+        else:
+            if not self.seeded:
+                self.seed()
+
+            with self.lock:
+                r = self.records.get(vm_uuid)
+
+        return r.state if r else None
+
+
+domain_cache = DomainStateCache()
+
+
+class VmStateReporter(object):
+    '''
+    coalesces vm state changes happening within REPORT_WINDOW and reports them together,
+    a vm flipping several times in the window is reported once with its latest state.
+    Every change carries a sequence number so the management node can drop stale ones.
+    Without batchVmStateReport the changes of each vm are sent in order by a thread of the vm
+    '''
+    REPORT_WINDOW = 0.2
+    REPORT_VM_STATE_PATH = '/kvm/reportvmstate'
+    REPORT_VM_SHUTDOWN_PATH = '/kvm/reportvmshutdown'
+    REPORT_VM_STATES_PATH = '/kvm/reportvmstates'
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        # batches are sent one after another to keep them in order
+        self.send_lock = threading.Lock()
+        self.states = {}
+        self.shutdowns = {}
+        # vm uuid -> [(seq, state or None for shutdown)] waiting to be sent by the sender of the vm
+        self.pending = {}
+        self.flush_scheduled = False
+        # counting from the current time keeps sequence numbers increasing across agent restarts
+        self.seq = long(time.time() * 1000)
+
+    def report_state(self, vm_uuid, vm_state):
+        with self.lock:
+            self.seq += 1
+            self.states[vm_uuid] = (vm_state, self.seq)
+            self._schedule_flush()
+
+    def report_shutdown(self, vm_uuid):
+        with self.lock:
+            self.seq += 1
+            self.shutdowns[vm_uuid] = self.seq
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self._flush_later()
+
+    @thread.AsyncThread
+    def _flush_later(self):
+        time.sleep(self.REPORT_WINDOW)
+        with self.lock:
+            states = self.states
+            shutdowns = self.shutdowns
+            self.states = {}
+            self.shutdowns = {}
+            self.flush_scheduled = False
+
+        if self.config.get(kvmagent.BATCH_VM_STATE_REPORT):
+            with self.send_lock:
+                try:
+                    self._send(states, shutdowns)
+                except:
+                    logger.warn(traceback.format_exc())
+            return
+
+        # the management node doesn't take batched reports, send them one by one. Only the
+        # reports of a vm wait for each other, so a slow callback doesn't hold up other vms
+        reports = [(seq, vm_uuid, state) for vm_uuid, (state, seq) in states.items()]
+        reports.extend([(seq, vm_uuid, None) for vm_uuid, seq in shutdowns.items()])
+        with self.lock:
+            for seq, vm_uuid, state in sorted(reports):
+                if vm_uuid in self.pending:
+                    self.pending[vm_uuid].append((seq, state))
+                else:
+                    self.pending[vm_uuid] = [(seq, state)]
+                    self._send_vm_reports(vm_uuid)
+
+    @thread.AsyncThread
+    def _send_vm_reports(self, vm_uuid):
+        while True:
+            with self.lock:
+                reports = self.pending[vm_uuid]
+                if not reports:
+                    del self.pending[vm_uuid]
+                    return
+                seq, state = reports.pop(0)
+
+            try:
+                if state is None:
+                    self._send({}, {vm_uuid: seq})
+                else:
+                    self._send({vm_uuid: (state, seq)}, {})
+            except:
+                logger.warn(traceback.format_exc())
+
+    def _send(self, states, shutdowns):
+        url = self.config.get(kvmagent.SEND_COMMAND_URL)
+        host_uuid = self.config.get(kvmagent.HOST_UUID)
+        if not url or not host_uuid:
+            logger.warn('cannot find SEND_COMMAND_URL or HOST_UUID, unable to report states of vms%s and shutdown of vms%s'
+                        % (states.keys(), shutdowns.keys()))
+            return
+
+        if len(states) + len(shutdowns) > 1:
+            cmd = ReportVmStatesCmd()
+            cmd.hostUuid = host_uuid
+            cmd.vmStates = [{'vmUuid': vm_uuid, 'vmState': state, 'seq': seq}
+                            for vm_uuid, (state, seq) in states.items()]
+            cmd.shutdownEvents = [{'vmUuid': vm_uuid, 'seq': seq} for vm_uuid, seq in shutdowns.items()]
+            logger.debug('report states of %s vms and shutdown of %s vms to %s' % (len(states), len(shutdowns), url))
+            http.json_dump_post(url, cmd, {'commandpath': self.REPORT_VM_STATES_PATH})
+            return
+
+        reports = [(seq, vm_uuid, state) for vm_uuid, (state, seq) in states.items()]
+        reports.extend([(seq, vm_uuid, None) for vm_uuid, seq in shutdowns.items()])
+        for seq, vm_uuid, state in reports:
+            if state is None:
+                cmd = ReportVmShutdownEventCmd()
+                cmd.vmUuid = vm_uuid
+                cmd.seq = seq
+                logger.debug('report shutdown event of vm ' + vm_uuid)
+                http.json_dump_post(url, cmd, {'commandpath': self.REPORT_VM_SHUTDOWN_PATH})
+            else:
+                cmd = ReportVmStateCmd()
+                cmd.vmUuid = vm_uuid
+                cmd.hostUuid = host_uuid
+                cmd.vmState = state
+                cmd.seq = seq
+                logger.debug('report state[%s] of vm[uuid:%s] to %s' % (state, vm_uuid, url))
+                http.json_dump_post(url, cmd, {'commandpath': self.REPORT_VM_STATE_PATH})
+
+
 class IscsiLogin(object):
     def __init__(self):
         self.server_hostname = None
@@ -767,7 +1086,9 @@ class IscsiLogin(object):
         def wait_device_to_show(_):
             return os.path.exists(device_path)
 
-        if not linux.wait_callback_success(wait_device_to_show, timeout=30, interval=0.5):
+        with waiter.watch_file(device_path) as events:
+            ok = linux.wait_callback_success(wait_device_to_show, timeout=30, interval=0.5, events=events)
+        if not ok:
             raise Exception('ISCSI device[%s] is not shown up after 30s' % device_path)
 
         return device_path
@@ -1138,40 +1459,16 @@ def get_vm_by_uuid_no_retry(uuid, exception_if_not_existing=True):
         raise libvirt.libvirtError(err)
 
 def get_active_vm_uuids_states():
-    @LibvirtAutoReconnect
-    def call_libvirt(conn):
-        return conn.listDomainsID()
-
-    ids = call_libvirt()
     uuids_states = {}
-
-    @LibvirtAutoReconnect
-    def get_domain(conn):
-        # i is for..loop's control variable
-        # it's Python's local scope tricky
-        try:
-            return conn.lookupByID(i)
-        except libvirt.libvirtError as ex:
-            if ex.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
-                return None
-            raise ex
-
-    for i in ids:
-        domain = get_domain()
-        if domain == None:
-            continue
-
-        uuid = domain.name()
-        if uuid.startswith("guestfs-"):
+    for r in domain_cache.get_records():
+        vm_uuid = r.uuid
+        if vm_uuid.startswith("guestfs-"):
             logger.debug("ignore the temp vm generate by guestfish.")
             continue
-        if uuid == "ZStack Management Node VM":
+        if vm_uuid == "ZStack Management Node VM":
             logger.debug("ignore the vm used for MN HA.")
             continue
-        (state, _, _, _, _) = domain.info()
-        state = Vm.power_state[state]
-        # or use
-        uuids_states[uuid] = state
+        uuids_states[vm_uuid] = r.state
     return uuids_states
 
 
@@ -1181,37 +1478,26 @@ def get_all_vm_states():
 
 def get_running_vms():
     @LibvirtAutoReconnect
-    def get_all_ids(conn):
-        return conn.listDomainsID()
+    def get_all_domains(conn):
+        return conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
 
-    ids = get_all_ids()
     vms = []
-
-    @LibvirtAutoReconnect
-    def get_domain(conn):
+    for domain in get_all_domains():
         try:
-            return conn.lookupByID(i)
+            vms.append(Vm.from_virt_domain(domain))
         except libvirt.libvirtError as ex:
             if ex.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
-                return None
+                continue
             raise ex
-
-    for i in ids:
-        domain = get_domain()
-        if domain == None:
-            continue
-        vm = Vm.from_virt_domain(domain)
-        vms.append(vm)
     return vms
 
 
 def get_cpu_memory_used_by_running_vms():
-    runnings = get_running_vms()
     used_cpu = 0
     used_memory = 0
-    for vm in runnings:
-        used_cpu += vm.get_cpu_num()
-        used_memory += vm.get_memory()
+    for r in domain_cache.get_records():
+        used_cpu += r.cpu_num
+        used_memory += r.memory
 
     return (used_cpu, used_memory)
 
@@ -1385,8 +1671,10 @@ class Vm(object):
             return False
 
     def _wait_for_vm_running(self, timeout=60):
-        if not linux.wait_callback_success(self.wait_for_state_change, self.VM_STATE_RUNNING, interval=0.5,
-                                           timeout=timeout):
+        with LibvirtAutoReconnect.domain_events.listen() as events:
+            ok = linux.wait_callback_success(self.wait_for_state_change, self.VM_STATE_RUNNING, interval=0.5,
+                                             timeout=timeout, events=events)
+        if not ok:
             raise kvmagent.KvmError('unable to start vm[uuid:%s, name:%s], vm state is not changing to '
                                     'running after %s seconds' % (self.uuid, self.get_name(), timeout))
 
@@ -1397,13 +1685,15 @@ class Vm(object):
             cmd(is_exception=False)
             return cmd.return_code == 0
 
-        if not linux.wait_callback_success(wait_vnc_port_open, None, interval=0.5, timeout=30):
+        if not linux.wait_callback_success(wait_vnc_port_open, None, interval=0.5, timeout=30, events=waiter.Backoff()):
             raise kvmagent.KvmError("unable to start vm[uuid:%s, name:%s]; its vnc port does"
                                     " not open after 30 seconds" % (self.uuid, self.get_name()))
 
     def _wait_for_vm_paused(self, timeout=60):
-        if not linux.wait_callback_success(self.wait_for_state_change, self.VM_STATE_PAUSED, interval=0.5,
-                                           timeout=timeout):
+        with LibvirtAutoReconnect.domain_events.listen() as events:
+            ok = linux.wait_callback_success(self.wait_for_state_change, self.VM_STATE_PAUSED, interval=0.5,
+                                             timeout=timeout, events=events)
+        if not ok:
             raise kvmagent.KvmError('unable to start vm[uuid:%s, name:%s], vm state is not changing to '
                                     'paused after %s seconds' % (self.uuid, self.get_name(), timeout))
 
@@ -1513,13 +1803,16 @@ class Vm(object):
 
         do_destroy = True
         if graceful:
-            if linux.wait_callback_success(loop_shutdown, None, timeout=60):
-                do_destroy = False
+            with LibvirtAutoReconnect.domain_events.listen() as events:
+                if linux.wait_callback_success(loop_shutdown, None, timeout=60, events=events):
+                    do_destroy = False
 
         iscsi_cleanup()
 
         if do_destroy:
-            if not linux.wait_callback_success(loop_destroy, None, timeout=60):
+            with LibvirtAutoReconnect.domain_events.listen() as events:
+                destroyed = linux.wait_callback_success(loop_destroy, None, timeout=60, events=events)
+            if not destroyed:
                 logger.warn('failed to destroy vm, timeout after 60 secs')
                 raise kvmagent.KvmError('failed to stop vm, timeout after 60 secs')
 
@@ -1555,7 +1848,9 @@ class Vm(object):
                 else:
                     raise
 
-        if not linux.wait_callback_success(loop_suspend, None, timeout=10):
+        with LibvirtAutoReconnect.domain_events.listen() as events:
+            suspended = linux.wait_callback_success(loop_suspend, None, timeout=10, events=events)
+        if not suspended:
             raise kvmagent.KvmError('failed to suspend vm ,timeout after 10 secs')
 
     def resume(self, timeout=5):
@@ -1573,7 +1868,9 @@ class Vm(object):
                 else:
                     raise
 
-        if not linux.wait_callback_success(loop_resume, None, timeout=60):
+        with LibvirtAutoReconnect.domain_events.listen() as events:
+            resumed = linux.wait_callback_success(loop_resume, None, timeout=60, events=events)
+        if not resumed:
             raise kvmagent.KvmError('failed to resume vm ,timeout after 60 secs')
 
     def harden_console(self, mgmt_ip):
@@ -2484,7 +2781,9 @@ class Vm(object):
             else:
                 self.domain.attachDevice(xml)
 
-            if not linux.wait_callback_success(check_device, interval=0.5, timeout=30):
+            with waiter.watch_links() as events:
+                shown = linux.wait_callback_success(check_device, interval=0.5, timeout=30, events=events)
+            if not shown:
                 raise Exception('nic device does not show after 30 seconds')
         except:
             #  check one more time
@@ -2581,7 +2880,9 @@ class Vm(object):
                 self.domain.updateDeviceFlags(xml, libvirt.VIR_DOMAIN_AFFECT_LIVE)
             else:
                 self.domain.updateDeviceFlags(xml)
-            if not linux.wait_callback_success(check_device, nic, interval=0.5, timeout=30):
+            with waiter.watch_links() as events:
+                shown = linux.wait_callback_success(check_device, nic, interval=0.5, timeout=30, events=events)
+            if not shown:
                 raise Exception('nic device does not show after 30 seconds')
 
     def _check_qemuga_info(self, info):
@@ -2595,7 +2896,7 @@ class Vm(object):
     def _wait_until_qemuga_ready(self, timeout, uuid):
         finish_time = time.time() + (timeout / 1000)
         while time.time() < finish_time:
-            state = get_all_vm_states().get(uuid)
+            state = domain_cache.get_state(uuid)
             if state != Vm.VM_STATE_RUNNING:
                 raise kvmagent.KvmError("vm's state is %s, not running" % state)
             ping_json = shell.call('virsh qemu-agent-command %s \'{"execute":"guest-ping"}\'' % self.uuid, False)
@@ -2620,7 +2921,7 @@ class Vm(object):
     def change_vm_password(self, cmd):
         uuid = self.uuid
         # check the vm state first, then choose the method in different way
-        state = get_all_vm_states().get(uuid)
+        state = domain_cache.get_state(uuid)
         timeout = 60000
         if state == Vm.VM_STATE_RUNNING:
             # before set-user-password, we must check if os ready in the guest
@@ -3950,6 +4251,7 @@ class VmPlugin(kvmagent.KvmAgent):
             vm = get_vm_by_uuid(cmd.vmUuid)
             memory_size = cmd.memorySize
             vm.hotplug_mem(memory_size)
+            domain_cache.refresh(cmd.vmUuid)
             vm = get_vm_by_uuid(cmd.vmUuid)
             rsp.memorySize = vm.get_memory()
             logger.debug('successfully increase memory of vm[uuid:%s] to %s Kib' % (cmd.vmUuid, vm.get_memory()))
@@ -3974,6 +4276,7 @@ class VmPlugin(kvmagent.KvmAgent):
             vm = get_vm_by_uuid(cmd.vmUuid)
             cpu_num = cmd.cpuNum
             vm.hotplug_cpu(cpu_num)
+            domain_cache.refresh(cmd.vmUuid)
             vm = get_vm_by_uuid(cmd.vmUuid)
             rsp.cpuNum = vm.get_cpu_num()
             logger.debug('successfully increase cpu number of vm[uuid:%s] to %s' % (cmd.vmUuid, vm.get_cpu_num()))
@@ -3994,6 +4297,7 @@ class VmPlugin(kvmagent.KvmAgent):
             memory_size = cmd.memorySize
             vm.hotplug_mem(memory_size)
             vm.hotplug_cpu(cpu_num)
+            domain_cache.refresh(cmd.vmUuid)
             vm = get_vm_by_uuid(cmd.vmUuid)
             rsp.cpuNum = vm.get_cpu_num()
             rsp.memorySize = vm.get_memory()
@@ -4998,6 +5302,7 @@ class VmPlugin(kvmagent.KvmAgent):
         return jsonobject.dumps(rsp)
 
     def start(self):
+        self.state_reporter = VmStateReporter(self.config)
         http_server = kvmagent.get_http_server()
 
         http_server.register_async_uri(self.KVM_START_VM_PATH, self.start_vm)
@@ -5150,21 +5455,14 @@ class VmPlugin(kvmagent.KvmAgent):
                     'cannot find HOST_UUID, unable to report abnormal operation[vm:%s, op:%s]' % (vm_uuid, evstr))
                 return
 
-            @thread.AsyncThread
-            def report_to_management_node():
-                cmd = ReportVmStateCmd()
-                cmd.vmUuid = vm_uuid
-                cmd.hostUuid = host_uuid
-                if evstr == LibvirtEventManager.EVENT_STARTED:
-                    cmd.vmState = Vm.VM_STATE_RUNNING
-                elif evstr == LibvirtEventManager.EVENT_STOPPED:
-                    cmd.vmState = Vm.VM_STATE_SHUTDOWN
-
-                logger.debug(
-                    'detected an abnormal vm operation[uuid:%s, op:%s], report it to %s' % (vm_uuid, evstr, url))
-                http.json_dump_post(url, cmd, {'commandpath': '/kvm/reportvmstate'})
+            if evstr == LibvirtEventManager.EVENT_STARTED:
+                vm_state = Vm.VM_STATE_RUNNING
+            else:
+                vm_state = Vm.VM_STATE_SHUTDOWN
 
-            report_to_management_node()
+            logger.debug(
+                'detected an abnormal vm operation[uuid:%s, op:%s], report it to %s' % (vm_uuid, evstr, url))
+            self.state_reporter.report_state(vm_uuid, vm_state)
         except:
             content = traceback.format_exc()
             logger.warn(content)
@@ -5354,14 +5652,7 @@ class VmPlugin(kvmagent.KvmAgent):
                 logger.warn('cannot find SEND_COMMAND_URL, unable to report shutdown event of vm[uuid:%s]' % vm_uuid)
                 return
 
-            @thread.AsyncThread
-            def report_to_management_node():
-                cmd = ReportVmShutdownEventCmd()
-                cmd.vmUuid = vm_uuid
-                logger.debug('report shutdown event of vm ' + vm_uuid)
-                http.json_dump_post(url, cmd, {'commandpath': '/kvm/reportvmshutdown'})
-
-            report_to_management_node()
+            self.state_reporter.report_shutdown(vm_uuid)
         except:
             content = traceback.format_exc()
             logger.warn("traceback: %s" % content)
@@ -5455,6 +5746,7 @@ class VmPlugin(kvmagent.KvmAgent):
         LibvirtAutoReconnect.add_libvirt_callback(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._release_sharedblocks)
         LibvirtAutoReconnect.add_libvirt_callback(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._extend_sharedblock)
         LibvirtAutoReconnect.add_libvirt_callback(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._delete_pushgateway_metric)
+        domain_cache.start()
         LibvirtAutoReconnect.register_libvirt_callbacks()
 
     def clean_old_sshfs_mount_points(self):
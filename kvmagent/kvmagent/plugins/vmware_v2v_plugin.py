@@ -13,6 +13,7 @@ from zstacklib.utils import log
 from zstacklib.utils import shell
 from zstacklib.utils import http
 from zstacklib.utils import thread
+from zstacklib.utils import waiter
 from zstacklib.utils.bash import in_bash
 from zstacklib.utils.linux import shellquote
 from zstacklib.utils.plugin import completetask
@@ -175,7 +176,8 @@ class VMwareV2VPlugin(kvmagent.KvmAgent):
 
         @thread.AsyncThread
         def save_pid():
-            linux.wait_callback_success(os.path.exists, v2v_pid_path)
+            with waiter.watch_file(v2v_pid_path) as events:
+                linux.wait_callback_success(os.path.exists, v2v_pid_path, events=events)
             with open(v2v_pid_path, 'r') as fd:
                 new_task.current_pid = fd.read().strip()
             new_task.current_process_cmd = echo_pid_cmd
@@ -223,7 +225,8 @@ class VMwareV2VPlugin(kvmagent.KvmAgent):
                 return do_run()
 
             if process_still_running:
-                linux.wait_callback_success(os.path.exists, v2v_cmd_ret_path, timeout=259200, interval=60)
+                with waiter.watch_file(v2v_cmd_ret_path) as events:
+                    linux.wait_callback_success(os.path.exists, v2v_cmd_ret_path, timeout=259200, interval=60, events=events)
 
             ret = linux.read_file(v2v_cmd_ret_path)
             return int(ret.strip() if ret else 126)
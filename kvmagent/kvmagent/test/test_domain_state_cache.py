@@ -0,0 +1,153 @@
+'''
+
+@author: frank
+'''
+import unittest
+import libvirt
+from kvmagent.plugins import vm_plugin
+
+
+class FakeDomain(object):
+    def __init__(self, name, state=libvirt.VIR_DOMAIN_RUNNING, memory=1048576, cpu_num=1, active=True):
+        self._name = name
+        self.state = state
+        self.memory = memory
+        self.cpu_num = cpu_num
+        self.active = active
+
+    def name(self):
+        return self._name
+
+    def info(self):
+        return [self.state, self.memory, self.memory, self.cpu_num, 0]
+
+    def isActive(self):
+        return self.active
+
+
+class FakeConn(object):
+    def __init__(self, broken=False):
+        self.broken = broken
+
+    def getLibVersion(self):
+        if self.broken:
+            raise libvirt.libvirtError('client socket is closed')
+        return 1
+
+    def close(self):
+        pass
+
+
+class TestDomainStateCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = vm_plugin.DomainStateCache()
+        self.domains = [FakeDomain('vm1'), FakeDomain('vm2', libvirt.VIR_DOMAIN_PAUSED, cpu_num=2)]
+        self.loads = 0
+
+        def load_active_domains():
+            self.loads += 1
+            return dict([(d.name(), vm_plugin.DomainRecord.from_virt_domain(d)) for d in self.domains])
+        self.cache._load_active_domains = load_active_domains
+
+        self.timers = []
+        self.timer = vm_plugin.thread.timer
+        self.add_libvirt_callback = vm_plugin.LibvirtAutoReconnect.add_libvirt_callback
+        vm_plugin.thread.timer = lambda interval, func, *args, **kwargs: FakeTimer(self.timers, func)
+        vm_plugin.LibvirtAutoReconnect.add_libvirt_callback = staticmethod(lambda id, cb: None)
+
+    def tearDown(self):
+        vm_plugin.thread.timer = self.timer
+        vm_plugin.LibvirtAutoReconnect.add_libvirt_callback = staticmethod(self.add_libvirt_callback)
+
+    def test_event_driven_update(self):
+        self.cache.start()
+        self.assertEqual(vm_plugin.Vm.VM_STATE_RUNNING, self.cache.get_state('vm1'))
+        self.assertEqual(3, sum([r.cpu_num for r in self.cache.get_records()]))
+        self.assertEqual(2 << 30, sum([r.memory for r in self.cache.get_records()]))
+
+        self.cache._lifecycle_event(None, FakeDomain('vm3'), libvirt.VIR_DOMAIN_EVENT_STARTED, 0, None)
+        self.cache._lifecycle_event(None, FakeDomain('vm1'), libvirt.VIR_DOMAIN_EVENT_STOPPED, 0, None)
+        self.cache._lifecycle_event(None, FakeDomain('vm2'), libvirt.VIR_DOMAIN_EVENT_RESUMED, 0, None)
+        self.cache._lifecycle_event(None, FakeDomain('vm4', active=False), libvirt.VIR_DOMAIN_EVENT_DEFINED, 0, None)
+        self.assertEqual(None, self.cache.get_state('vm1'))
+        self.assertEqual(vm_plugin.Vm.VM_STATE_RUNNING, self.cache.get_state('vm2'))
+        self.assertEqual(vm_plugin.Vm.VM_STATE_RUNNING, self.cache.get_state('vm3'))
+        self.assertEqual(None, self.cache.get_state('vm4'))
+        # served from memory after the first seed
+        self.assertEqual(1, self.loads)
+
+    def test_event_during_seed_wins(self):
+        self.cache.start()
+        load_active_domains = self.cache._load_active_domains
+
+        def stop_while_listing():
+            records = load_active_domains()
+            self.cache._lifecycle_event(None, FakeDomain('vm1'), libvirt.VIR_DOMAIN_EVENT_STOPPED, 0, None)
+            return records
+        self.cache._load_active_domains = stop_while_listing
+        self.assertEqual(None, self.cache.get_state('vm1'))
+        self.assertEqual(vm_plugin.Vm.VM_STATE_PAUSED, self.cache.get_state('vm2'))
+
+    def test_not_listening(self):
+        # without events every call goes to libvirt
+        self.assertEqual(vm_plugin.Vm.VM_STATE_RUNNING, self.cache.get_state('vm1'))
+        self.assertEqual(2, len(self.cache.get_records()))
+        self.assertEqual(2, self.loads)
+
+    def test_reconcile_timer(self):
+        self.cache.start()
+        self.assertEqual(1, len(self.timers))
+        self.assertTrue(self.timers[0].started)
+        self.cache.get_state('vm1')
+
+        # an event is lost, the next reconcile catches up with libvirt
+        self.domains.pop(0)
+        self.domains.append(FakeDomain('vm3'))
+        self.assertEqual(vm_plugin.Vm.VM_STATE_RUNNING, self.cache.get_state('vm1'))
+        self.assertTrue(self.timers[0].func())
+        self.assertEqual(None, self.cache.get_state('vm1'))
+        self.assertEqual(vm_plugin.Vm.VM_STATE_RUNNING, self.cache.get_state('vm3'))
+        self.assertEqual(2, self.loads)
+
+        # starting again doesn't add another timer
+        self.cache.start()
+        self.assertEqual(1, len(self.timers))
+
+    def test_reconnect_invalidates(self):
+        cache = vm_plugin.domain_cache
+        conn = vm_plugin.LibvirtAutoReconnect.conn
+        shell_call = vm_plugin.shell.call
+        libvirt_open = vm_plugin.libvirt.open
+        seeded = cache.seeded
+        try:
+            cache.seeded = True
+            vm_plugin.LibvirtAutoReconnect.conn = FakeConn(broken=True)
+            vm_plugin.shell.call = lambda cmd, *args, **kwargs: ''
+            vm_plugin.libvirt.open = lambda uri: FakeConn()
+            vm_plugin.LibvirtAutoReconnect(lambda c: None)._reconnect()
+            self.assertFalse(cache.seeded)
+        finally:
+            vm_plugin.LibvirtAutoReconnect.conn = conn
+            vm_plugin.shell.call = shell_call
+            vm_plugin.libvirt.open = libvirt_open
+            cache.seeded = seeded
+
+        self.cache.start()
+        self.cache.get_state('vm1')
+        self.cache.invalidate()
+        self.cache.get_state('vm1')
+        self.assertEqual(2, self.loads)
+
+
+class FakeTimer(object):
+    def __init__(self, timers, func):
+        self.func = func
+        self.started = False
+        timers.append(self)
+
+    def start(self):
+        self.started = True
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+'''
+
+@author: frank
+'''
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from kvmagent.plugins import localstorage
+
+
+class FakeStdout(object):
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, size):
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+
+class FakePopen(object):
+    returncode = 0
+    cmds = []
+
+    def __init__(self, cmd, **kwargs):
+        FakePopen.cmds.append(cmd)
+        self.stdout = FakeStdout('sending incremental file list\n      1,024  50%\r      2,048 100%\n')
+
+    def wait(self):
+        pass
+
+
+class TestChainTransfer(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.base = os.path.join(self.dir, 'base.qcow2')
+        self.top = os.path.join(self.dir, 'top.qcow2')
+        for path in (self.base, self.top):
+            with open(path, 'w') as fd:
+                fd.write('x' * 2048)
+
+        self.cmds = []
+        self.call = localstorage.shell.call
+        self.run = localstorage.shell.run
+        self.popen = localstorage.subprocess.Popen
+        localstorage.shell.call = self._call
+        localstorage.shell.run = lambda cmd, *args, **kwargs: self.cmds.append(cmd)
+        localstorage.subprocess.Popen = FakePopen
+        FakePopen.returncode = 0
+        FakePopen.cmds = []
+
+    def tearDown(self):
+        localstorage.shell.call = self.call
+        localstorage.shell.run = self.run
+        localstorage.subprocess.Popen = self.popen
+        shutil.rmtree(self.dir)
+
+    def _call(self, cmd, *args, **kwargs):
+        self.cmds.append(cmd)
+        if 'stat -c' in cmd:
+            # the base is already on the destination
+            return '2048 %s %s\n' % (long(os.path.getmtime(self.base)), self.base)
+        return ''
+
+    def _transfer(self):
+        return localstorage.ChainTransfer([self.base, self.top], '10.0.0.2', 2222, 'root', '/tmp/password', 2)
+
+    def test_commands(self):
+        transfer = self._transfer()
+        transfer.run()
+
+        ssh = transfer.ssh
+        self.assertTrue(ssh.startswith('/usr/bin/sshpass -f/tmp/password ssh '))
+        self.assertIn(' -p 2222 -l root', ssh)
+        self.assertIn(' -o ControlPath=/tmp/zs-ssh-', ssh)
+
+        self.assertEqual('%s -fN -o ControlMaster=yes 10.0.0.2 </dev/null >/dev/null 2>&1' % ssh, self.cmds[0])
+        self.assertEqual('%s -O check 10.0.0.2' % ssh, self.cmds[1])
+        self.assertTrue(self.cmds[2].startswith('%s 10.0.0.2 ' % ssh))
+        self.assertIn('stat -c', self.cmds[2])
+        self.assertEqual('%s 10.0.0.2 %s' % (ssh, localstorage.linux.shellquote("/bin/sync '%s'" % self.top)),
+                         self.cmds[3])
+        self.assertEqual('%s -O exit 10.0.0.2' % ssh, self.cmds[-1])
+        self.assertEqual(5, len(self.cmds))
+
+        self.assertEqual(['rsync -a --progress --relative --partial --partial-dir=%s \'%s\' --rsh=%s 10.0.0.2:/' %
+                          (localstorage.RSYNC_PARTIAL_DIR, self.top, localstorage.linux.shellquote(ssh))],
+                         FakePopen.cmds)
+        self.assertEqual([self.base], transfer.skipped)
+        self.assertEqual(transfer.total, transfer.transferred())
+
+    def test_master_stopped_on_failure(self):
+        FakePopen.returncode = 1
+        transfer = self._transfer()
+        self.assertRaises(Exception, transfer.run)
+        self.assertEqual('%s -O exit 10.0.0.2' % transfer.ssh, self.cmds[-1])
+        self.assertFalse([c for c in self.cmds if '/bin/sync' in c])
+
+
+# like ssh -fN, the master goes to background with the stdout and stderr it was given
+FAKE_SSH = """#!/bin/bash
+case " $* " in
+*" -fN "*)
+    sleep 60 &
+    echo $! > %(dir)s/master.pid
+    ;;
+*" -O check "*)
+    kill -0 $(cat %(dir)s/master.pid)
+    ;;
+*" -O exit "*)
+    kill $(cat %(dir)s/master.pid)
+    ;;
+esac
+"""
+
+# drops -fPASSWORD_FILE and runs the rest
+FAKE_SSHPASS = """#!/bin/bash
+shift
+exec "$@"
+"""
+
+
+class TestChainTransferMaster(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for name, content in (('ssh', FAKE_SSH % {'dir': self.dir}), ('sshpass', FAKE_SSHPASS)):
+            path = os.path.join(self.dir, name)
+            with open(path, 'w') as fd:
+                fd.write(content)
+            os.chmod(path, 0755)
+
+        self.sshpass = localstorage.SSHPASS
+        self.path = os.environ['PATH']
+        localstorage.SSHPASS = os.path.join(self.dir, 'sshpass')
+        os.environ['PATH'] = '%s:%s' % (self.dir, self.path)
+
+    def tearDown(self):
+        localstorage.SSHPASS = self.sshpass
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.dir)
+
+    def test_master_in_background(self):
+        transfer = localstorage.ChainTransfer([], '10.0.0.2', 22, 'root', '/tmp/password')
+        start = time.time()
+        transfer._start_master()
+        # not waiting for the master to close its stdout
+        self.assertLess(time.time() - start, 30)
+
+        with open(os.path.join(self.dir, 'master.pid')) as fd:
+            pid = int(fd.read())
+        self.assertTrue(_running(pid))
+        transfer._stop_master()
+        time.sleep(0.1)
+        self.assertFalse(_running(pid))
+
+
+def _running(pid):
+    try:
+        with open('/proc/%s/stat' % pid) as fd:
+            # a zombie is not reaped yet if nothing waits for it in the container
+            return fd.read().split()[2] != 'Z'
+    except IOError:
+        return False
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,6 +6,7 @@ from zstacklib.utils import http
 from zstacklib.utils import jsonobject
 from zstacklib.utils import shell
 from zstacklib.utils import daemon
+from zstacklib.utils import downloader
 from zstacklib.utils.bash import *
 import functools
 import urlparse
@@ -425,7 +426,22 @@ class SftpBackupStorageAgent(object):
 
         timeout = cmd.timeout if cmd.timeout else 7200
         url = urlparse.urlparse(cmd.url)
-        if cmd.urlScheme in [self.URL_HTTP, self.URL_HTTPS, self.URL_FTP]:
+        md5sum = None
+        if cmd.urlScheme in [self.URL_HTTP, self.URL_HTTPS]:
+            try:
+                md5sum = downloader.download(cmd.url, install_path, timeout=timeout, callback=percentage_callback)
+            except downloader.DownloadError as e:
+                logger.warn(linux.get_exception_stacktrace())
+                rsp.success = False
+                rsp.error = str(e)
+                return jsonobject.dumps(rsp)
+            except Exception as e:
+                # e.g. the server refuses the probe request, let wget try it
+                logger.warn('failed to download %s in segments, use wget instead, %s' % (cmd.url, e))
+
+        if md5sum is not None:
+            logger.debug('downloaded %s in segments' % cmd.url)
+        elif cmd.urlScheme in [self.URL_HTTP, self.URL_HTTPS, self.URL_FTP]:
             try:
                 image_name = linux.shellquote(image_name)
                 cmd.url = linux.shellquote(cmd.url)
@@ -469,7 +485,8 @@ class SftpBackupStorageAgent(object):
         except Exception as e:
             image_format = "raw"
         size = os.path.getsize(install_path)
-        md5sum = 'not calculated'
+        if md5sum is None:
+            md5sum = 'not calculated'
         logger.debug('successfully downloaded %s to %s' % (cmd.url, install_path))
         (total, avail) = self.get_capacity()
         rsp.md5Sum = md5sum
@@ -10,6 +10,7 @@ from zstacklib.utils import linux
 from zstacklib.utils import log
 from zstacklib.utils import shell
 from zstacklib.utils import lock
+from zstacklib.utils import waiter
 import os.path
 
 logger = log.get_logger(__name__)
@@ -280,14 +281,14 @@ class Dnsmasq(virtualrouter.VRAgent):
             dnsmasq_pid = linux.get_pid_by_process_name('dnsmasq')
             return dnsmasq_pid is not None 
 
-        if not linux.wait_callback_success(check_start, None, 5, 0.5):
+        if not linux.wait_callback_success(check_start, None, 5, 0.5, events=waiter.Backoff()):
             logger.debug('dnsmasq is not running, former start failed, try to start it again ...')
             cmd = self._do_dnsmasq_start()
             
             if cmd.return_code != 0:
                 raise virtualrouter.VirtualRouterError('dnsmasq in virtual router is not running, we try to start it but fail, error is %s' % cmd.stdout)
 
-            if not linux.wait_callback_success(check_start, None, 5, 0.5):
+            if not linux.wait_callback_success(check_start, None, 5, 0.5, events=waiter.Backoff()):
                 raise virtualrouter.VirtualRouterError('dnsmasq in virtual router is not running, "/etc/init.d/dnsmasq start" returns success, but the process is not running after 5 seconds')
 
     @lock.lock('dnsmasq')
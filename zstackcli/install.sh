@@ -14,5 +14,7 @@ source $VIRTUAL_ENV/bin/activate
 
 python setup.py sdist
 pip install --ignore-installed dist/*.tar.gz
+# completion index of the installed apibinding, read by zstack-cli at startup
+python -m zstackcli.completion_index
 # If you have own pypi server, please use followin line.
 #pip install --ignore-installed dist/*.tar.gz -i http://10.0.101.1/pypi/simple
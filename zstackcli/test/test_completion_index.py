@@ -0,0 +1,159 @@
+'''
+
+@author: frank
+'''
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+import apibinding
+import simplejson
+from zstackcli import completion_index
+
+
+class OptionalList(list):
+    pass
+
+
+class NotNoneList(list):
+    pass
+
+
+class APICreateVmInstanceMsg(object):
+    def __init__(self):
+        self.name = None
+        self.l3NetworkUuids = OptionalList()
+        self.session = None
+
+
+class APIQueryVmInstanceMsg(object):
+    def __init__(self):
+        self.conditions = NotNoneList()
+        self.limit = None
+        self.session = None
+
+
+class VmInstanceInventory(object):
+    PRIMITIVE_FIELDS = ['uuid', 'name']
+    EXPANDED_FIELDS = ['vmNics']
+    QUERY_OBJECT_MAP = {'vmNics': 'VmNicInventory'}
+
+
+class VmNicInventory(object):
+    PRIMITIVE_FIELDS = ['uuid', 'ip']
+    EXPANDED_FIELDS = ['vmInstance']
+    QUERY_OBJECT_MAP = {'vmInstance': 'VmInstanceInventory'}
+
+
+def _fake_inventory():
+    inventory = types.ModuleType('apibinding.inventory')
+    for obj in (OptionalList, NotNoneList, APICreateVmInstanceMsg, APIQueryVmInstanceMsg, VmInstanceInventory,
+                VmNicInventory):
+        setattr(inventory, obj.__name__, obj)
+    inventory.api_names = ['APIQueryVmInstanceMsg', 'APICreateVmInstanceMsg']
+    inventory.queryMessageInventoryMap = {'APIQueryVmInstanceMsg': VmInstanceInventory}
+    return inventory
+
+
+class TestCompletionIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = list(completion_index.INDEX_PATHS)
+        # save() takes the list as its default, change it in place
+        completion_index.INDEX_PATHS[:] = [os.path.join(self.dir, 'share', completion_index.INDEX_NAME)]
+
+        self.inventory = sys.modules.get('apibinding.inventory')
+        sys.modules['apibinding.inventory'] = _fake_inventory()
+        apibinding.inventory = sys.modules['apibinding.inventory']
+
+        self.stamp = ['inventory.py', 100, 1]
+        self.inventory_stamp = completion_index._inventory_stamp
+        completion_index._inventory_stamp = lambda: self.stamp
+
+        self.builds = 0
+        self.build = completion_index.build
+
+        def build():
+            self.builds += 1
+            return self.build()
+        completion_index.build = build
+
+    def tearDown(self):
+        completion_index.INDEX_PATHS[:] = self.paths
+        completion_index._inventory_stamp = self.inventory_stamp
+        completion_index.build = self.build
+        if self.inventory:
+            sys.modules['apibinding.inventory'] = apibinding.inventory = self.inventory
+        else:
+            del sys.modules['apibinding.inventory']
+            del apibinding.inventory
+        shutil.rmtree(self.dir)
+
+    def test_build(self):
+        index = completion_index.build()
+        self.assertEqual(completion_index.INDEX_VERSION, index['version'])
+        self.assertEqual(self.stamp, index['inventory'])
+        self.assertEqual(['CreateVmInstance', 'QueryVmInstance'], index['short_names'])
+        self.assertEqual(['l3NetworkUuids', 'name'], sorted(index['params']['APICreateVmInstanceMsg']))
+        self.assertEqual(['l3NetworkUuids'], index['list_params']['APICreateVmInstanceMsg'])
+        self.assertEqual(['conditions'], index['list_params']['APIQueryVmInstanceMsg'])
+        self.assertEqual({'APIQueryVmInstanceMsg': 'VmInstanceInventory'}, index['query_inventories'])
+        # inventories referring to each other are walked once
+        self.assertEqual(['VmInstanceInventory', 'VmNicInventory'], sorted(index['inventories']))
+        self.assertEqual({'vmNics': 'VmNicInventory'},
+                         index['inventories']['VmInstanceInventory']['query_object_map'])
+        # what the cli loads is plain json
+        self.assertEqual(index, simplejson.loads(simplejson.dumps(index)))
+
+    def test_load(self):
+        index = completion_index.load()
+        self.assertEqual(1, self.builds)
+        self.assertTrue(os.path.exists(completion_index.INDEX_PATHS[0]))
+
+        # read from the file afterwards
+        self.assertEqual(index, completion_index.load())
+        self.assertEqual(1, self.builds)
+
+    def test_unwritable_path_falls_back(self):
+        blocker = os.path.join(self.dir, 'file')
+        with open(blocker, 'w') as fd:
+            fd.write('')
+        fallback = os.path.join(self.dir, 'home', completion_index.INDEX_NAME)
+        completion_index.INDEX_PATHS[:] = [os.path.join(blocker, completion_index.INDEX_NAME), fallback]
+        completion_index.load()
+        self.assertTrue(os.path.exists(fallback))
+        completion_index.load()
+        self.assertEqual(1, self.builds)
+
+    def test_stale_index(self):
+        completion_index.load()
+
+        # the inventory is regenerated
+        self.stamp = ['inventory.py', 200, 2]
+        self.assertEqual(self.stamp, completion_index.load()['inventory'])
+        self.assertEqual(2, self.builds)
+
+        # an index of another layout
+        path = completion_index.INDEX_PATHS[0]
+        with open(path) as fd:
+            index = simplejson.load(fd)
+        index['version'] = completion_index.INDEX_VERSION + 1
+        with open(path, 'w') as fd:
+            simplejson.dump(index, fd)
+        completion_index.load()
+        self.assertEqual(3, self.builds)
+
+        # a broken index
+        with open(path, 'w') as fd:
+            fd.write('{')
+        completion_index.load()
+        self.assertEqual(4, self.builds)
+        completion_index.load()
+        self.assertEqual(4, self.builds)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+'''
+
+@author: frank
+'''
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from zstackcli import result_history
+
+
+class TestResultHistory(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.folder = os.path.join(self.dir, 'result_history')
+        self.history = result_history.ResultHistory(self.folder, 3)
+        self.appended = 0
+
+    def tearDown(self):
+        self.history.close()
+        shutil.rmtree(self.dir)
+
+    def _append(self, count):
+        # the results are numbered on from the ones already there, odd ones succeed
+        for i in range(self.appended + 1, self.appended + count + 1):
+            self.history.append('QueryHost uuid=%s' % i, '{"result": %s}' % i, i % 2 == 1)
+        self.appended += count
+
+    def _read_file(self, slot):
+        f = gzip.open(os.path.join(self.folder, 'result-%d.gz' % slot), 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_wrap_around(self):
+        self._append(3)
+        self.assertEqual('{"result": 1}', self._read_file(1))
+
+        self._append(2)
+        self.assertEqual(3, self.history.count())
+        # the 4th result takes over the slot of the 1st, its file is replaced
+        self.assertEqual('{"result": 4}', self._read_file(1))
+        self.assertEqual(['result-0.gz', 'result-1.gz', 'result-2.gz'],
+                         sorted([n for n in os.listdir(self.folder) if n.startswith('result-')]))
+
+    def test_more_num_after_wrapping(self):
+        self._append(5)
+        # 'more N' is the Nth latest result
+        self.assertEqual(('QueryHost uuid=5', True, '{"result": 5}'), self.history.get(1))
+        self.assertEqual(('QueryHost uuid=4', False, '{"result": 4}'), self.history.get(2))
+        self.assertEqual(('QueryHost uuid=3', True, '{"result": 3}'), self.history.get(3))
+        self.assertEqual([(1, 'QueryHost uuid=5', True), (2, 'QueryHost uuid=4', False), (3, 'QueryHost uuid=3', True)],
+                         self.history.list())
+
+        # and the same after reopening
+        self.history.close()
+        self.history = result_history.ResultHistory(self.folder, 3)
+        self.assertEqual(('QueryHost uuid=5', True, '{"result": 5}'), self.history.get(1))
+
+    def test_out_of_range(self):
+        self.assertRaises(result_history.ResultHistoryError, self.history.get, 1)
+        self._append(2)
+        self.assertRaises(result_history.ResultHistoryError, self.history.get, 0)
+        self.assertRaises(result_history.ResultHistoryError, self.history.get, 3)
+        self._append(3)
+        self.assertRaises(result_history.ResultHistoryError, self.history.get, 4)
+        self.assertRaises(result_history.ResultHistoryError, self.history.get, -1)
+
+    def test_missing_slot(self):
+        self._append(3)
+
+        # the result file of 'more 1' is lost
+        os.remove(os.path.join(self.folder, 'result-0.gz'))
+        try:
+            self.history.get(1)
+            self.fail('a lost result file should raise')
+        except result_history.ResultHistoryError as e:
+            self.assertIn('No.1', str(e))
+
+        # the result file of 'more 2' is broken
+        with open(os.path.join(self.folder, 'result-2.gz'), 'wb') as fd:
+            fd.write(open(os.path.join(self.folder, 'result-1.gz'), 'rb').read()[:10])
+        self.assertRaises(result_history.ResultHistoryError, self.history.get, 2)
+
+        # the index doesn't have the slot of 'more 3'
+        self.history.index.set('1', [100, 'QueryHost', True])
+        self.assertRaises(result_history.ResultHistoryError, self.history.get, 3)
+        self.assertEqual([1, 2], [num for num, _, _ in self.history.list()])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -25,6 +25,7 @@ import urllib3
 
 import cStringIO as c
 import csv
+import simplejson
 
 import zstacklib.utils.log as log
 import zstacklib.utils.linux as linux
@@ -32,24 +33,34 @@ import zstacklib.utils.linux as linux
 # comment out next line to print detail zstack cli http command to screen.
 log.configure_log('/var/log/zstack/zstack-cli', log_to_console=False)
 
-import apibinding.inventory as inventory
 import apibinding.api as api
 import zstacklib.utils.jsonobject as jsonobject
-import zstacklib.utils.filedb as filedb
-import zstackcli.parse_config as parse_config
-import zstackcli.deploy_config as deploy_config
-import zstackcli.read_config as read_config
+import zstackcli.completion_index as completion_index
+import zstackcli.result_history as result_history
 
 cld = termcolor.colored
 cprint = termcolor.cprint
 
 text_doc = pydoc.TextDoc()
 
+
+class LazyInventory(object):
+    """
+    apibinding.inventory holds thousands of classes, it's imported when a message is
+    created rather than at startup. Completion uses the completion index instead
+    """
+    def __getattr__(self, name):
+        import apibinding.inventory
+        return getattr(apibinding.inventory, name)
+
+
+inventory = LazyInventory()
+
 CLI_LIB_FOLDER = os.path.expanduser('~/.zstack/cli')
 CLI_HISTORY = '%s/command_history' % CLI_LIB_FOLDER
 CLI_RESULT_HISTORY_FOLDER = '%s/result_history' % CLI_LIB_FOLDER
+# index of the former result history, whose plain result files are dropped on upgrade
 CLI_RESULT_HISTORY_KEY = '%s/result_key' % CLI_RESULT_HISTORY_FOLDER
-CLI_RESULT_FILE = '%s/result' % CLI_RESULT_HISTORY_FOLDER
 SESSION_FILE = '%s/session' % CLI_LIB_FOLDER
 CLI_MAX_CMD_HISTORY = 1000
 CLI_MAX_RESULT_HISTORY = 1000
@@ -59,6 +70,13 @@ query_param_keys = \
     ['conditions', 'count', 'limit', 'start', 'timeout',
      'replyWithCount', 'sortBy', 'sortDirection', 'fields']
 
+# streaming query: pages through the results and writes inventories as they arrive
+STREAM_OUTPUT_KEY = '__output__'
+STREAM_FILE_KEY = '__outputFile__'
+STREAM_PAGE_SIZE_KEY = '__pageSize__'
+STREAM_PARAM_KEYS = [STREAM_OUTPUT_KEY, STREAM_FILE_KEY, STREAM_PAGE_SIZE_KEY]
+STREAM_FORMATS = ['jsonl', 'csv']
+
 NOT_QUERY_MYSQL_APIS = [
     'APIQueryLogMsg',
     'QueryLog'
@@ -141,11 +159,11 @@ class Cli(object):
 
         def prepare_primitive_fields_words(apiname, separator='=', prefix=''):
             if not prefix:
-                api_map_name = inventory.queryMessageInventoryMap[apiname].__name__
+                api_map_name = self.query_inventories[apiname]
             else:
                 api_map_name = apiname
 
-            query_pri_fields = eval('inventory.%s().PRIMITIVE_FIELDS' % api_map_name)
+            query_pri_fields = self.inventories[api_map_name]['primitive']
             query_pri_fields = ['%s' % field for field in query_pri_fields]
             temp_fields = list(query_pri_fields)
             query_pri_fields = []
@@ -159,10 +177,10 @@ class Cli(object):
 
         def prepare_expanded_fields_words(apiname, separator='.', prefix=''):
             if not prefix:
-                api_map_name = inventory.queryMessageInventoryMap[apiname].__name__
+                api_map_name = self.query_inventories[apiname]
             else:
                 api_map_name = apiname
-            query_ext_fields = eval('inventory.%s().EXPANDED_FIELDS' % api_map_name)
+            query_ext_fields = self.inventories[api_map_name]['expanded']
             query_ext_fields = ['%s' % field for field in query_ext_fields]
             temp_fields = list(query_ext_fields)
             query_ext_fields = []
@@ -199,6 +217,7 @@ class Cli(object):
                     if not ('UserTag' in apiname or 'SystemTag' in apiname):
                         self.words.append('__systemTag__=')
                         self.words.append('__userTag__=')
+                    self.words.extend(['%s=' % key for key in STREAM_PARAM_KEYS])
             else:
                 self.is_cmd = True
                 self.words = self.words_db
@@ -221,20 +240,19 @@ class Cli(object):
                 fields_num = len(fields_objects)
                 apiname = currtext.split()[0]
                 new_api_name = 'API%sMsg' % apiname
-                if inventory.queryMessageInventoryMap.has_key(new_api_name):
-                    api_obj_name = inventory.queryMessageInventoryMap[new_api_name].__name__
-                    query_ext_fields = eval('inventory.%s().EXPANDED_FIELDS' % api_obj_name)
+                if new_api_name in self.query_inventories:
+                    api_obj_name = self.query_inventories[new_api_name]
+                    query_ext_fields = self.inventories[api_obj_name]['expanded']
                     if head_field in query_ext_fields:
-                        current_obj_name = eval('inventory.%s().QUERY_OBJECT_MAP["%s"]' % (api_obj_name, head_field))
+                        current_obj_name = self.inventories[api_obj_name]['query_object_map'][head_field]
 
                         for i in range(0, fields_num):
                             if i == fields_num - 2:
                                 break
                             next_field = fields_objects[i + 1]
-                            query_ext_fields = eval('inventory.%s().EXPANDED_FIELDS' % current_obj_name)
+                            query_ext_fields = self.inventories[current_obj_name]['expanded']
                             if next_field in query_ext_fields:
-                                current_obj_name = eval(
-                                    'inventory.%s().QUERY_OBJECT_MAP["%s"]' % (current_obj_name, next_field))
+                                current_obj_name = self.inventories[current_obj_name]['query_object_map'][next_field]
                             else:
                                 current_obj_name = None
                     else:
@@ -252,7 +270,6 @@ class Cli(object):
             if not currtext.endswith(' ') and last_field.startswith('fields='):
                 apiname = currtext.split()[0]
                 new_api_name = 'API%sMsg' % apiname
-                api_map_name = inventory.queryMessageInventoryMap[new_api_name].__name__
                 self.words = []
                 fields = last_field.split('=')[1]
                 prepare_fields_words(new_api_name, fields.split(','))
@@ -275,11 +292,9 @@ example: %sLogInByAccount accountName=admin password=your_super_secure_admin_pas
             return True
 
         def is_api_param_a_list(apiname, param):
-            optional_list = eval('isinstance(inventory.%s().%s, \
-                    inventory.OptionalList)' % (apiname, param))
-            not_none_list = eval('isinstance(inventory.%s().%s, \
-                    inventory.NotNoneList)' % (apiname, param))
-            if optional_list or not_none_list:
+            if param not in self.api_class_params[apiname] and param != 'session':
+                raise CliError("'%s' object has no attribute '%s'" % (apiname, param))
+            if param in self.completion_index['list_params'][apiname]:
                 return True
 
         def build_params():
@@ -310,7 +325,7 @@ Parse command parameters error:
                     return cmd, None
 
             apiname = 'API%sMsg' % pairs[0]
-            if apiname not in inventory.api_names:
+            if apiname not in self.api_class_params:
                 raise CliError('"%s" is not an API message' % apiname)
 
             # '=' will be used for more meanings than 'equal' in Query API
@@ -510,6 +525,18 @@ Parse command parameters error:
                 setattr(msg, key, value)
             return msg
 
+        def pop_stream_params(params):
+            stream = {}
+            for param in list(params):
+                key, value = param.split('=', 1)
+                if key in STREAM_PARAM_KEYS:
+                    stream[key] = value
+                    params.remove(param)
+
+            if stream and stream.get(STREAM_OUTPUT_KEY) not in STREAM_FORMATS:
+                raise CliError('%s must be one of %s' % (STREAM_OUTPUT_KEY, ', '.join(STREAM_FORMATS)))
+            return stream
+
         def set_session_to_api(msg):
             session = inventory.Session()
             session.uuid = self.session_uuid
@@ -533,9 +560,19 @@ Parse command parameters error:
         if not check_session(apiname):
             raise CliError("No session uuid defined")
 
+        stream = None
+        if apiname.startswith('APIQuery') and apiname not in NOT_QUERY_MYSQL_APIS:
+            stream = pop_stream_params(all_params)
+
         msg = create_msg(apiname, all_params)
         set_session_to_api(msg)
         try:
+            if stream:
+                result = self.stream_query(msg, stream)
+                print '%s\n' % result
+                self.write_more(args, result)
+                return
+
             if apiname in [self.LOGIN_MESSAGE_NAME, self.LOGIN_BY_USER_NAME, self.CREATE_ACCOUNT_NAME,
                            self.CREATE_USER_NAME, self.LOGIN_BY_USER_IAM2, self.CREATE_USER_IAM2,
                            self.GET_TWO_FACTOR_AUTHENTICATION_SECRET]:
@@ -654,23 +691,8 @@ Parse command parameters error:
                     keys.remove(k)
             return keys
 
-        for apiname in inventory.api_names:
-            obj = eval("inventory.%s()" % apiname)
-            params = []
-            params.extend(obj.__dict__.keys())
-            self.api_class_params[apiname] = rule_out_unneeded_params(params)
-
-    def _parse_api_name(self, api_names):
-        """
-        Remove API pattern 'API' and appendix 'MSG'
-        """
-        short_api_name = []
-        for api in api_names:
-            if api.endswith('Msg'):
-                short_api_name.append(api[3:-3])
-
-        short_api_name.sort()
-        return short_api_name
+        for apiname, params in self.completion_index['params'].items():
+            self.api_class_params[apiname] = rule_out_unneeded_params(list(params))
 
     def get_prompt_with_account_info(self):
         prompt_with_account_info = ''
@@ -770,39 +792,52 @@ Parse command parameters error:
 
         # readline.redisplay()
 
-    def write_more(self, cmd, result, success=True):
-        if self.hd.get(self.start_key):
-            start_value = int(self.hd.get(self.start_key))
-        else:
-            start_value = 0
-
-        if self.hd.get(self.last_key):
-            last_value = int(self.hd.get(self.last_key))
-        else:
-            last_value = 0
-
-        if last_value <= start_value:
-            if start_value < CLI_MAX_RESULT_HISTORY:
-                start_value += 1
-            else:
-                start_value = 1
-                last_value = 2
-        else:
-            if last_value < CLI_MAX_RESULT_HISTORY:
-                start_value += 1
-                last_value += 1
+    def stream_query(self, msg, stream):
+        '''
+        writes the inventories of a query page by page as JSON lines or CSV rows,
+        so the memory doesn't grow with the number of results
+        '''
+        if str(getattr(msg, 'count', None)).lower() == 'true':
+            raise CliError('count=true is not supported with %s' % STREAM_OUTPUT_KEY)
+
+        def to_str(value):
+            if isinstance(value, unicode):
+                return value.encode('utf-8')
+            if isinstance(value, (jsonobject.JsonObject, list, dict)):
+                return simplejson.dumps(value, default=lambda obj: obj.__dict__)
+            return '' if value is None else str(value)
+
+        page_size = int(stream.get(STREAM_PAGE_SIZE_KEY) or api.QUERY_PAGE_SIZE)
+        path = stream.get(STREAM_FILE_KEY)
+        out = open(os.path.expanduser(path), 'w') if path else sys.stdout
+        writer = None
+        num = 0
+        try:
+            for inv in self.api.iter_query(msg, page_size, fail_soon=True):
+                if stream[STREAM_OUTPUT_KEY] == 'jsonl':
+                    out.write('%s\n' % jsonobject.dumps(inv))
+                else:
+                    if not writer:
+                        # columns of the first inventory unless given by 'fields'
+                        columns = getattr(msg, 'fields', None) or sorted(inv.__dict__.keys())
+                        writer = csv.writer(out)
+                        writer.writerow(columns)
+                    writer.writerow([to_str(getattr(inv, col, None)) for col in columns])
+
+                num += 1
+                if num % page_size == 0:
+                    out.flush()
+        finally:
+            if path:
+                out.close()
             else:
-                start_value += 1
-                last_value = 1
+                out.flush()
 
-        self.hd.set(self.start_key, start_value)
-        self.hd.set(self.last_key, last_value)
-        # filedb might leave more than 1 same key item.
-        while self.hd.get(str(start_value)):
-            self.hd.rem(str(start_value))
+        if path:
+            return '%d inventories written to %s' % (num, path)
+        return '%d inventories' % num
 
-        result_file = '%s%d' % (CLI_RESULT_FILE, start_value)
-        with open(result_file, 'w') as f: f.write(result)
+    def write_more(self, cmd, result, success=True):
         if not self.no_secure and 'password=' in ' '.join(cmd):
             cmds2 = []
             for cmd2 in cmd:
@@ -812,7 +847,7 @@ Parse command parameters error:
                     cmds2.append(cmd2.split('=')[0] + '=' + '******')
             cmd = ' '.join(cmds2)
 
-        self.hd.set(str(start_value), [cmd, success])
+        self.hd.append(cmd, result, success)
 
     def read_more(self, num=None, need_print=True, full_info=True):
         """
@@ -821,8 +856,6 @@ Parse command parameters error:
         full_info will indicate whether return command and params information
             when return command results.
         """
-        start_value = self.hd.get(self.start_key)
-        last_value = self.hd.get(self.last_key)
         more_usage_list = [text_doc.bold('Usage:'),
                            text_doc.bold('\t%smore NUM\t #show the No. NUM Command result' % prompt), text_doc.bold(
                 '\t%smore\t\t #show all available NUM and Command.'
@@ -830,69 +863,46 @@ Parse command parameters error:
 
         more_usage = '\n'.join(more_usage_list)
 
-        if not start_value:
+        if not self.hd.count():
             print 'No command history to display.'
             return
 
         if num:
             if num.isdigit():
-                if int(num) > CLI_MAX_CMD_HISTORY:
+                if int(num) > CLI_MAX_RESULT_HISTORY:
                     print 'Not find result for number: %s' % num
                     print 'Max number is: %s ' % str(CLI_MAX_RESULT_HISTORY)
                     cprint(more_usage, attrs=['bold'], end='\n')
                     return
 
-                key = start_value - int(num) + 1
-                if key <= 0:
-                    key += CLI_MAX_RESULT_HISTORY
-
-                # print key
-                result_list = self.hd.get(str(key))
-                result = None
-
-                result_file = '%s%d' % (CLI_RESULT_FILE, key)
-                with open(result_file, 'r') as f: result = f.read()
+                # reads the result of this command only
+                try:
+                    cmd, _, result = self.hd.get(int(num))
+                except result_history.ResultHistoryError as e:
+                    print 'Not find result for number: %s, %s' % (num, e)
+                    cprint(more_usage, attrs=['bold'], end='\n')
+                    return
 
-                if result_list:
-                    output = 'Command: \n\t%s\nResult:\n%s' % \
-                             (result_list[0], result)
-                    if need_print:
-                        pydoc.pager(output)
+                output = 'Command: \n\t%s\nResult:\n%s' % (cmd, result)
+                if need_print:
+                    pydoc.pager(output)
 
-                    if full_info:
-                        return [result_list[0], output]
-                    else:
-                        return [result_list[0], result]
+                if full_info:
+                    return [cmd, output]
+                else:
+                    return [cmd, result]
         else:
             more_list = []
             explamation = text_doc.bold('!')
-            if start_value < last_value:
-                for i in range(CLI_MAX_RESULT_HISTORY):
-                    if start_value - i > 0:
-                        key = start_value - i
-                    else:
-                        key = start_value - i + CLI_MAX_RESULT_HISTORY
-
-                    cmd_result = self.hd.get(str(key))
-                    cmd_result_list = str(cmd_result[0]).split()
-                    cmd = text_doc.bold(cmd_result_list[0])
-                    if len(cmd_result_list) > 1:
-                        cmd = cmd + ' ' + ' '.join(cmd_result_list[1:])
-                    if len(cmd_result) <= 2 or cmd_result[2]:
-                        more_list.append('[%s]\t %s' % (str(i + 1), cmd))
-                    else:
-                        more_list.append('[%s]  %s\t %s' % (str(i + 1), explamation, cmd))
-            else:
-                for i in range(start_value):
-                    cmd_result = self.hd.get(str(start_value - i))
-                    cmd_result_list = str(cmd_result[0]).split()
-                    cmd = text_doc.bold(cmd_result_list[0])
-                    if len(cmd_result_list) > 1:
-                        cmd = cmd + ' ' + ' '.join(cmd_result_list[1:])
-                    if len(cmd_result) <= 2 or cmd_result[2]:
-                        more_list.append('[%s]\t %s' % (str(i + 1), cmd))
-                    else:
-                        more_list.append('[%s]  %s\t %s' % (str(i + 1), explamation, cmd))
+            for i, cmd_str, success in self.hd.list():
+                cmd_result_list = str(cmd_str).split()
+                cmd = text_doc.bold(cmd_result_list[0])
+                if len(cmd_result_list) > 1:
+                    cmd = cmd + ' ' + ' '.join(cmd_result_list[1:])
+                if success:
+                    more_list.append('[%s]\t %s' % (str(i), cmd))
+                else:
+                    more_list.append('[%s]  %s\t %s' % (str(i), explamation, cmd))
 
             more_result = '\n'.join(more_list)
             header = text_doc.bold('[NUM]\tCOMMAND')
@@ -1066,6 +1076,15 @@ Parse command parameters error:
 
                 [VALUE] is a string containing value as query a condition; ',' is used to split value into a string list.
                         strings are compared as case insensitive.
+
+                __output__=jsonl|csv: stream the results page by page with 'start' and 'limit' instead of loading
+                        them all, writing a JSON line or a CSV row per inventory; __outputFile__=PATH writes to a
+                        file instead of the screen and __pageSize__=NUM sets the page size(default 1000). Give
+                        'sortBy' to keep pages apart when resources change meanwhile.
+
+                      >>> QueryVmInstance state=Running sortBy=createDate __output__=csv __outputFile__=vms.csv
+
+                      >>> QueryVolume fields=uuid,name,size __output__=jsonl
 '''
 
         help_string += text_doc.bold('ZStack API')
@@ -1091,20 +1110,16 @@ Parse command parameters error:
             pass
         readline.set_history_length(CLI_MAX_CMD_HISTORY)
 
-        if not os.path.isdir(CLI_RESULT_HISTORY_FOLDER):
-
-            linux.rm_dir_force(os.path.dirname(CLI_RESULT_HISTORY_FOLDER))
-            os.system('mkdir -p %s' % os.path.dirname(CLI_RESULT_HISTORY_FOLDER))
+        if not os.path.isdir(CLI_RESULT_HISTORY_FOLDER) or os.path.exists(CLI_RESULT_HISTORY_KEY):
+            linux.rm_dir_force(CLI_RESULT_HISTORY_FOLDER)
+            os.system('mkdir -p %s' % CLI_RESULT_HISTORY_FOLDER)
 
         try:
-            self.hd = filedb.FileDB(CLI_RESULT_HISTORY_KEY, is_abs_path=True)
+            self.hd = result_history.ResultHistory(CLI_RESULT_HISTORY_FOLDER, CLI_MAX_RESULT_HISTORY)
         except:
-            linux.rm_dir_force(CLI_RESULT_HISTORY_KEY)
-            self.hd = filedb.FileDB(CLI_RESULT_HISTORY_KEY, is_abs_path=True)
-            print "\nRead history file: %s error. Has recreate it.\n" % CLI_RESULT_HISTORY_KEY
-
-        self.start_key = 'start_key'
-        self.last_key = 'last_key'
+            linux.rm_dir_force(CLI_RESULT_HISTORY_FOLDER)
+            self.hd = result_history.ResultHistory(CLI_RESULT_HISTORY_FOLDER, CLI_MAX_RESULT_HISTORY)
+            print "\nRead history file: %s error. Has recreate it.\n" % CLI_RESULT_HISTORY_FOLDER
         self.cli_cmd_func = {'help': self.show_help,
                              'history': self.show_help,
                              'more': self.show_more,
@@ -1113,7 +1128,11 @@ Parse command parameters error:
                              'save': self.save_json_to_file}
         self.cli_cmd = self.cli_cmd_func.keys()
 
-        self.raw_words_db = self._parse_api_name(inventory.api_names)
+        self.completion_index = completion_index.load()
+        self.query_inventories = self.completion_index['query_inventories']
+        self.inventories = self.completion_index['inventories']
+        # API names without the 'API' prefix and 'Msg' suffix, sorted when the index was built
+        self.raw_words_db = self.completion_index['short_names']
         self.words_db = list(self.raw_words_db)
         self.words_db.extend(self.cli_cmd)
         self.words = list(self.words_db)
@@ -1206,10 +1225,13 @@ def main():
     os.environ['ZSTACK_BUILT_IN_HTTP_SERVER_PORT'] = options.port
 
     if options.zstack_config_dump_file:
+        import zstackcli.read_config as read_config
         admin_passwd = hashlib.sha512(options.admin_password).hexdigest()
         read_config.dump_zstack(options.zstack_config_dump_file,
                                 admin_passwd)
     elif options.deploy_config_file:
+        import zstackcli.parse_config as parse_config
+        import zstackcli.deploy_config as deploy_config
         # deploy ZStack pre-configed environment.
         xml_config = parse_config.DeployConfig(options.deploy_config_file, options.deploy_config_template_file)
         deploy_xml_obj = xml_config.get_deploy_config()
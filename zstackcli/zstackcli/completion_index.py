@@ -0,0 +1,120 @@
+"""
+API names, parameters and query fields the cli completes, extracted from
+apibinding.inventory once and loaded with one file read afterwards
+
+@author: Frank
+"""
+import os
+import sys
+
+import simplejson
+
+# bump it when the layout of the index changes
+INDEX_VERSION = 1
+INDEX_NAME = 'completion_index.json'
+# generated by install.sh into the virtualenv of zstack-cli; the cli rebuilds the index
+# into its lib folder when that one is missing or built from another inventory
+INDEX_PATHS = [os.path.join(sys.prefix, 'share', 'zstackcli', INDEX_NAME),
+               os.path.expanduser('~/.zstack/cli/%s' % INDEX_NAME)]
+
+
+def _inventory_stamp():
+    # stat the module instead of importing it, the import is what the index saves
+    import apibinding
+    path = os.path.join(os.path.dirname(apibinding.__file__), 'inventory')
+    for p in (path + '.py', path + '.pyc'):
+        if os.path.exists(p):
+            st = os.stat(p)
+            return [os.path.basename(p), st.st_size, int(st.st_mtime)]
+    return None
+
+
+def _query_fields(inventory, inv_name, inventories):
+    if inv_name in inventories:
+        return
+
+    obj = getattr(inventory, inv_name)()
+    query_object_map = dict(getattr(obj, 'QUERY_OBJECT_MAP', {}))
+    inventories[inv_name] = {
+        'primitive': list(getattr(obj, 'PRIMITIVE_FIELDS', [])),
+        'expanded': list(getattr(obj, 'EXPANDED_FIELDS', [])),
+        'query_object_map': query_object_map,
+    }
+    for name in query_object_map.values():
+        if hasattr(inventory, name):
+            _query_fields(inventory, name, inventories)
+
+
+def build():
+    import apibinding.inventory as inventory
+
+    params = {}
+    list_params = {}
+    for apiname in inventory.api_names:
+        obj = getattr(inventory, apiname)()
+        params[apiname] = [k for k in obj.__dict__.keys() if k != 'session']
+        list_params[apiname] = [k for k, v in obj.__dict__.items()
+                                if isinstance(v, (inventory.OptionalList, inventory.NotNoneList))]
+
+    query_inventories = {}
+    inventories = {}
+    for apiname, inv_class in inventory.queryMessageInventoryMap.items():
+        query_inventories[apiname] = inv_class.__name__
+        _query_fields(inventory, inv_class.__name__, inventories)
+
+    return {
+        'version': INDEX_VERSION,
+        'inventory': _inventory_stamp(),
+        'api_names': list(inventory.api_names),
+        'short_names': sorted([n[3:-3] for n in inventory.api_names if n.endswith('Msg')]),
+        'params': params,
+        'list_params': list_params,
+        'query_inventories': query_inventories,
+        'inventories': inventories,
+    }
+
+
+def _read(path):
+    try:
+        with open(path) as fd:
+            index = simplejson.load(fd)
+    except (IOError, ValueError):
+        return None
+
+    if index.get('version') != INDEX_VERSION:
+        return None
+    stamp = _inventory_stamp()
+    if stamp and index.get('inventory') != stamp:
+        return None
+    return index
+
+
+def save(index, paths=INDEX_PATHS):
+    for path in paths:
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            tmp = '%s.tmp' % path
+            with open(tmp, 'w') as fd:
+                simplejson.dump(index, fd)
+            os.rename(tmp, path)
+            return path
+        except (IOError, OSError):
+            continue
+    return None
+
+
+def load():
+    for path in INDEX_PATHS:
+        index = _read(path)
+        if index:
+            return index
+
+    index = build()
+    save(index)
+    return index
+
+
+if __name__ == '__main__':
+    # install.sh: python -m zstackcli.completion_index
+    print 'completion index saved to %s' % save(build())
@@ -0,0 +1,108 @@
+"""
+Results of the recent cli commands, shown by 'more' and saved by 'save'.
+
+Every result is a gzip file in a ring of max_entries slots. A FileDB
+indexes the slots, so appending costs one file write plus one log record
+and reading a result opens only its own file.
+
+@author: Frank
+"""
+import gzip
+import os
+import zlib
+
+import zstacklib.utils.filedb as filedb
+
+COMPRESS_LEVEL = 6
+SEQ_KEY = 'seq'
+
+
+class ResultHistoryError(Exception):
+    '''result history error'''
+
+
+class ResultHistory(object):
+    def __init__(self, folder, max_entries):
+        self.folder = folder
+        self.max_entries = max_entries
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.index = filedb.FileDB(os.path.join(folder, 'index'), is_abs_path=True)
+
+    def _slot(self, seq):
+        return seq % self.max_entries
+
+    def _result_file(self, seq):
+        return os.path.join(self.folder, 'result-%d.gz' % self._slot(seq))
+
+    def _last_seq(self):
+        return int(self.index.get(SEQ_KEY) or 0)
+
+    def count(self):
+        return min(self._last_seq(), self.max_entries)
+
+    def append(self, cmd, result, success=True):
+        seq = self._last_seq() + 1
+        if isinstance(result, unicode):
+            result = result.encode('utf-8')
+
+        result_file = self._result_file(seq)
+        tmp = '%s.tmp' % result_file
+        f = gzip.open(tmp, 'wb', COMPRESS_LEVEL)
+        try:
+            f.write(result)
+        finally:
+            f.close()
+        os.rename(tmp, result_file)
+
+        with self.index.batch():
+            # the slot of the entry max_entries ago is taken over
+            self.index.set(str(self._slot(seq)), [seq, cmd, success])
+            self.index.set(SEQ_KEY, seq)
+
+    def _entry(self, num):
+        if num < 1 or num > self.count():
+            return None, None
+
+        seq = self._last_seq() - num + 1
+        entry = self.index.get(str(self._slot(seq)))
+        if not entry or entry[0] != seq:
+            return None, None
+        return seq, entry
+
+    def get(self, num):
+        """
+        :param num: 1 is the latest result
+        :return: (cmd, success, result)
+        :raise ResultHistoryError: the result is not kept, or its file is lost or broken
+        """
+        if num < 1 or num > self.count():
+            raise ResultHistoryError('no result No.%s, the history keeps %s results' % (num, self.count()))
+
+        seq, entry = self._entry(num)
+        if not entry:
+            raise ResultHistoryError('result No.%s is missing from the history index' % num)
+
+        try:
+            f = gzip.open(self._result_file(seq), 'rb')
+            try:
+                result = f.read()
+            finally:
+                f.close()
+        except (IOError, EOFError, zlib.error) as e:
+            raise ResultHistoryError('unable to read result No.%s, %s' % (num, e))
+        return entry[1], entry[2], result
+
+    def list(self):
+        """
+        :return: [(num, cmd, success)] from the latest, without reading any result
+        """
+        entries = []
+        for num in range(1, self.count() + 1):
+            _, entry = self._entry(num)
+            if entry:
+                entries.append((num, entry[1], entry[2]))
+        return entries
+
+    def close(self):
+        self.index.close()
@@ -0,0 +1,44 @@
+'''
+
+@author: frank
+'''
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from zstacklib.utils import filedb
+
+def _workload(db, key_num):
+    for i in xrange(key_num):
+        db.set('vm-%s' % i, {'uuid': 'vm-%s' % i, 'state': 'Running', 'vnc': 5900 + i})
+    for i in xrange(0, key_num, 2):
+        db.rem('vm-%s' % i)
+    for i in xrange(key_num):
+        db.get('vm-%s' % i)
+
+def _timeit(name, db, key_num):
+    start = time.time()
+    _workload(db, key_num)
+    print '%-10s %6d keys: %.3fs' % (name, key_num, time.time() - start)
+
+def main(compare=False):
+    d = tempfile.mkdtemp()
+    try:
+        for key_num in (1000, 10000):
+            db = filedb.FileDB(os.path.join(d, 'filedb-%s' % key_num), is_abs_path=True)
+            _timeit('filedb', db, key_num)
+            db.close()
+
+            if compare:
+                # the former FileDB, rewriting the whole json file on every update
+                import pickledb
+                db = pickledb.pickledb(os.path.join(d, 'pickledb-%s' % key_num), True)
+                _timeit('pickledb', db, key_num)
+    finally:
+        shutil.rmtree(d)
+
+if __name__ == '__main__':
+    # pass --compare to time pickledb too, it takes minutes on 10k keys
+    main('--compare' in sys.argv)
@@ -0,0 +1,99 @@
+'''
+
+@author: frank
+'''
+import httplib
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from zstacklib.utils import http
+
+PORT = 17070
+
+def _slow(req):
+    time.sleep(1)
+    return 'slow'
+
+def _start(backend):
+    server = http.HttpServer(port=PORT)
+    server.backend = backend
+    server.register_sync_uri('/bench/echo', lambda req: '')
+    server.register_sync_uri('/bench/slow', _slow)
+    server.start_in_thread()
+    time.sleep(2)
+    return server
+
+def _echo(conn):
+    start = time.time()
+    conn.request('POST', '/bench/echo', '')
+    conn.getresponse().read()
+    return time.time() - start
+
+def _percentile(latencies, p):
+    latencies = sorted(latencies)
+    return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+
+def _throughput(client_num, request_num):
+    latencies = []
+
+    def client():
+        conn = httplib.HTTPConnection('127.0.0.1', PORT, timeout=60)
+        for i in xrange(request_num):
+            latencies.append(_echo(conn))
+        conn.close()
+
+    clients = [threading.Thread(target=client) for i in range(client_num)]
+    start = time.time()
+    for t in clients:
+        t.start()
+    for t in clients:
+        t.join()
+    print '  %d keep-alive clients: %.0f req/s, p50 %.2fms, p99 %.2fms' % (
+        client_num, len(latencies) / (time.time() - start), _percentile(latencies, 0.5), _percentile(latencies, 0.99))
+
+def _echo_under_load(idle_num, slow_num):
+    def slow():
+        conn = httplib.HTTPConnection('127.0.0.1', PORT, timeout=60)
+        conn.request('POST', '/bench/slow', '')
+        conn.getresponse().read()
+        conn.close()
+
+    slows = [threading.Thread(target=slow) for i in range(slow_num)]
+    for t in slows:
+        t.start()
+    idles = [socket.create_connection(('127.0.0.1', PORT)) for i in range(idle_num)]
+    time.sleep(0.2)
+
+    conn = httplib.HTTPConnection('127.0.0.1', PORT, timeout=60)
+    print '  echo with %d idle connections and %d slow calls: %.2fms' % (idle_num, slow_num, _echo(conn) * 1000)
+    conn.close()
+
+    for s in idles:
+        s.close()
+    for t in slows:
+        t.join()
+
+def run(backend):
+    print backend
+    _start(backend)
+    _throughput(8, 1000)
+    _echo_under_load(0, 20)
+    _echo_under_load(30, 0)
+
+def main():
+    # every backend runs in its own process, the cherrypy engine is global
+    for backend in (http.CHERRYPY_BACKEND, http.EVENT_LOOP_BACKEND):
+        subprocess.check_call([sys.executable, __file__, backend])
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        run(sys.argv[1])
+        # the cherrypy engine doesn't exit with the main thread
+        sys.stdout.flush()
+        os._exit(0)
+    else:
+        main()
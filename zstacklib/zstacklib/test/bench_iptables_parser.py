@@ -0,0 +1,151 @@
+'''
+
+@author: frank
+'''
+import sys
+import time
+
+from pyparsing import Literal, Word, alphas, alphanums, nums, printables, restOfLine
+
+from zstacklib.utils import iptables
+from zstacklib.utils import ipset
+
+def make_iptables_dump(rule_num, rules_per_vnic=20):
+    '''
+    a dump like the ones on hosts with dense security groups, each vnic has
+    an in and an out chain referred by sg-default
+    '''
+    vnic_num = max(rule_num / (rules_per_vnic * 2), 1)
+    vnics = ['vnic%s.0' % i for i in xrange(vnic_num)]
+
+    lst = ['# Generated by iptables-save v1.4.21 on Thu Jan  1 00:00:00 2020', '*filter',
+           ':INPUT ACCEPT [2381:1092877]', ':FORWARD ACCEPT [0:0]', ':OUTPUT ACCEPT [1964:2096376]',
+           ':sg-default - [0:0]']
+    for v in vnics:
+        lst.append(':%s-in - [0:0]' % v)
+        lst.append(':%s-out - [0:0]' % v)
+
+    lst.append('-A FORWARD -m physdev --physdev-is-bridged -j sg-default')
+    lst.append('-A sg-default -m state --state RELATED,ESTABLISHED -j ACCEPT')
+    for v in vnics:
+        lst.append('-A sg-default -m physdev --physdev-out %s --physdev-is-bridged -j %s-in' % (v, v))
+        lst.append('-A sg-default -m physdev --physdev-in %s --physdev-is-bridged -j %s-out' % (v, v))
+    lst.append('-A sg-default -j ACCEPT')
+
+    for i, v in enumerate(vnics):
+        for direction in ('in', 'out'):
+            chain = '%s-%s' % (v, direction)
+            for j in xrange(rules_per_vnic - 1):
+                lst.append('-A %s -s 10.%s.%s.0/24 -p tcp -m tcp --dport %s:%s -m state --state NEW -j RETURN' %
+                           (chain, i % 256, j % 256, 1000 + j, 2000 + j))
+            lst.append('-A %s -m set --match-set %s-%s src -j RETURN' % (chain, v, direction))
+            lst.append('-A %s -j REJECT --reject-with icmp-host-prohibited' % chain)
+
+    lst.append('COMMIT')
+    lst.append('# Completed on Thu Jan  1 00:00:00 2020')
+    lst.append('*nat')
+    lst.append(':PREROUTING ACCEPT [0:0]')
+    lst.append(':POSTROUTING ACCEPT [0:0]')
+    lst.append('-A POSTROUTING -s 192.168.122.0/24 ! -d 192.168.122.0/24 -j MASQUERADE')
+    lst.append('COMMIT')
+    lst.append('')
+    return '\n'.join(lst)
+
+def make_ipset_dump(entry_num, entries_per_set=100):
+    lst = []
+    for i in xrange(max(entry_num / entries_per_set, 1)):
+        name = 'vnic%s.0-in' % i
+        lst.append('create %s hash:net family inet hashsize 1024 maxelem 65536' % name)
+        for j in xrange(entries_per_set):
+            lst.append('add %s 10.%s.%s.0/24' % (name, i % 256, j % 256))
+    return '\n'.join(lst)
+
+def parse_iptables_save_by_pyparsing(ipt, txt):
+    '''
+    the former parser of IPTables/IP6Tables, too slow for big rule sets. Kept to check the
+    parity of _from_iptables_save
+    '''
+    def parse_table(tokens):
+        ipt._create_table_if_not_exists(tokens[1])
+
+    def parse_commit(tokens):
+        ipt._current_table = None
+
+    def parse_counter(tokens):
+        lst = [':%s' % tokens[1]]
+        lst.extend(tokens[2:])
+        ipt._create_chain_if_not_exists(tokens[1], ' '.join(lst))
+
+    def parse_rule(tokens):
+        ipt._add_rule(tokens[1], ' '.join(tokens))
+
+    table = Literal('*') + Word(alphas)
+    table.setParseAction(parse_table)
+    chain_name = Word(printables + '.-_+=%$#')
+    counter = Literal(':') + chain_name + restOfLine
+    counter.setParseAction(parse_counter)
+    comment = Literal('#') + restOfLine
+    rule = Literal('-A') + chain_name + restOfLine
+    rule.setParseAction(parse_rule)
+    commit = Literal('COMMIT')
+    commit.setParseAction(parse_commit)
+    parser = table | counter | comment | rule | commit
+
+    ipt._reset()
+    for l in txt.split('\n'):
+        l = l.strip('\n').strip('\r').strip('\t').strip()
+        if not l:
+            continue
+        parser.parseString(l)
+
+def parse_ipset_save_by_pyparsing(mgr, txt):
+    '''
+    the former parser of IPSetManager, too slow for big sets. Kept to check the parity of
+    _from_ipset_save
+    '''
+    def parse_set(tokens):
+        mgr.create_set(name=tokens[1], set_type='%s:%s' % (tokens[2], tokens[4]), ip_version=tokens[6])
+
+    def parse_entry(tokens):
+        if tokens[1] not in mgr.sets.keys():
+            mgr.create_set(name=tokens[1])
+        mgr.sets[tokens[1]].add_match_ip(tokens[2])
+
+    set_name = Word(printables)
+    set_type = Word(alphas) + Word(':') + Word(alphas + ',')
+    sets = Literal('create') + set_name + set_type + Literal('family') + Word(alphanums) + restOfLine
+    sets.setParseAction(parse_set)
+    entry = Literal('add') + set_name + Word(nums + './')
+    entry.setParseAction(parse_entry)
+    parser = sets | entry
+
+    mgr.reset()
+    for l in txt.splitlines():
+        l = l.strip('\n').strip('\r').strip('\t').strip()
+        if not l:
+            continue
+        parser.parseString(l)
+
+def _timeit(func, txt):
+    start = time.time()
+    func(txt)
+    return time.time() - start
+
+def main(compare=False):
+    for num in (10000, 50000, 100000):
+        txt = make_iptables_dump(num)
+        line_num = len(txt.splitlines())
+        ipt = iptables.IPTables()
+        print 'iptables-save %6d lines: %.3fs' % (line_num, _timeit(ipt._from_iptables_save, txt))
+        if compare:
+            print '  pyparsing: %.3fs' % _timeit(lambda t: parse_iptables_save_by_pyparsing(ipt, t), txt)
+
+        txt = make_ipset_dump(num)
+        mgr = ipset.IPSetManager()
+        print 'ipset save %6d lines: %.3fs' % (num, _timeit(mgr._from_ipset_save, txt))
+        if compare:
+            print '  pyparsing: %.3fs' % _timeit(lambda t: parse_ipset_save_by_pyparsing(mgr, t), txt)
+
+if __name__ == '__main__':
+    # pass --compare to time the former pyparsing parsers too, it takes minutes on big dumps
+    main('--compare' in sys.argv)
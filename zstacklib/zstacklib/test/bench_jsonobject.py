@@ -0,0 +1,65 @@
+'''
+
+@author: frank
+'''
+import time
+
+import simplejson
+
+from zstacklib.utils import jsonobject
+
+def _security_group_rules(vm_num):
+    # RefreshAllRulesOnHostCmd
+    rule_tos = []
+    for i in xrange(vm_num):
+        rules = [{'type': 'Ingress', 'protocol': 'TCP', 'startPort': 22 + j, 'endPort': 22 + j,
+                  'allowedCidr': '10.%d.%d.0/24' % (i % 255, j), 'ipVersion': 4, 'priority': j,
+                  'securityGroupUuid': 'sg-%032d' % j} for j in xrange(10)]
+        rule_tos.append({'vmNicUuid': 'nic-%032d' % i, 'vmNicInternalName': 'vnet%d' % i,
+                         'vmNicMac': 'fa:16:3e:%02x:%02x:%02x' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                         'vmNicIp': '10.0.%d.%d' % (i >> 8 & 255, i & 255), 'actionCode': 'applyRuleOnHost',
+                         'rules': rules, 'ipv6Rules': []})
+    return {'ruleTOs': rule_tos, 'ipv6RuleTOs': []}
+
+def _dhcp_entries(entry_num):
+    # apply_dhcp of mevoco
+    return {'rebuild': True, 'dhcp': [
+        {'ip': '10.0.%d.%d' % (i >> 8 & 255, i & 255), 'mac': 'fa:16:3e:00:%02x:%02x' % (i >> 8 & 255, i & 255),
+         'netmask': '255.255.0.0', 'gateway': '10.0.0.1', 'hostname': 'vm-%d' % i, 'dns': ['8.8.8.8', '114.114.114.114'],
+         'dnsDomain': 'zstack.org', 'bridgeName': 'br_eth0', 'namespaceName': 'br_eth0_l3', 'l3NetworkUuid': 'l3-%d' % (i % 4),
+         'isDefaultL3Network': True, 'mtu': 1500, 'vmMultiGateway': False} for i in xrange(entry_num)]}
+
+def _vm_states(vm_num):
+    # VmSyncResponse
+    return {'success': True, 'states': dict(('vm-%032d' % i, 'Running') for i in xrange(vm_num)),
+            'vmInShutdowns': ['vm-%032d' % i for i in xrange(0, vm_num, 50)]}
+
+PAYLOADS = [
+    ('security group rules, 1000 nics', _security_group_rules(1000)),
+    ('dhcp, 5000 entries', _dhcp_entries(5000)),
+    ('vm sync, 5000 vms', _vm_states(5000)),
+]
+
+def _former_loads(jstr):
+    # decoding to dicts then walking them into JsonObjects, as loads() did before
+    return jsonobject._parse_dict(simplejson.loads(jstr))
+
+def _timeit(func, arg, times=10):
+    start = time.time()
+    for i in xrange(times):
+        func(arg)
+    return (time.time() - start) / times * 1000
+
+def main():
+    print '%-36s %9s %9s %9s %9s' % ('payload', 'loads', 'former', 'walk', 'encoding')
+    for name, payload in PAYLOADS:
+        jstr = simplejson.dumps(payload)
+        obj = jsonobject.loads(jstr)
+        jsonmap = jsonobject._dump(obj)
+        print '%-36s %7.1fms %7.1fms %7.1fms %7.1fms' % (
+            name, _timeit(jsonobject.loads, jstr), _timeit(_former_loads, jstr), _timeit(jsonobject._dump, obj),
+            _timeit(lambda m: simplejson.dumps(m, ensure_ascii=True), jsonmap))
+
+if __name__ == '__main__':
+    # dumps() is the walk plus encoding
+    main()
@@ -0,0 +1,114 @@
+'''
+
+@author: frank
+'''
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import os
+import shutil
+import simplejson
+import tempfile
+import threading
+import unittest
+from ..utils import downloader
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # the probe closes the connection without reading the whole body
+        pass
+
+class _RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    data = ''
+    support_range = True
+    requests = []
+
+    def do_GET(self):
+        rng = self.headers.getheader('Range')
+        _RangeHandler.requests.append(rng)
+        if not rng or not self.support_range:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(self.data)))
+            self.end_headers()
+            self.wfile.write(self.data)
+            return
+
+        start, end = rng[len('bytes='):].split('-')
+        start, end = int(start), min(int(end), len(self.data) - 1)
+        self.send_response(206)
+        self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, len(self.data)))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', '"%s"' % hashlib.md5(self.data).hexdigest())
+        self.end_headers()
+        self.wfile.write(self.data[start:end + 1])
+
+    def log_message(self, *args):
+        pass
+
+class TestDownloader(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dst = os.path.join(self.dir, 'image')
+        self.old_min_segment_size = downloader.MIN_SEGMENT_SIZE
+        downloader.MIN_SEGMENT_SIZE = 1024 * 1024
+        _RangeHandler.data = os.urandom(downloader.MIN_SEGMENT_SIZE * 5 + 12345)
+        _RangeHandler.support_range = True
+        _RangeHandler.requests = []
+        self.server = _Server(('127.0.0.1', 0), _RangeHandler)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.url = 'http://127.0.0.1:%s/image' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        downloader.MIN_SEGMENT_SIZE = self.old_min_segment_size
+        shutil.rmtree(self.dir)
+
+    def _read(self):
+        with open(self.dst, 'rb') as f:
+            return f.read()
+
+    def test_download(self):
+        percents = []
+        md5 = downloader.download(self.url, self.dst, callback=lambda p, u: percents.append(p))
+        self.assertEqual(hashlib.md5(_RangeHandler.data).hexdigest(), md5)
+        self.assertEqual(_RangeHandler.data, self._read())
+        self.assertEqual(100, percents[-1])
+        self.assertFalse(os.path.exists(self.dst + downloader.CHECKPOINT_SUFFIX))
+
+    def test_resume(self):
+        d = downloader.SegmentedDownloader(self.url, self.dst)
+        self.assertTrue(d.probe())
+        d._prepare()
+        # pretend the first half of every segment was written before an interruption
+        with open(self.dst, 'r+b') as f:
+            for seg in d.segments:
+                seg.done = seg.size() / 2
+                f.seek(seg.start)
+                f.write(_RangeHandler.data[seg.start:seg.start + seg.done])
+        d._save_checkpoint()
+        segments = [(s.start, s.done) for s in d.segments]
+
+        _RangeHandler.requests = []
+        md5 = downloader.download(self.url, self.dst)
+        self.assertEqual(hashlib.md5(_RangeHandler.data).hexdigest(), md5)
+        self.assertEqual(_RangeHandler.data, self._read())
+        for start, done in segments:
+            self.assertIn('bytes=%s-' % (start + done), ''.join(_RangeHandler.requests))
+
+    def test_stale_checkpoint(self):
+        with open(self.dst + downloader.CHECKPOINT_SUFFIX, 'w') as f:
+            simplejson.dump({'url': self.url, 'size': 1, 'validator': None, 'segments': [[0, 1, 1]]}, f)
+        md5 = downloader.download(self.url, self.dst)
+        self.assertEqual(hashlib.md5(_RangeHandler.data).hexdigest(), md5)
+
+    def test_no_range_support(self):
+        _RangeHandler.support_range = False
+        self.assertIsNone(downloader.download(self.url, self.dst))
+        self.assertFalse(os.path.exists(self.dst))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,147 @@
+'''
+
+@author: frank
+'''
+import httplib
+import socket
+import threading
+import time
+import unittest
+from ..utils import evhttp
+from ..utils import http
+
+class TestEventLoopHttpServer(unittest.TestCase):
+    def setUp(self):
+        self.posts = []
+        self.json_post = http.json_post
+        http.json_post = lambda uri, body, headers: self.posts.append((uri, body, headers))
+
+        self.server = http.HttpServer(port=0)
+        self.server.backend = http.EVENT_LOOP_BACKEND
+        self.server.register_sync_uri('/test/echo', lambda req: '')
+        self.server.register_sync_uri('/test/same/', lambda req: req[http.REQUEST_BODY])
+        self.server.register_sync_uri('/test/header', lambda req: req[http.REQUEST_HEADER]['X-Test'])
+        self.server.register_sync_uri('/test/slow', self._slow)
+        self.server.register_async_uri('/test/async', lambda req: req[http.REQUEST_BODY],
+                                       callback_uri='http://127.0.0.1:1/callback')
+        self.server.start_in_thread()
+        for i in range(100):
+            if self.server.server and self.server.server.running:
+                break
+            time.sleep(0.05)
+        self.port = self.server.server.port
+
+    def tearDown(self):
+        self.server.stop()
+        http.json_post = self.json_post
+
+    def _slow(self, req):
+        time.sleep(0.5)
+        return 'slow'
+
+    def _request(self, conn, uri, body='', headers={}):
+        conn.request('POST', uri, body, headers)
+        rsp = conn.getresponse()
+        return rsp.status, rsp.read()
+
+    def test_sync_uri(self):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        self.assertEqual((200, 'hello'), self._request(conn, '/test/same', 'hello'))
+        # trailing slash and keep-alive on the same connection
+        self.assertEqual((200, 'again'), self._request(conn, '/test/same/', 'again'))
+        self.assertEqual((200, 'value'), self._request(conn, '/test/header', headers={'x-test': 'value'}))
+        self.assertEqual(404, self._request(conn, '/test/none')[0])
+        status, body = self._request(conn, '/test/same', headers={http.TASK_UUID: 'uuid'})
+        self.assertEqual(500, status)
+        self.assertIn('wrongly register sync uri', body)
+        conn.close()
+
+        self.assertTrue(self.server.sync_uri_handlers['/test/echo'].inline)
+        self.assertFalse(self.server.sync_uri_handlers['/test/slow'].inline)
+        stats = self.server.get_uri_stats()['/test/same/']
+        self.assertEqual(3, stats['handler_time']['count'])
+        self.assertEqual(1, stats['errors'])
+
+    def test_async_uri(self):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        self.assertEqual((200, ''), self._request(conn, '/test/async', 'hello', {http.TASK_UUID: 'uuid'}))
+        self.assertEqual(400, self._request(conn, '/test/async', 'hello')[0])
+        conn.close()
+
+        for i in range(100):
+            if self.posts:
+                break
+            time.sleep(0.05)
+        self.assertEqual([('http://127.0.0.1:1/callback', 'hello', {http.TASK_UUID: 'uuid'})], self.posts)
+
+    def test_echo_not_blocked(self):
+        def slow():
+            conn = httplib.HTTPConnection('127.0.0.1', self.port)
+            self._request(conn, '/test/slow')
+            conn.close()
+
+        slows = [threading.Thread(target=slow) for i in range(20)]
+        for t in slows:
+            t.start()
+        # idle keep-alive connections take no worker
+        idles = [socket.create_connection(('127.0.0.1', self.port)) for i in range(50)]
+
+        time.sleep(0.1)
+        start = time.time()
+        conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        self.assertEqual((200, ''), self._request(conn, '/test/echo'))
+        self.assertLess(time.time() - start, 0.3)
+        conn.close()
+
+        for t in slows:
+            t.join()
+        for s in idles:
+            s.close()
+
+    def test_pipelined_requests(self):
+        s = socket.create_connection(('127.0.0.1', self.port))
+        req = 'POST /test/same HTTP/1.1\r\nHost: x\r\nContent-Length: %d\r\n\r\n%s'
+        s.sendall(req % (1, 'a') + req % (2, 'bc'))
+        data = ''
+        while data.count('HTTP/1.1 200') < 2 or not data.endswith('bc'):
+            data += s.recv(4096)
+        self.assertLess(data.index('\r\n\r\na'), data.index('\r\n\r\nbc'))
+        s.close()
+
+    def test_many_pipelined_requests(self):
+        s = socket.create_connection(('127.0.0.1', self.port), timeout=30)
+        num = 2000
+        s.sendall('POST /test/echo HTTP/1.1\r\nHost: x\r\nContent-Length: 0\r\n\r\n' * num)
+        data = ''
+        while data.count('HTTP/1.1 200') < num:
+            r = s.recv(65536)
+            self.assertTrue(r)
+            data += r
+        s.close()
+
+        conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        self.assertEqual((200, 'alive'), self._request(conn, '/test/same', 'alive'))
+        conn.close()
+
+    def test_invalid_content_length(self):
+        for length, status in (('-1', 400), ('x', 400), (str(evhttp.MAX_BODY_SIZE + 1), 413)):
+            s = socket.create_connection(('127.0.0.1', self.port))
+            s.sendall('POST /test/same HTTP/1.1\r\nHost: x\r\nContent-Length: %s\r\n\r\n' % length)
+            data = ''
+            while True:
+                r = s.recv(4096)
+                if not r:
+                    break
+                data += r
+            s.close()
+            self.assertTrue(data.startswith('HTTP/1.1 %d' % status), data)
+
+    def test_header_map(self):
+        headers = evhttp.HeaderMap()
+        headers['Content-Length'] = '1'
+        self.assertEqual('1', headers['content-length'])
+        self.assertTrue(headers.has_key('CONTENT-LENGTH'))
+        self.assertIsNone(headers.get('Host'))
+
+if __name__ == "__main__":
+    unittest.main()
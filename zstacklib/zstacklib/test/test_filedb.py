@@ -0,0 +1,81 @@
+'''
+
+@author: frank
+'''
+import os
+import shutil
+import simplejson
+import tempfile
+import unittest
+from ..utils import filedb
+
+class TestFileDB(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _open(self):
+        return filedb.FileDB(self.path, is_abs_path=True)
+
+    def test_reopen(self):
+        db = self._open()
+        db.set('a', 1)
+        db.set('b', [1, 'x'])
+        db.set('a', 2)
+        db.rem('b')
+        self.assertIsNone(db.get('b'))
+        self.assertRaises(KeyError, db.rem, 'b')
+        db.close()
+
+        db = self._open()
+        self.assertEqual({'a': 2}, db.get_all())
+        db.close()
+
+    def test_compact(self):
+        old = filedb.COMPACT_MIN_RECORDS
+        filedb.COMPACT_MIN_RECORDS = 10
+        try:
+            db = self._open()
+            for i in range(25):
+                db.set(str(i % 5), i)
+            self.assertLessEqual(db.log_records, 10)
+            db.close()
+        finally:
+            filedb.COMPACT_MIN_RECORDS = old
+
+        # compacted after the 11th and the 22nd update
+        with open(self.path) as fd:
+            self.assertEqual(dict([(str(i % 5), i) for i in range(17, 22)]), simplejson.load(fd))
+        self.assertEqual(dict([(str(i % 5), i) for i in range(20, 25)]), self._open().get_all())
+
+    def test_torn_commit(self):
+        db = self._open()
+        db.set('a', 1)
+        with db.batch():
+            db.set('b', 2)
+            db.set('c', 3)
+        db.close()
+
+        with open(self.path + filedb.LOG_SUFFIX, 'ab') as fd:
+            fd.write('["s", "d", ')
+
+        db = self._open()
+        self.assertEqual({'a': 1, 'b': 2, 'c': 3}, db.get_all())
+        db.set('d', 4)
+        db.close()
+        self.assertEqual({'a': 1, 'b': 2, 'c': 3, 'd': 4}, self._open().get_all())
+
+    def test_pickledb_file(self):
+        with open(self.path, 'w') as fd:
+            simplejson.dump({'a': 1}, fd)
+        db = self._open()
+        self.assertEqual(1, db.get('a'))
+        db.set('b', 2)
+        db.close()
+        self.assertEqual({'a': 1, 'b': 2}, self._open().get_all())
+
+if __name__ == "__main__":
+    unittest.main()
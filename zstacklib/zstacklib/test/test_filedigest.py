@@ -0,0 +1,51 @@
+'''
+
+@author: frank
+'''
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+from ..utils import filedigest
+
+class TestFileDigest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.files = []
+        for i, size in enumerate([0, 1, filedigest.CHUNK_SIZE, filedigest.CHUNK_SIZE * 2 + 4097]):
+            path = os.path.join(self.dir, str(i))
+            with open(path, 'wb') as f:
+                f.write(os.urandom(size))
+            self.files.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_hash_files(self):
+        progress = filedigest.Progress(sum([os.path.getsize(p) for p in self.files]))
+        digests = filedigest.hash_files(self.files, progress=progress, workers=3)
+        self.assertEqual([hashlib.md5(self._read(p)).hexdigest() for p in self.files], digests)
+        self.assertEqual(100, progress.percent())
+        self.assertEqual(progress.total, progress.done)
+
+    def test_direct_io(self):
+        self.assertEqual(hashlib.sha1(self._read(self.files[-1])).hexdigest(),
+                         filedigest.hash_file(self.files[-1], filedigest.SHA1, direct=True))
+
+    def test_checksums(self):
+        data = self._read(self.files[-1])
+        self.assertEqual('%08x' % (zlib.adler32(data) & 0xffffffff),
+                         filedigest.hash_file(self.files[-1], filedigest.ADLER32))
+        self.assertRaises(ValueError, filedigest.hash_files, self.files, 'md4')
+
+    def test_missing_file(self):
+        self.assertRaises(OSError, filedigest.hash_files, self.files + [os.path.join(self.dir, 'none')])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+'''
+
+@author: frank
+'''
+import simplejson
+import time
+import unittest
+import urllib3
+from ..utils import histogram
+from ..utils import http
+
+class TestHttpStats(unittest.TestCase):
+    def setUp(self):
+        self.posts = []
+        self.json_post = http.json_post
+        http.json_post = lambda uri, body, headers: self.posts.append((uri, body, headers))
+
+    def tearDown(self):
+        http.json_post = self.json_post
+
+    def _request(self, body):
+        req = http.Request()
+        req.headers = {http.CALLBACK_URI: 'http://127.0.0.1:8080/callback'}
+        req.body = body
+        return req
+
+    def test_histogram(self):
+        h = histogram.Histogram((0.1, 1, float('inf')))
+        for v in (0.05, 0.5, 0.7, 10):
+            h.observe(v)
+        stats = h.get_stats()
+        self.assertEqual([('0.1', 1), ('1', 3), ('+Inf', 4)], stats['buckets'])
+        self.assertEqual(4, stats['count'])
+        self.assertEqual(10, stats['max'])
+
+    def test_async_uri_stats(self):
+        def handler(req):
+            if req[http.REQUEST_BODY] == 'fail':
+                raise Exception('on purpose')
+            return req[http.REQUEST_BODY]
+
+        server = http.HttpServer(port=0)
+        server.register_async_uri('/test/async', handler)
+        uri_obj = server.async_uri_handlers['/test/async']
+        controller = uri_obj.controller
+
+        for body in ('ok', 'fail'):
+            uri_obj.stats.enter()
+            controller.HANDLER_COUNTER.inc()
+            controller._run_index('uuid-%s' % body, self._request(body), time.time() - 0.5)
+
+        self.assertEqual(2, len(self.posts))
+        self.assertIn(http.ERROR_CODE, self.posts[1][2])
+
+        stats = server.get_uri_stats()['/test/async']
+        self.assertEqual(0, stats['in_flight'])
+        self.assertEqual(1, stats['errors'])
+        self.assertEqual(2, stats['queue_time']['count'])
+        self.assertGreaterEqual(stats['queue_time']['sum'], 1.0)
+        self.assertEqual(2, stats['handler_time']['count'])
+        self.assertEqual(2, stats['callback_time']['count'])
+
+    def test_debug_stats(self):
+        server = http.HttpServer(port=0)
+        server.register_sync_uri('/test/sync', lambda req: 'ok')
+        stats = simplejson.loads(server._get_debug_stats(None))
+        self.assertIn(http.DEBUG_STATS_PATH, stats['uris'])
+        self.assertEqual(0, stats['uris']['/test/sync']['handler_time']['count'])
+        self.assertIn(http.DEFAULT_ASYNC_POOL, stats['async_pools'])
+
+    def _retry_sleeps(self, fail_soon):
+        retries = http._post_retries(fail_soon)
+        sleeps = []
+        while True:
+            try:
+                retries = retries.increment('POST', '/', error=urllib3.exceptions.ConnectTimeoutError())
+            except urllib3.exceptions.MaxRetryError:
+                return sleeps
+            sleeps.append(retries.get_backoff_time())
+
+    def test_post_retry_backoff(self):
+        sleeps = self._retry_sleeps(False)
+        self.assertEqual(http.POST_RETRIES, len(sleeps))
+        # one attempt ends well before wait_callback_success() gives up after 60 seconds
+        self.assertLess(sum(sleeps), 5)
+        self.assertEqual([0] * http.POST_RETRIES, self._retry_sleeps(True))
+
+if __name__ == "__main__":
+    unittest.main()
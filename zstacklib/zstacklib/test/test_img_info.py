@@ -0,0 +1,107 @@
+'''
+
+@author: frank
+'''
+import os
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+from ..utils import linux
+
+def _write_qcow2(path, size, backing_file=None, backing_format=None, version=3, cluster_bits=16):
+    header_length = 104 if version >= 3 else 72
+    exts = ''
+    if backing_format:
+        padded = backing_format + '\0' * ((8 - len(backing_format) % 8) % 8)
+        exts += struct.pack('>II', linux.QCOW2_EXT_BACKING_FORMAT, len(backing_format)) + padded
+    exts += struct.pack('>II', linux.QCOW2_EXT_END, 0)
+
+    backing_offset = header_length + len(exts) if backing_file else 0
+    header = struct.pack('>4sIQIIQIIQQIIQ', linux.QCOW2_MAGIC, version, backing_offset,
+                         len(backing_file or ''), cluster_bits, size, 0, 0, 0, 0, 0, 0, 0)
+    if version >= 3:
+        header += struct.pack('>QQQII', 0, 0, 0, 4, header_length)
+
+    with open(path, 'wb') as f:
+        f.write(header + exts + (backing_file or ''))
+        f.write('\0' * (1 << cluster_bits))
+
+class TestImgInfo(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        linux._img_info_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_qcow2_chain(self):
+        base = os.path.join(self.dir, 'base.qcow2')
+        mid = os.path.join(self.dir, 'mid.qcow2')
+        top = os.path.join(self.dir, 'top.qcow2')
+        _write_qcow2(base, 10 << 30, version=2, cluster_bits=20)
+        _write_qcow2(mid, 10 << 30, backing_file=base, backing_format='qcow2')
+        # relative to the directory of the image, like qemu does
+        _write_qcow2(top, 20 << 30, backing_file='mid.qcow2')
+
+        info = linux.read_img_info(mid)
+        self.assertEqual('qcow2', info.format)
+        self.assertEqual(10 << 30, info.virtual_size)
+        self.assertEqual(1 << 16, info.cluster_size)
+        self.assertEqual(base, info.backing_file)
+        self.assertEqual('qcow2', info.backing_format)
+        self.assertEqual(1 << 20, linux.read_img_info(base).cluster_size)
+
+        self.assertEqual([top, mid, base], linux.qcow2_get_file_chain(top))
+        self.assertEqual(20 << 30, linux.qcow2_virtualsize(top))
+        self.assertEqual('qcow2', linux.get_img_fmt(top))
+
+    def test_raw_and_iso(self):
+        raw = os.path.join(self.dir, 'raw')
+        with open(raw, 'wb') as f:
+            f.write('\0' * 65536)
+        self.assertEqual('raw', linux.get_img_file_fmt(raw))
+        self.assertEqual(65536, linux.qcow2_virtualsize(raw))
+
+        iso = os.path.join(self.dir, 'iso')
+        with open(iso, 'wb') as f:
+            f.write('\0' * linux.ISO_MAGIC_OFFSET + linux.ISO_MAGIC + '\0' * 2048)
+        self.assertEqual('iso', linux.get_img_file_fmt(iso))
+
+        mbr = os.path.join(self.dir, 'mbr')
+        with open(mbr, 'wb') as f:
+            f.write('\xeb\x63\x90' + '\1' * 507 + linux.MBR_SIGNATURE + '\0' * 65536)
+        self.assertEqual('raw', linux.get_img_fmt(mbr))
+
+    def test_other_formats_are_left_to_qemu_img(self):
+        def write(name, content):
+            path = os.path.join(self.dir, name)
+            with open(path, 'wb') as f:
+                f.write(content)
+            return path
+
+        self.assertEqual(None, linux.read_img_info(write('vmdk', 'KDMV' + '\0' * 512)))
+        self.assertEqual(None, linux.read_img_info(os.path.join(self.dir, 'not-exist')))
+        vdi = '<<< Oracle VM VirtualBox Disk Image >>>\n'
+        self.assertEqual(None, linux.read_img_info(write('vdi', vdi + '\0' * (1024 - len(vdi)))))
+
+        qcow1 = os.path.join(self.dir, 'qcow1')
+        _write_qcow2(qcow1, 1 << 30, version=1)
+        self.assertEqual(None, linux.read_img_info(qcow1))
+        self.assertEqual(None, linux.read_img_info(write('short', linux.QCOW2_MAGIC + '\0\0\0\3')))
+
+    def test_cache(self):
+        path = os.path.join(self.dir, 'a.qcow2')
+        _write_qcow2(path, 1 << 30)
+        info = linux.read_img_info(path)
+        self.assertTrue(info is linux.read_img_info(path))
+        self.assertEqual(1, linux.get_img_info_cache_stats()['hits'])
+
+        # rewritten images are parsed again
+        _write_qcow2(path, 2 << 30)
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        self.assertEqual(2 << 30, linux.read_img_info(path).virtual_size)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+'''
+
+@author: frank
+'''
+import unittest
+from ..utils import ipset
+
+def _make_set(match_ip, nomatch_ip=None):
+    s = ipset.IPSet('zstack-sg-0123456789abcdefghi', ipset.IPSetManager.HASH_NET, 'inet')
+    s.match_ip = match_ip
+    s.nomatch_ip = nomatch_ip or []
+    return s
+
+class TestIPSetRefresh(unittest.TestCase):
+    def test_first_refresh_swaps_in(self):
+        cmds, view = ipset._make_refresh_cmd_list(_make_set(['10.0.0.1', '10.0.0.2']), None)
+        self.assertEqual('create zstack-sg-0123456789abcdefghi-t hash:net family inet --exist', cmds[0])
+        self.assertIn('swap zstack-sg-0123456789abcdefghi-t zstack-sg-0123456789abcdefghi', cmds)
+        self.assertEqual('destroy zstack-sg-0123456789abcdefghi-t', cmds[-1])
+        self.assertEqual(frozenset(['10.0.0.1', '10.0.0.2']), view.match_ip)
+
+    def test_delta(self):
+        ips = ['10.0.0.%s' % i for i in range(10)]
+        _, view = ipset._make_refresh_cmd_list(_make_set(ips), None)
+
+        cmds, new_view = ipset._make_refresh_cmd_list(_make_set(ips), view)
+        self.assertEqual([], cmds)
+        self.assertTrue(new_view is view)
+
+        cmds, new_view = ipset._make_refresh_cmd_list(_make_set(ips[1:] + ['10.0.1.1'], ['10.0.0.0']), view)
+        self.assertEqual(['del zstack-sg-0123456789abcdefghi 10.0.0.0',
+                          'add zstack-sg-0123456789abcdefghi 10.0.1.1',
+                          'add zstack-sg-0123456789abcdefghi 10.0.0.0 nomatch'], cmds)
+        self.assertEqual(view.created, new_view.created)
+
+    def test_mostly_replaced_set_is_swapped(self):
+        _, view = ipset._make_refresh_cmd_list(_make_set(['10.0.0.1', '10.0.0.2']), None)
+        cmds, _ = ipset._make_refresh_cmd_list(_make_set(['10.0.1.1', '10.0.1.2']), view)
+        self.assertTrue([c for c in cmds if c.startswith('swap ')])
+
+    def test_expired_view_is_swapped(self):
+        _, view = ipset._make_refresh_cmd_list(_make_set(['10.0.0.1']), None)
+        view.created -= ipset.SET_VIEW_TTL + 1
+        cmds, _ = ipset._make_refresh_cmd_list(_make_set(['10.0.0.1']), view)
+        self.assertTrue([c for c in cmds if c.startswith('swap ')])
+
+    def test_stale_view_falls_back_to_swap(self):
+        restored = []
+
+        def restore_cmds(namespace, cmds):
+            restored.append(cmds)
+            # the delta fails as 10.0.0.10 was deleted behind us
+            return 'Element cannot be deleted' if len(restored) == 1 else None
+
+        mgr = ipset.IPSetManager()
+        mgr.sets['zstack-sg-0123456789abcdefghi'] = _make_set(['10.0.0.%s' % i for i in range(10)])
+        key = (None, 'zstack-sg-0123456789abcdefghi')
+        ipset._set_views[key] = ipset.SetView(_make_set(['10.0.0.%s' % i for i in range(11)]))
+        restore = ipset._restore_cmds
+        ipset._restore_cmds = restore_cmds
+        try:
+            ipset.refresh_ipsets([mgr])
+            self.assertEqual(['del zstack-sg-0123456789abcdefghi 10.0.0.10'], restored[0])
+            self.assertTrue([c for c in restored[1] if c.startswith('swap ')])
+            self.assertEqual(10, ipset._set_views[key].size())
+
+            # no cached view to blame, the failure is raised
+            ipset._set_views.clear()
+            del restored[:]
+            self.assertRaises(ipset.IPSetError, ipset.refresh_ipsets, [mgr])
+            self.assertEqual(1, len(restored))
+            self.assertFalse(key in ipset._set_views)
+        finally:
+            ipset._restore_cmds = restore
+            ipset._set_views.clear()
+
+if __name__ == "__main__":
+    unittest.main()
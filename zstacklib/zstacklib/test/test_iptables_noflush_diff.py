@@ -0,0 +1,140 @@
+'''
+
+@author: frank
+'''
+import unittest
+from ..utils import iptables
+
+DUMP = '''# Generated by iptables-save v1.4.21 on Thu Jan  1 00:00:00 2020
+*filter
+:INPUT ACCEPT [10:100]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [5:50]
+:sg-default - [0:0]
+:vnic1.0-in - [0:0]
+:vnic1.0-out - [0:0]
+:vnic2.0-in - [0:0]
+:vnic2.0-out - [0:0]
+-A FORWARD -m physdev --physdev-is-bridged -j sg-default
+-A sg-default -m state --state RELATED,ESTABLISHED -j ACCEPT
+-A sg-default -m physdev --physdev-out vnic1.0 --physdev-is-bridged -j vnic1.0-in
+-A sg-default -m physdev --physdev-in vnic1.0 --physdev-is-bridged -j vnic1.0-out
+-A sg-default -m physdev --physdev-out vnic2.0 --physdev-is-bridged -j vnic2.0-in
+-A sg-default -m physdev --physdev-in vnic2.0 --physdev-is-bridged -j vnic2.0-out
+-A sg-default -j ACCEPT
+-A vnic1.0-in -p tcp -m tcp --dport 22:22 -m state --state NEW -s 10.0.0.0/8 -j RETURN
+-A vnic1.0-in -j REJECT --reject-with icmp-host-prohibited
+-A vnic1.0-out -j RETURN
+-A vnic2.0-in -j ACCEPT
+-A vnic2.0-out -j RETURN
+COMMIT
+'''
+
+
+def apply_diff(snapshot, lines):
+    # a tiny model of iptables-restore --noflush, enough to check the diff
+    tables = dict([(t, dict([(c[0], list(c[2])) for c in chains])) for t, chains in snapshot])
+    chains = None
+    for l in lines:
+        if l.startswith('*'):
+            chains = tables.setdefault(l[1:], {})
+        elif l.startswith(':'):
+            name = l[1:].split()[0]
+            if name not in iptables.BUILTIN_CHAIN_NAMES:
+                chains[name] = []
+        elif l == 'COMMIT':
+            chains = None
+        else:
+            op, name, rest = (l.split(' ', 2) + [''])[:3]
+            if op == '-A':
+                chains[name].append(l)
+            elif op == '-F':
+                chains[name] = []
+            elif op == '-X':
+                assert not chains[name]
+                del chains[name]
+            elif op == '-D' and rest.isdigit():
+                del chains[name][int(rest) - 1]
+            elif op == '-D':
+                chains[name].remove('-A %s %s' % (name, rest))
+            elif op == '-I':
+                pos, spec = rest.split(' ', 1)
+                chains[name].insert(int(pos) - 1, '-A %s %s' % (name, spec))
+    return tables
+
+
+class TestNoflushDiff(unittest.TestCase):
+    def _parse(self, dump=DUMP):
+        ipt = iptables.IPTables()
+        ipt._from_iptables_save(dump)
+        return ipt
+
+    def _check(self, ipt):
+        ipt._to_iptables_string()
+        new = iptables._take_snapshot(ipt)
+        lines = iptables.make_noflush_diff(ipt._snapshot, new)
+        expected = dict([(t, dict([(c[0], c[2]) for c in chains])) for t, chains in new])
+        self.assertEqual(expected, apply_diff(ipt._snapshot, lines))
+        return lines
+
+    def test_no_change(self):
+        ipt = self._parse()
+        self.assertEqual([], self._check(ipt))
+
+    def test_add_and_delete_chain(self):
+        ipt = self._parse()
+        ipt.delete_chain('vnic2.0-in')
+        ipt.delete_chain('vnic2.0-out')
+        ipt.remove_rule('-A sg-default -j ACCEPT')
+        ipt.add_rule('-A sg-default -m physdev --physdev-out vnic3.0 --physdev-is-bridged -j vnic3.0-in')
+        ipt.add_rule('-A vnic3.0-in -j ACCEPT')
+        ipt.add_rule('-A sg-default -j ACCEPT')
+        lines = self._check(ipt)
+
+        self.assertIn(':vnic3.0-in - [0:0]', lines)
+        self.assertIn('-X vnic2.0-in', lines)
+        self.assertNotIn('-F vnic1.0-in', lines)
+        self.assertFalse([l for l in lines if 'vnic1.0' in l])
+
+    def test_reorder_in_chain(self):
+        ipt = self._parse()
+        ipt.remove_rule('-A vnic1.0-in -p tcp -m tcp --dport 22:22 -m state --state NEW -s 10.0.0.0/8 -j RETURN')
+        ipt.add_rule('-A vnic1.0-in -p udp -m udp --dport 53:53 -m state --state NEW -s 10.0.0.0/8 -j RETURN')
+        self._check(ipt)
+
+    def test_delete_by_number(self):
+        ipt = self._parse()
+        ipt.remove_rule('-A sg-default -m physdev --physdev-in vnic1.0 --physdev-is-bridged -j vnic1.0-out')
+        ipt.remove_rule('-A sg-default -m physdev --physdev-in vnic2.0 --physdev-is-bridged -j vnic2.0-out')
+        lines = self._check(ipt)
+        self.assertEqual(['-D sg-default 5', '-D sg-default 3'], [l for l in lines if l.startswith('-D')])
+
+    def test_duplicate_rules_in_kernel(self):
+        # [A, X, A] -> [A, X]; deleting the rule '-A sg-default -j ACCEPT' would delete the first one
+        dup = '-A sg-default -m state --state RELATED,ESTABLISHED -j ACCEPT\n'
+        ipt = self._parse(DUMP.replace('-A sg-default -j ACCEPT\n', '-A sg-default -j ACCEPT\n' + dup))
+        self.assertEqual(2, ipt._snapshot[0][1][3][2].count(dup.strip()))
+        lines = self._check(ipt)
+        self.assertIn('-F sg-default', lines)
+        self.assertFalse([l for l in lines if l.startswith('-D')])
+
+        # a duplicate of an unchanged chain is dropped as the full restore did
+        ipt = self._parse(DUMP.replace('-A vnic2.0-in -j ACCEPT\n', '-A vnic2.0-in -j ACCEPT\n' * 2))
+        self.assertEqual(['*filter', '-F vnic2.0-in', '-A vnic2.0-in -j ACCEPT', 'COMMIT'], self._check(ipt))
+
+    def test_cached_model(self):
+        fingerprint = iptables._fingerprint(DUMP)
+        self.assertEqual(fingerprint, iptables._fingerprint(DUMP.replace('[10:100]', '[11:200]')))
+        self.assertNotEqual(fingerprint, iptables._fingerprint(DUMP.replace('22:22', '23:23')))
+
+        ipt = self._parse()
+        loaded = iptables.IPTables()
+        iptables._load_snapshot(loaded, ipt._snapshot)
+        self.assertEqual(str(ipt), str(loaded))
+
+        iptables._refresh_counters(loaded, DUMP.replace('[10:100]', '[11:200]'))
+        self.assertEqual(self._parse(DUMP.replace('[10:100]', '[11:200]')).get_chain('INPUT').counter_str,
+                         loaded.get_chain('INPUT').counter_str)
+
+if __name__ == "__main__":
+    unittest.main()
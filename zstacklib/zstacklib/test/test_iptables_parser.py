@@ -0,0 +1,83 @@
+'''
+
+@author: frank
+'''
+import unittest
+from ..utils import iptables
+from ..utils import ipset
+from . import bench_iptables_parser
+
+def _dump_model(ipt):
+    lst = []
+    for table in ipt.children:
+        lst.append((table.name, table.identity))
+        for chain in table.children:
+            lst.append((chain.name, chain.identity, chain.counter_str, chain.parent is table))
+            lst.extend([(r.name, r.identity, r.order, r.parent is chain) for r in chain.children])
+    return lst
+
+class TestIPTablesParser(unittest.TestCase):
+    def _check_parity(self, txt, cls=iptables.IPTables):
+        expected = cls()
+        bench_iptables_parser.parse_iptables_save_by_pyparsing(expected, txt)
+        ipt = cls()
+        ipt._from_iptables_save(txt)
+        self.assertEqual(_dump_model(expected), _dump_model(ipt))
+        self.assertEqual(str(expected), str(ipt))
+        return ipt
+
+    def test_parity(self):
+        ipt = self._check_parity(bench_iptables_parser.make_iptables_dump(2000))
+        self.assertTrue(ipt.get_chain('vnic3.0-in') is not None)
+        self.assertTrue(ipt._nat_table is not None)
+
+    def test_parity_ip6tables(self):
+        self._check_parity(bench_iptables_parser.make_iptables_dump(200), iptables.IP6Tables)
+
+    def test_parity_irregular_lines(self):
+        self._check_parity('''# Generated by iptables-save
+*filter
+:INPUT ACCEPT [1:2]
+:FORWARD\tDROP   [0:0]
+:bare
+-A   INPUT  -i lo   -j ACCEPT\r
+-A undeclared -j RETURN
+
+-A INPUT -m comment --comment "a  b" -j ACCEPT
+COMMIT
+*mangle
+:PREROUTING ACCEPT [0:0]
+COMMIT
+*filter
+:INPUT ACCEPT [3:4]
+-A INPUT -j DROP
+COMMIT
+''')
+
+    def test_unrecognized_line(self):
+        ipt = iptables.IPTables()
+        self.assertRaises(iptables.IPTablesError, ipt._from_iptables_save, '*filter\n-I INPUT -j DROP\nCOMMIT\n')
+        self.assertRaises(iptables.IPTablesError, ipt.add_rule, '-I INPUT -j DROP')
+
+class TestIPSetParser(unittest.TestCase):
+    def _check_parity(self, txt):
+        expected = ipset.IPSetManager()
+        bench_iptables_parser.parse_ipset_save_by_pyparsing(expected, txt)
+        mgr = ipset.IPSetManager()
+        mgr._from_ipset_save(txt)
+        self.assertEqual(sorted(expected.sets.keys()), sorted(mgr.sets.keys()))
+        for name, s in expected.sets.items():
+            self.assertEqual((s.name, s.type, s.ip_version, s.match_ip, s.nomatch_ip),
+                             (mgr.sets[name].name, mgr.sets[name].type, mgr.sets[name].ip_version,
+                              mgr.sets[name].match_ip, mgr.sets[name].nomatch_ip))
+
+    def test_parity(self):
+        self._check_parity(bench_iptables_parser.make_ipset_dump(2000))
+        self._check_parity('''create s1 hash:net,port family inet hashsize 1024 maxelem 65536
+add s1 10.0.0.0/24,tcp:80
+add s1 10.0.0.1
+add s2 10.0.0.2
+''')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -42,6 +42,35 @@ class Test(unittest.TestCase):
         print jb.xxxxx
         print jb.lst
 
+    def test_nested(self):
+        jstr = '{"rules": [{"ports": [22, {"start": 80}], "cidr": null}], "states": {"vm1": "Running"}, "name": "\\u4e2d"}'
+        obj = jsonobject.loads(jstr)
+        self.assertIsInstance(obj.rules[0], jsonobject.JsonObject)
+        self.assertEqual(80, obj.rules[0].ports[1].start)
+        self.assertIsNone(obj.rules[0].cidr)
+        self.assertEqual('Running', obj.states.vm1)
+        self.assertEqual(u'\u4e2d', obj.name)
+        lst = jsonobject.loads('[1, {"a": 1}]')
+        self.assertEqual(1, lst[0])
+        self.assertEqual(1, lst[1].a)
+
+        nobj = jsonobject.loads(jsonobject.dumps(obj))
+        self.assertEqual(80, nobj.rules[0].ports[1].start)
+        self.assertFalse(nobj.rules[0].hasattr('cidr'))
+        self.assertEqual(u'\u4e2d', nobj.name)
+
+    def test_dumps_numbers(self):
+        b = B()
+        b.big = 1 << 70
+        b.small = 1e-12
+        b.ratio = 0.1234567890123
+        b.path = '/var/lib'
+        nb = jsonobject.loads(jsonobject.dumps(b))
+        self.assertEqual(1 << 70, nb.big)
+        self.assertEqual(1e-12, nb.small)
+        self.assertEqual(0.1234567890123, nb.ratio)
+        self.assertEqual('/var/lib', nb.path)
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,101 @@
+'''
+
+@author: frank
+'''
+import marshal
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from ..utils import bash
+from ..utils import shell
+
+class TestShellForkServer(unittest.TestCase):
+    def setUp(self):
+        shell.inlinecmd = True
+        self.dir = tempfile.mkdtemp()
+        for name in ['b', 'a', '.hidden']:
+            with open(os.path.join(self.dir, name), 'w') as fd:
+                fd.write(name + '\n')
+
+    def tearDown(self):
+        shell.inlinecmd = False
+        shell.disable_fork_server()
+        shutil.rmtree(self.dir)
+
+    def _check_commands(self, mode):
+        for cmd in ['cat %s/a %s/b' % (self.dir, self.dir), 'ls %s' % self.dir]:
+            s = shell.ShellCmd(cmd)
+            self.assertEqual(shell.INLINE, s.mode)
+            inline = s()
+            self.assertEqual(0, s.return_code)
+            self.assertEqual(shell.call('%s | cat' % cmd), inline)
+
+        s = shell.ShellCmd('cat %s/nothing' % self.dir)
+        self.assertEqual(mode, s.mode)
+        self.assertRaises(shell.ShellError, s)
+        self.assertEqual(1, s.return_code if s.return_code is not None else s.process.returncode)
+
+        self.assertEqual('a\n', shell.call('cat a', workdir=self.dir))
+        self.assertEqual(os.path.realpath(self.dir), shell.call('pwd', workdir=self.dir).strip())
+        self.assertEqual(3, shell.run('exit 3'))
+        self.assertEqual((0, 'x\n', None), bash.bash_roe('echo x | grep x', pipe_fail=True))
+        self.assertEqual((1, '', ''), bash.bash_roe('false | true', pipe_fail=True))
+
+    def test_fork(self):
+        self._check_commands(shell.FORK)
+
+    def test_fork_server(self):
+        shell.enable_fork_server()
+        self._check_commands(shell.FORK_SERVER)
+        self.assertGreater(shell.get_call_stats()['echo'][shell.FORK_SERVER], 0)
+
+        # commands fall back to forking by this process
+        shell._fork_server.process.kill()
+        shell._fork_server.process.wait()
+        self.assertEqual('y\n', shell.call('echo y'))
+        self.assertIsNone(shell._fork_server)
+
+    def test_truncated_reply(self):
+        path = os.path.join(self.dir, 'sock')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(1)
+
+        def serve():
+            conn, _ = listener.accept()
+            while conn.recv(65536):
+                pass
+            # the server dies in the middle of the reply
+            conn.sendall(marshal.dumps((0, 'x' * 1024, '', None))[:100])
+            conn.close()
+        t = threading.Thread(target=serve)
+        t.daemon = True
+        t.start()
+
+        server = shell._ForkServer.__new__(shell._ForkServer)
+        server.path = path
+        server.stop = lambda: listener.close()
+        shell._fork_server = server
+        self.assertEqual('y\n', shell.call('echo y'))
+        self.assertIsNone(shell._fork_server)
+        t.join(5)
+
+    def test_call_stats(self):
+        shell.call('cat %s/a' % self.dir)
+        shell.call('true')
+        stats = shell.get_call_stats()
+        self.assertGreater(stats['cat'][shell.INLINE], 0)
+        self.assertGreater(stats['true'][shell.FORK], 0)
+        self.assertGreaterEqual(stats['true']['time']['sum'], stats['true']['time']['max'])
+
+    def test_inline_off_by_default(self):
+        shell.inlinecmd = False
+        s = shell.ShellCmd('cat %s/a' % self.dir)
+        self.assertEqual(shell.FORK, s.mode)
+        self.assertEqual('a\n', s())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+'''
+
+@author: frank
+'''
+import simplejson
+import unittest
+from ..utils import bash
+from ..utils import http
+from ..utils import shell
+
+class TestShellTrace(unittest.TestCase):
+    def setUp(self):
+        shell.tracecmd = True
+
+    def tearDown(self):
+        shell.tracecmd = False
+        shell.logcmd = True
+
+    def test_trace(self):
+        with shell.trace_endpoint('/test/slow'):
+            shell.run('sleep 0.3')
+            shell.call('exit 2', False)
+            bash.bash_r('sleep 0.1')
+        shell.call('true')
+
+        slowest = shell.get_slowest_commands(2)
+        self.assertEqual(['sleep 0.3', 'sleep 0.1'], [t['cmd'] for t in slowest])
+        self.assertEqual('/test/slow', slowest[0]['endpoint'])
+        self.assertGreaterEqual(slowest[0]['seconds'], 0.3)
+
+        traces = shell.get_slowest_commands(100, '/test/slow')
+        self.assertEqual(3, len(traces))
+        self.assertEqual(2, [t for t in traces if t['cmd'] == 'exit 2'][0]['return_code'])
+        self.assertIsNone([t for t in shell.get_slowest_commands(100) if t['cmd'] == 'true'][0]['endpoint'])
+
+        stats = shell.get_call_stats()['sleep']
+        self.assertGreaterEqual(stats['calls'], 2)
+        self.assertEqual(stats['calls'], stats['time']['count'])
+        self.assertGreaterEqual(shell.get_call_stats()['exit']['failures'], 1)
+
+    def test_trace_without_cmd(self):
+        with shell.trace_endpoint('/test/secret'):
+            shell.tracecmd = False
+            shell.call('echo password1')
+            shell.tracecmd = True
+            shell.logcmd = False
+            shell.call('echo password2')
+
+        traces = shell.get_slowest_commands(100, '/test/secret')
+        self.assertEqual(['echo', 'echo'], [t['cmd'] for t in traces])
+
+    def test_debug_endpoint(self):
+        server = http.HttpServer(port=0)
+
+        def handler(req):
+            shell.call('echo traced')
+            return ''
+
+        server.register_sync_uri('/test/sync', handler)
+        server.sync_uri_handlers['/test/sync'].controller._do_index(http.Request())
+
+        body = simplejson.dumps({'top': 1, 'endpoint': '/test/sync'})
+        stats = simplejson.loads(server._get_debug_shell({http.REQUEST_BODY: body}))
+        self.assertEqual(1, len(stats['slowest']))
+        self.assertEqual('echo traced', stats['slowest'][0]['cmd'])
+        self.assertIn('echo', stats['executables'])
+
+if __name__ == "__main__":
+    unittest.main()
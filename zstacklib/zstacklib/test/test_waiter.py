@@ -0,0 +1,76 @@
+'''
+
+@author: frank
+'''
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from ..utils import linux
+from ..utils import waiter
+
+class TestWaiter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _later(self, func, delay=0.2):
+        t = threading.Timer(delay, func)
+        t.start()
+        return t
+
+    def test_watch_file(self):
+        path = os.path.join(self.dir, 'pid')
+        with waiter.watch_file(path) as events:
+            # changes of other files in the directory don't wake the wait
+            open(os.path.join(self.dir, 'log'), 'w').close()
+            self.assertFalse(events.wait(0.1))
+
+            self._later(lambda: open(path, 'w').close())
+            start = time.time()
+            self.assertTrue(linux.wait_callback_success(os.path.exists, path, timeout=10, interval=5, events=events))
+            self.assertLess(time.time() - start, 2)
+
+    def test_watch_process(self):
+        p = subprocess.Popen(['sleep', '0.2'])
+        with waiter.watch_process(p.pid) as events:
+            start = time.time()
+            self.assertTrue(linux.wait_callback_success(lambda _: p.poll() is not None, timeout=10, interval=5,
+                                                        events=events))
+            self.assertLess(time.time() - start, 2)
+
+    def test_notifier(self):
+        notifier = waiter.Notifier()
+        state = []
+        with notifier.listen() as events:
+            def change():
+                state.append('Running')
+                notifier.notify()
+
+            self._later(change)
+            start = time.time()
+            self.assertTrue(linux.wait_callback_success(lambda _: state, timeout=10, interval=5, events=events))
+            self.assertLess(time.time() - start, 2)
+
+            # a notify between two waits is not lost
+            notifier.notify()
+            self.assertTrue(events.wait(0))
+            self.assertFalse(events.wait(0))
+
+    def test_backoff(self):
+        calls = []
+        start = time.time()
+        self.assertFalse(linux.wait_callback_success(lambda _: calls.append(1), timeout=0.5, interval=0.2,
+                                                     events=waiter.Backoff()))
+        self.assertLess(time.time() - start, 1)
+        # 0.01, 0.02, 0.04, 0.08, 0.16, then at most every 0.2s
+        self.assertGreater(len(calls), 5)
+        self.assertLess(len(calls), 10)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+'''
+
+@author: frank
+'''
+import unittest
+import threading
+import time
+from ..utils.thread import WorkerPool
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def test_priority_and_saturation(self):
+        pool = WorkerPool('test', 1, 3)
+        gate = threading.Event()
+        done = threading.Event()
+        order = []
+
+        pool.submit(gate.wait)
+        # wait until the only worker is blocked on the gate
+        while pool.get_stats()['busy'] != 1:
+            gate.wait(0.01)
+
+        self.assertTrue(pool.submit(order.append, ('low',), priority=10))
+        self.assertTrue(pool.submit(order.append, ('high',), priority=0))
+        self.assertTrue(pool.submit(done.set, priority=20))
+        self.assertFalse(pool.submit(order.append, ('rejected',)))
+
+        gate.set()
+        done.wait(5)
+        self.assertEqual(['high', 'low'], order)
+
+        stats = pool.get_stats()
+        self.assertEqual(1, stats['workers'])
+        self.assertEqual(1, stats['rejected'])
+        self.assertEqual(4, stats['submitted'])
+
+    def test_spawn_while_worker_takes_task(self):
+        pool = WorkerPool('test', 2, 10)
+        get = pool.queue.get
+
+        def slow_get():
+            # the worker holds the task for a while before running it
+            task = get()
+            time.sleep(0.2)
+            return task
+        pool.queue.get = slow_get
+
+        gate = threading.Event()
+        started = threading.Event()
+        pool.submit(gate.wait)
+        time.sleep(0.05)
+        pool.submit(started.set)
+        # the second task runs by a new worker instead of waiting behind the blocked one
+        self.assertTrue(started.wait(2))
+        self.assertEqual(2, pool.get_stats()['workers'])
+        gate.set()
+
+    def test_idle_worker_reused(self):
+        pool = WorkerPool('test', 5, 10)
+        for i in range(3):
+            done = threading.Event()
+            pool.submit(done.set)
+            self.assertTrue(done.wait(2))
+            time.sleep(0.05)
+        self.assertEqual(1, pool.get_stats()['workers'])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,3 @@
-import subprocess
 import functools
 import json
 from jinja2 import Template
@@ -8,6 +7,7 @@ import time
 import re
 from progress_report import WatchThread_1
 from zstacklib.utils import linux
+from zstacklib.utils import shell
 
 logger = log.get_logger(__name__)
 
@@ -51,17 +51,15 @@ def bash_roe(cmd, errorout=False, ret_code = 0, pipe_fail=False):
     ctx = __collect_locals_on_stack()
 
     cmd = bash_eval(cmd, ctx)
-    p = subprocess.Popen('/bin/bash', stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
     if pipe_fail:
         cmd = 'set -o pipefail; %s' % cmd
-    o, e = p.communicate(cmd)
-    r = p.returncode
+    r, o, e = shell.run_script(cmd)
 
     __BASH_DEBUG_INFO__ = ctx.get('__BASH_DEBUG_INFO__')
     if __BASH_DEBUG_INFO__ is not None:
         __BASH_DEBUG_INFO__.append({
             'cmd': cmd,
-            'return_code': p.returncode,
+            'return_code': r,
             'stdout': o,
             'stderr': e
         })
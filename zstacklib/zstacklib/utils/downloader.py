@@ -0,0 +1,305 @@
+'''
+
+@author: frank
+'''
+import Queue
+import hashlib
+import os
+import threading
+import time
+
+import simplejson
+import urllib3
+
+from zstacklib.utils import linux
+from zstacklib.utils import log
+from zstacklib.utils import shell
+
+logger = log.get_logger(__name__)
+
+SEGMENT_NUM = 4
+# files smaller than two segments of this size are not split
+MIN_SEGMENT_SIZE = 32 * 1024 * 1024
+BUFFER_SIZE = 1024 * 1024
+# buffers read from the network but not written yet, bounds the memory used by a download
+BUFFER_NUM = 32
+READ_TIMEOUT = 60
+SEGMENT_RETRIES = 5
+# seconds between saving the progress of segments for resuming
+CHECKPOINT_INTERVAL = 5
+CHECKPOINT_SUFFIX = '.download'
+
+class DownloadError(Exception):
+    '''download error'''
+
+class Segment(object):
+    def __init__(self, start, end, done=0):
+        self.start = start
+        # exclusive
+        self.end = end
+        # bytes written to the file
+        self.done = done
+
+    def size(self):
+        return self.end - self.start
+
+    def finished(self):
+        return self.done >= self.size()
+
+class SegmentedDownloader(object):
+    '''
+    downloads a http/https url by several Range requests in parallel into a preallocated file.
+    Segments read from the network go through a bounded buffer queue to one writer, the md5
+    is computed from the written file in order while the download goes on. The progress of
+    segments is saved in a checkpoint file next to the target, so an interrupted download
+    with the same url resumes from there
+    '''
+    def __init__(self, url, dst, segment_num=SEGMENT_NUM, timeout=0, callback=None):
+        self.url = url
+        self.dst = dst
+        self.checkpoint_path = dst + CHECKPOINT_SUFFIX
+        self.segment_num = segment_num
+        self.timeout = timeout
+        self.callback = callback
+        self.pool = urllib3.PoolManager(num_pools=1, maxsize=segment_num + 1)
+        self.size = None
+        self.validator = None
+        self.segments = []
+        self.buffers = Queue.Queue(BUFFER_NUM)
+        self.cond = threading.Condition()
+        self.errors = []
+        self.deadline = None
+
+    def _request(self, start, end):
+        return self.pool.request('GET', self.url, headers={'Range': 'bytes=%s-%s' % (start, end)},
+                                 preload_content=False, retries=False,
+                                 timeout=urllib3.Timeout(connect=READ_TIMEOUT, read=READ_TIMEOUT))
+
+    def probe(self):
+        '''
+        :return: False if the server doesn't take range requests
+        '''
+        resp = self._request(0, 0)
+        try:
+            content_range = resp.getheader('content-range')
+            if resp.status != 206 or not content_range or '/' not in content_range:
+                return False
+
+            total = content_range.split('/')[-1].strip()
+            if not total.isdigit():
+                return False
+
+            self.size = long(total)
+            # a resumed download must fetch the same content
+            self.validator = resp.getheader('etag') or resp.getheader('last-modified')
+            return True
+        finally:
+            # the body is never read, don't put the connection back to the pool
+            resp.close()
+
+    def _load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path) or not os.path.exists(self.dst):
+            return False
+
+        try:
+            with open(self.checkpoint_path, 'r') as fd:
+                cp = simplejson.load(fd)
+        except Exception as e:
+            logger.warn('ignore broken checkpoint %s, %s' % (self.checkpoint_path, e))
+            return False
+
+        if (cp.get('url'), cp.get('size'), cp.get('validator')) != (self.url, self.size, self.validator) or \
+                os.path.getsize(self.dst) != self.size:
+            return False
+
+        self.segments = [Segment(start, end, done) for start, end, done in cp['segments']]
+        logger.debug('resume downloading %s from %s bytes' % (self.url, sum([s.done for s in self.segments])))
+        return True
+
+    def _save_checkpoint(self):
+        with self.cond:
+            segments = [[s.start, s.end, s.done] for s in self.segments]
+
+        tmp = self.checkpoint_path + '.tmp'
+        with open(tmp, 'w') as fd:
+            simplejson.dump({'url': self.url, 'size': self.size, 'validator': self.validator, 'segments': segments}, fd)
+        os.rename(tmp, self.checkpoint_path)
+
+    def _prepare(self):
+        if self._load_checkpoint():
+            return
+
+        if os.path.exists(self.dst):
+            os.remove(self.dst)
+        if shell.run('fallocate -l %s %s' % (self.size, linux.shellquote(self.dst))) != 0:
+            # e.g. the file system doesn't support fallocate
+            with open(self.dst, 'w') as fd:
+                fd.truncate(self.size)
+
+        num = max(min(self.segment_num, self.size / MIN_SEGMENT_SIZE), 1)
+        seg_size = self.size / num
+        self.segments = []
+        for i in range(num):
+            end = self.size if i == num - 1 else (i + 1) * seg_size
+            self.segments.append(Segment(i * seg_size, end))
+        self._save_checkpoint()
+
+    def _check_deadline(self):
+        if self.deadline and time.time() > self.deadline and not self.errors:
+            self.errors.append(DownloadError('download %s timeout after %s seconds' % (self.url, self.timeout)))
+
+    def _fetch(self, seg):
+        # bytes of the segment queued to write
+        fetched = seg.done
+        retries = SEGMENT_RETRIES
+        while fetched < seg.size() and not self.errors:
+            try:
+                resp = self._request(seg.start + fetched, seg.end - 1)
+                try:
+                    if resp.status != 206:
+                        raise DownloadError('unexpected status %s for range request of %s' % (resp.status, self.url))
+
+                    while fetched < seg.size() and not self.errors:
+                        data = resp.read(min(BUFFER_SIZE, seg.size() - fetched))
+                        if not data:
+                            raise DownloadError('connection closed by server')
+
+                        self._put((seg, seg.start + fetched, data))
+                        fetched += len(data)
+                finally:
+                    if fetched < seg.size():
+                        # a partially read response can't be reused
+                        resp.close()
+                    else:
+                        resp.release_conn()
+            except Exception as e:
+                retries -= 1
+                if retries < 0:
+                    self.errors.append(e)
+                    break
+
+                logger.warn('retry downloading bytes %s-%s of %s, %s' % (seg.start + fetched, seg.end - 1, self.url, e))
+                time.sleep(1)
+
+    def _put(self, item):
+        while not self.errors:
+            try:
+                self.buffers.put(item, timeout=1)
+                return
+            except Queue.Full:
+                self._check_deadline()
+
+    def _write(self):
+        fd = os.open(self.dst, os.O_WRONLY)
+        last_checkpoint = time.time()
+        try:
+            while True:
+                item = self.buffers.get()
+                if item is None:
+                    break
+
+                seg, offset, data = item
+                os.lseek(fd, offset, os.SEEK_SET)
+                os.write(fd, data)
+                with self.cond:
+                    seg.done += len(data)
+                    self.cond.notify_all()
+
+                if time.time() - last_checkpoint > CHECKPOINT_INTERVAL:
+                    self._save_checkpoint()
+                    last_checkpoint = time.time()
+        except Exception as e:
+            self.errors.append(e)
+            # don't let fetchers block on a full queue
+            while self.buffers.get() is not None:
+                pass
+        finally:
+            os.close(fd)
+
+    def _written(self):
+        with self.cond:
+            return sum([s.done for s in self.segments])
+
+    def _written_prefix(self):
+        prefix = 0
+        for seg in self.segments:
+            prefix = seg.start + seg.done
+            if not seg.finished():
+                break
+        return prefix
+
+    def _hash(self):
+        md5 = hashlib.md5()
+        cursor = 0
+        last_percent = None
+        fd = os.open(self.dst, os.O_RDONLY)
+        try:
+            while cursor < self.size and not self.errors:
+                with self.cond:
+                    prefix = self._written_prefix()
+                    if prefix <= cursor:
+                        self.cond.wait(1)
+                        prefix = self._written_prefix()
+
+                # the data was just written, it's read back from page cache
+                while cursor < prefix:
+                    os.lseek(fd, cursor, os.SEEK_SET)
+                    data = os.read(fd, min(BUFFER_SIZE, prefix - cursor))
+                    md5.update(data)
+                    cursor += len(data)
+
+                percent = int(self._written() * 100 / self.size)
+                if self.callback and percent != last_percent:
+                    last_percent = percent
+                    try:
+                        self.callback(percent, self.url)
+                    except Exception:
+                        pass
+                self._check_deadline()
+        finally:
+            os.close(fd)
+
+        return md5.hexdigest()
+
+    def download(self):
+        '''
+        :return: md5 of the downloaded file, or None if the url can't be downloaded in segments,
+                 callers should download it in other ways then
+        '''
+        if not self.probe():
+            logger.debug('%s does not support range requests' % self.url)
+            return None
+
+        if self.timeout:
+            self.deadline = time.time() + self.timeout
+        self._prepare()
+        logger.debug('start to download %s(%s bytes) in %s segments' % (self.url, self.size, len(self.segments)))
+
+        start_time = time.time()
+        fetchers = [threading.Thread(target=self._fetch, args=(s,)) for s in self.segments if not s.finished()]
+        writer = threading.Thread(target=self._write)
+        for t in fetchers + [writer]:
+            t.daemon = True
+            t.start()
+
+        md5 = None
+        try:
+            md5 = self._hash()
+        finally:
+            for t in fetchers:
+                t.join()
+            self.buffers.put(None)
+            writer.join()
+
+        if self.errors:
+            self._save_checkpoint()
+            raise DownloadError('failed to download %s, %s' % (self.url, self.errors[0]))
+
+        os.remove(self.checkpoint_path)
+        elapsed = time.time() - start_time
+        logger.debug('downloaded %s to %s in %.1fs, %.1f MB/s' % (self.url, self.dst, elapsed,
+                     float(self.size) / 1024 / 1024 / max(elapsed, 0.001)))
+        return md5
+
+def download(url, dst, segment_num=SEGMENT_NUM, timeout=0, callback=None):
+    return SegmentedDownloader(url, dst, segment_num, timeout, callback).download()
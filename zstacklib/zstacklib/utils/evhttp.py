@@ -0,0 +1,399 @@
+'''
+
+@author: frank
+'''
+import collections
+import errno
+import fcntl
+import os
+import select
+import socket
+import threading
+import time
+import traceback
+
+from zstacklib.utils import log
+from zstacklib.utils import thread
+
+logger = log.get_logger(__name__)
+
+# an HTTP/1.1 server on one epoll loop thread, the backend of http.HttpServer selected by
+# HTTP_SERVER_BACKEND=eventloop. Idle keep-alive connections cost no thread. Handlers marked
+# inline, which must not block, run on the loop; others run by a bounded worker pool and
+# their responses are handed back to the loop.
+
+MAX_HEADER_SIZE = 64 * 1024
+# the same as the default max_request_body_size of cherrypy
+MAX_BODY_SIZE = 100 * 1024 * 1024
+# pipelined requests wait while this many bytes of responses are not taken by the client
+MAX_PENDING_OUTPUT = 1024 * 1024
+RECV_SIZE = 256 * 1024
+# seconds an idle keep-alive connection is kept
+IDLE_TIMEOUT = 300
+LISTEN_BACKLOG = 1024
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    411: 'Length Required',
+    413: 'Request Entity Too Large',
+    431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+class HeaderMap(dict):
+    '''
+    headers looked up case-insensitively, like the headers of a cherrypy request
+    '''
+    def __setitem__(self, key, value):
+        super(HeaderMap, self).__setitem__(key.lower(), value)
+
+    def __getitem__(self, key):
+        return super(HeaderMap, self).__getitem__(key.lower())
+
+    def __contains__(self, key):
+        return super(HeaderMap, self).__contains__(key.lower())
+
+    def has_key(self, key):
+        return key in self
+
+    def get(self, key, default=None):
+        return super(HeaderMap, self).get(key.lower(), default)
+
+class Request(object):
+    def __init__(self):
+        self.method = None
+        self.path = None
+        self.query_string = None
+        self.version = None
+        self.headers = HeaderMap()
+        self.body = None
+
+    def keep_alive(self):
+        conn = self.headers.get('Connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return conn == 'keep-alive'
+        return conn != 'close'
+
+class _Connection(object):
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.addr = addr
+        self.closed = False
+        self.inbuf = ''
+        self.outbuf = ''
+        # a request is being handled, the next one in inbuf waits for its response
+        self.busy = False
+        self.close_after_write = False
+        self.last_active = time.time()
+
+    def fileno(self):
+        return self.fd
+
+def _parse_head(head):
+    lines = head.split('\r\n')
+    parts = lines[0].split()
+    if len(parts) != 3:
+        raise ValueError('invalid request line: %s' % lines[0])
+
+    req = Request()
+    req.method, target, req.version = parts
+    req.path, _, req.query_string = target.partition('?')
+    req.query_string = req.query_string or None
+    for l in lines[1:]:
+        name, sep, value = l.partition(':')
+        if not sep:
+            raise ValueError('invalid header: %s' % l)
+        req.headers[name.strip()] = value.strip()
+    return req
+
+def make_response(status, headers, body, keep_alive):
+    if body is None:
+        body = ''
+    elif isinstance(body, unicode):
+        body = body.encode('utf-8')
+
+    lines = ['HTTP/1.1 %s %s' % (status, REASONS.get(status, 'Unknown'))]
+    headers = dict(headers or {})
+    headers.setdefault('Content-Type', 'text/html;charset=utf-8')
+    headers['Content-Length'] = str(len(body))
+    if not keep_alive:
+        headers['Connection'] = 'close'
+    lines.extend(['%s: %s' % (k, v) for k, v in headers.items()])
+    return '\r\n'.join(lines) + '\r\n\r\n' + body
+
+class EventLoopServer(object):
+    '''
+    route(request) returns (handler, inline) for a request or None for 404, handler(request)
+    returns (status, headers, body)
+    '''
+    def __init__(self, port, route, host='0.0.0.0', workers=10, max_queue_size=1000):
+        self.port = port
+        self.host = host
+        self.route = route
+        self.pool = thread.WorkerPool('http-server', workers, max_queue_size)
+        self.epoll = None
+        self.listener = None
+        self.conns = {}
+        self.running = False
+        # (fd, connection, response, keep alive) finished by workers, wrote to the connections by the loop
+        self.finished = collections.deque()
+        self.wake_r, self.wake_w = None, None
+        # workers and stop() wake the loop, which closes the pipe when it exits
+        self.wake_lock = threading.Lock()
+
+    def _listen(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.host, self.port))
+        self.listener.listen(LISTEN_BACKLOG)
+        self.listener.setblocking(0)
+        self.port = self.listener.getsockname()[1]
+
+        self.wake_r, self.wake_w = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        self.epoll = select.epoll()
+        self.epoll.register(self.listener.fileno(), select.EPOLLIN)
+        self.epoll.register(self.wake_r, select.EPOLLIN)
+
+    def _wake(self):
+        with self.wake_lock:
+            if self.wake_w is None:
+                return
+            try:
+                os.write(self.wake_w, 'x')
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def _accept(self):
+        while True:
+            try:
+                sock, addr = self.listener.accept()
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EMFILE, errno.ENFILE):
+                    return
+                raise
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = _Connection(sock, addr)
+            self.conns[sock.fileno()] = conn
+            self.epoll.register(sock.fileno(), select.EPOLLIN)
+
+    def _close(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        fd = conn.fileno()
+        self.conns.pop(fd, None)
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, OSError):
+            pass
+        conn.sock.close()
+
+    def _read(self, conn):
+        while True:
+            try:
+                data = conn.sock.recv(RECV_SIZE)
+            except socket.error as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                self._close(conn)
+                return
+            if not data:
+                self._close(conn)
+                return
+            conn.inbuf += data
+
+        conn.last_active = time.time()
+        self._serve(conn)
+
+    def _serve(self, conn):
+        # requests pipelined on a connection are handled in order, the next one after the
+        # response of the former is queued
+        while not conn.closed and not conn.busy and not conn.close_after_write and len(conn.outbuf) < MAX_PENDING_OUTPUT:
+            req = self._next_request(conn)
+            if req is None:
+                break
+            conn.busy = True
+            self._dispatch(conn, req)
+
+        if not conn.closed:
+            self._write(conn)
+
+    def _reject(self, conn, status, reason):
+        self._respond(conn, make_response(status, None, reason, False), False)
+
+    def _next_request(self, conn):
+        head_end = conn.inbuf.find('\r\n\r\n')
+        if head_end < 0:
+            if len(conn.inbuf) > MAX_HEADER_SIZE:
+                self._reject(conn, 431, 'request header too large')
+            return None
+
+        try:
+            req = _parse_head(conn.inbuf[:head_end])
+            if 'chunked' in req.headers.get('Transfer-Encoding', '').lower():
+                self._reject(conn, 411, 'chunked request body is not supported')
+                return None
+            length = int(req.headers.get('Content-Length', '0'))
+            if length < 0:
+                raise ValueError('invalid Content-Length: %s' % length)
+        except ValueError as e:
+            self._reject(conn, 400, str(e))
+            return None
+
+        if length > MAX_BODY_SIZE:
+            self._reject(conn, 413, 'request body is larger than %s bytes' % MAX_BODY_SIZE)
+            return None
+
+        body_start = head_end + 4
+        if len(conn.inbuf) < body_start + length:
+            return None
+
+        req.body = conn.inbuf[body_start:body_start + length]
+        conn.inbuf = conn.inbuf[body_start + length:]
+        return req
+
+    def _handle(self, handler, req):
+        try:
+            status, headers, body = handler(req)
+        except Exception as e:
+            logger.warn('[WARN]: %s' % traceback.format_exc())
+            status, headers, body = 500, None, str(e)
+        return make_response(status, headers, body, req.keep_alive())
+
+    def _dispatch(self, conn, req):
+        r = self.route(req)
+        if r is None:
+            self._respond(conn, make_response(404, None, 'no handler for %s' % req.path, req.keep_alive()), req.keep_alive())
+            return
+
+        handler, inline = r
+        if inline:
+            self._respond(conn, self._handle(handler, req), req.keep_alive())
+            return
+
+        fd = conn.fileno()
+
+        def work():
+            self.finished.append((fd, conn, self._handle(handler, req), req.keep_alive()))
+            self._wake()
+
+        if not self.pool.submit(work):
+            self._respond(conn, make_response(503, {'Retry-After': '5'}, 'too many requests', False), False)
+
+    def _respond(self, conn, response, keep_alive):
+        # queued only, _serve() writes it
+        conn.outbuf += response
+        conn.busy = False
+        if not keep_alive:
+            conn.close_after_write = True
+
+    def _write(self, conn):
+        while conn.outbuf:
+            try:
+                n = conn.sock.send(conn.outbuf)
+            except socket.error as e:
+                if e.errno == errno.EAGAIN:
+                    self.epoll.modify(conn.fileno(), select.EPOLLIN | select.EPOLLOUT)
+                    return
+                self._close(conn)
+                return
+            conn.outbuf = conn.outbuf[n:]
+
+        conn.last_active = time.time()
+        if conn.close_after_write:
+            self._close(conn)
+            return
+        self.epoll.modify(conn.fileno(), select.EPOLLIN)
+
+    def _drain_finished(self):
+        try:
+            while os.read(self.wake_r, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+        while self.finished:
+            fd, conn, response, keep_alive = self.finished.popleft()
+            # the client may have gone and the fd been reused
+            if self.conns.get(fd) is conn:
+                self._respond(conn, response, keep_alive)
+                self._on_conn(conn, self._serve)
+
+    def _on_conn(self, conn, func, *args):
+        # a failure of a connection closes the connection only, not the loop
+        try:
+            func(conn, *args)
+        except Exception:
+            logger.warn('[WARN]: connection from %s failed, %s' % (conn.addr, traceback.format_exc()))
+            self._close(conn)
+
+    def _handle_event(self, conn, event):
+        if event & (select.EPOLLERR | select.EPOLLHUP) and not event & select.EPOLLIN:
+            self._close(conn)
+            return
+        if event & select.EPOLLOUT:
+            # responses taken by the client unblock the pipelined requests
+            self._serve(conn)
+        if event & select.EPOLLIN and not conn.closed:
+            self._read(conn)
+
+    def _sweep_idle(self):
+        deadline = time.time() - IDLE_TIMEOUT
+        for conn in self.conns.values():
+            if not conn.busy and not conn.outbuf and conn.last_active < deadline:
+                self._close(conn)
+
+    def serve_forever(self):
+        self._listen()
+        self.running = True
+        logger.debug('event loop http server listens on %s:%s' % (self.host, self.port))
+        last_sweep = time.time()
+        try:
+            while self.running:
+                try:
+                    events = self.epoll.poll(1)
+                except IOError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+
+                for fd, event in events:
+                    if fd == self.listener.fileno():
+                        self._accept()
+                    elif fd == self.wake_r:
+                        self._drain_finished()
+                    else:
+                        conn = self.conns.get(fd)
+                        if conn is not None:
+                            self._on_conn(conn, self._handle_event, event)
+
+                if time.time() - last_sweep > 1:
+                    self._sweep_idle()
+                    last_sweep = time.time()
+        finally:
+            for conn in self.conns.values():
+                self._close(conn)
+            self.epoll.close()
+            self.listener.close()
+            with self.wake_lock:
+                os.close(self.wake_r)
+                os.close(self.wake_w)
+                self.wake_r, self.wake_w = None, None
+
+    @thread.AsyncThread
+    def serve_in_thread(self):
+        self.serve_forever()
+
+    def stop(self):
+        self.running = False
+        self._wake()
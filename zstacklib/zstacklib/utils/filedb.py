@@ -2,13 +2,35 @@
 
 @author: YYK
 '''
-import pickledb
+import contextlib
 import os
+import threading
+import time
+
+import simplejson
 
 ZSTACK_FILEDB_DIR="/var/lib/zstack/pickledb/"
 
+LOG_SUFFIX = '.log'
+# compact when the log has more records than this and than keys in the db
+COMPACT_MIN_RECORDS = 1000
+# seconds, commits in the interval share one fsync. 0 fsyncs every commit
+FSYNC_INTERVAL = 1
+
+# log records, one json list per line
+_SET = 's'
+_REM = 'r'
+_BATCH = 'b'
+
 class FileDB(object):
-    '''Wrap pickledb and provide unified file based database operations'''
+    '''
+    file based key-value database.
+
+    The database file keeps a json dump of all keys, the same format pickledb uses. Updates
+    are appended to a log file next to it as one line per commit, and the log is compacted
+    into the database file when it grows larger than the data. A crash can lose at most the
+    last unsynced commits, a torn last line is dropped when loading
+    '''
     def __init__(self, file_name, is_abs_path=False):
         if not is_abs_path:
             file_path = os.path.join(ZSTACK_FILEDB_DIR, file_name)
@@ -17,23 +39,126 @@ class FileDB(object):
         file_dir = os.path.dirname(file_path)
         if not os.path.exists(file_dir):
             os.makedirs(file_dir, 0755)
-        #force save for each db operation.
-        self.file_db = pickledb.pickledb(file_path, True)
+
+        self.file_path = file_path
+        self.log_path = file_path + LOG_SUFFIX
+        self.lock = threading.RLock()
+        self.db = {}
+        self.log = None
+        self.log_records = 0
+        self.last_sync = 0
+        self.batch_records = None
+        self._load()
+
+    def _load(self):
+        if os.path.exists(self.file_path) and os.path.getsize(self.file_path) > 0:
+            with open(self.file_path, 'rb') as fd:
+                self.db = simplejson.load(fd)
+
+        valid_size = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'rb') as fd:
+                for line in fd:
+                    if not line.endswith('\n'):
+                        break
+                    try:
+                        record = simplejson.loads(line)
+                    except ValueError:
+                        break
+                    self._replay(record)
+                    self.log_records += 1
+                    valid_size += len(line)
+
+        self.log = open(self.log_path, 'ab')
+        if self.log.tell() != valid_size:
+            # drop the commit torn by a crash
+            self.log.truncate(valid_size)
+            self.log.seek(valid_size)
+
+    def _replay(self, record):
+        op = record[0]
+        if op == _SET:
+            self.db[record[1]] = record[2]
+        elif op == _REM:
+            self.db.pop(record[1], None)
+        elif op == _BATCH:
+            for r in record[1]:
+                self._replay(r)
+
+    def _commit(self, record):
+        if self.batch_records is not None:
+            self.batch_records.append(record)
+            return
+
+        self.log.write(simplejson.dumps(record) + '\n')
+        self.log.flush()
+        self.log_records += 1
+
+        now = time.time()
+        if now - self.last_sync >= FSYNC_INTERVAL:
+            os.fsync(self.log.fileno())
+            self.last_sync = now
+
+        if self.log_records > max(COMPACT_MIN_RECORDS, len(self.db)):
+            self.compact()
 
     def get(self, key):
         try:
-            return self.file_db.get(key)
+            return self.db.get(key)
         except:
             return None
-    
+
     def set(self, key, value):
-        self.file_db.set(key, value)
-    
+        with self.lock:
+            self.db[key] = value
+            self._commit([_SET, key, value])
+
     def rem(self, key):
-        self.file_db.rem(key)
+        with self.lock:
+            del self.db[key]
+            self._commit([_REM, key])
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''
+        updates in the block are committed as one log record, all or none of them survive a crash
+        '''
+        with self.lock:
+            if self.batch_records is not None:
+                yield
+                return
+
+            self.batch_records = []
+            try:
+                yield
+            finally:
+                records = self.batch_records
+                self.batch_records = None
+                if records:
+                    self._commit([_BATCH, records])
 
     def get_all(self):
-        return self.file_db.db
+        return self.db
+
+    def compact(self):
+        with self.lock:
+            tmp = self.file_path + '.tmp'
+            with open(tmp, 'wb') as fd:
+                simplejson.dump(self.db, fd)
+                fd.flush()
+                os.fsync(fd.fileno())
+            os.rename(tmp, self.file_path)
+
+            self.log.truncate(0)
+            self.log.seek(0)
+            os.fsync(self.log.fileno())
+            self.log_records = 0
 
     def close(self):
-        self.file_db.close()
+        with self.lock:
+            if self.log is None:
+                return
+            self.log.flush()
+            os.fsync(self.log.fileno())
+            self.log.close()
+            self.log = None
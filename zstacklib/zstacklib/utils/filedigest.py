@@ -0,0 +1,131 @@
+'''
+
+@author: frank
+'''
+import Queue
+import hashlib
+import io
+import mmap
+import os
+import threading
+import zlib
+
+from zstacklib.utils import log
+
+logger = log.get_logger(__name__)
+
+# large reads aligned to pages, which O_DIRECT requires
+CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_WORKERS = 4
+
+MD5 = 'md5'
+SHA1 = 'sha1'
+# checksums much cheaper than md5, good enough to verify copies inside a cluster
+ADLER32 = 'adler32'
+CRC32 = 'crc32'
+ALGORITHMS = [MD5, SHA1, ADLER32, CRC32]
+
+class _Checksum(object):
+    def __init__(self, func):
+        self.func = func
+        self.value = func('')
+
+    def update(self, data):
+        self.value = self.func(data, self.value)
+
+    def hexdigest(self):
+        return '%08x' % (self.value & 0xffffffff)
+
+def new_digest(algorithm=MD5):
+    if algorithm == ADLER32:
+        return _Checksum(zlib.adler32)
+    if algorithm == CRC32:
+        return _Checksum(zlib.crc32)
+    if algorithm in (MD5, SHA1):
+        return hashlib.new(algorithm)
+    raise ValueError('unknown digest algorithm[%s], supported are %s' % (algorithm, ALGORITHMS))
+
+class Progress(object):
+    '''
+    bytes hashed so far, shared by the workers
+    '''
+    def __init__(self, total=0):
+        self.total = total
+        self.done = 0
+        self.lock = threading.Lock()
+
+    def add(self, n):
+        with self.lock:
+            self.done += n
+
+    def percent(self):
+        if not self.total:
+            return 100
+        return min(self.done * 100 / self.total, 100)
+
+def _open(path, direct):
+    if direct and hasattr(os, 'O_DIRECT'):
+        try:
+            return os.open(path, os.O_RDONLY | os.O_DIRECT)
+        except OSError:
+            # e.g. tmpfs doesn't support O_DIRECT
+            logger.debug('cannot open %s with O_DIRECT, read it through page cache' % path)
+    return os.open(path, os.O_RDONLY)
+
+def hash_file(path, algorithm=MD5, progress=None, direct=False):
+    digest = new_digest(algorithm)
+    # an anonymous mmap is page aligned, reading into it works with O_DIRECT
+    buf = mmap.mmap(-1, CHUNK_SIZE)
+    f = io.FileIO(_open(path, direct), 'r', closefd=True)
+    try:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+
+            # hashlib releases the GIL on large updates, workers really hash in parallel
+            digest.update(buffer(buf, 0, n))
+            if progress:
+                progress.add(n)
+    finally:
+        f.close()
+        buf.close()
+
+    return digest.hexdigest()
+
+def hash_files(paths, algorithm=MD5, workers=DEFAULT_WORKERS, progress=None, direct=False):
+    '''
+    hashes files by at most workers threads
+
+    :return: digests in the order of paths
+    '''
+    new_digest(algorithm)
+    results = [None] * len(paths)
+    errors = []
+    todo = Queue.Queue()
+    for i, path in enumerate(paths):
+        todo.put((i, path))
+
+    def work():
+        while not errors:
+            try:
+                i, path = todo.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                results[i] = hash_file(path, algorithm, progress, direct)
+            except Exception as e:
+                logger.warn('failed to hash %s, %s' % (path, e))
+                errors.append(e)
+
+    threads = [threading.Thread(target=work) for _ in range(max(min(workers, len(paths)), 1))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+    return results
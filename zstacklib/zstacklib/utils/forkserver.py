@@ -0,0 +1,65 @@
+'''
+
+@author: frank
+'''
+import marshal
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+# runs as a small separate process started by shell.enable_fork_server(), forking it is much
+# cheaper than forking an agent with a large heap. Only the standard library is imported here.
+#
+# a client connects to the unix socket, sends marshal.dumps((argv, cwd, stdin)) and shuts down
+# writing, then reads marshal.dumps((return_code, stdout, stderr, error)) until EOF. stdin None
+# means the command inherits stdin of the server, error is set when the command can't start
+
+def _recv_all(sock):
+    chunks = []
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return ''.join(chunks)
+        chunks.append(data)
+
+def _handle(conn):
+    try:
+        try:
+            argv, cwd, stdin = marshal.loads(_recv_all(conn))
+            p = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 stdin=subprocess.PIPE if stdin is not None else None, close_fds=True, cwd=cwd)
+            out, err = p.communicate(stdin)
+            result = (p.returncode, out, err, None)
+        except Exception as e:
+            result = (None, '', '', str(e))
+        conn.sendall(marshal.dumps(result))
+    finally:
+        conn.close()
+
+def serve(path, parent_pid):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(128)
+    server.settimeout(1)
+    # quit with the agent
+    while os.getppid() == parent_pid:
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            continue
+
+        conn.settimeout(None)
+        t = threading.Thread(target=_handle, args=(conn,))
+        t.daemon = True
+        t.start()
+
+if __name__ == '__main__':
+    # commands get the environment of the agent
+    pythonpath = os.environ.pop('FORK_SERVER_PYTHONPATH', '')
+    if pythonpath:
+        os.environ['PYTHONPATH'] = pythonpath
+    else:
+        os.environ.pop('PYTHONPATH', None)
+    serve(sys.argv[1], int(sys.argv[2]))
@@ -0,0 +1,43 @@
+'''
+
+@author: frank
+'''
+import threading
+
+# upper bounds in seconds, from fast sync calls to volume copies
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800, float('inf'))
+
+class Histogram(object):
+    '''
+    counts observed values in buckets the way prometheus histograms do
+    '''
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def get_stats(self):
+        '''
+        :return: {'count', 'sum', 'max', 'buckets': [(upper bound, cumulative count), ...]}, bounds
+                 are strings ending with '+Inf' as HistogramMetricFamily of prometheus takes them
+        '''
+        with self.lock:
+            cumulative = []
+            total = 0
+            for bound, n in zip(self.buckets, self.counts):
+                total += n
+                cumulative.append(('+Inf' if bound == float('inf') else str(bound), total))
+            return {'count': self.count, 'sum': self.sum, 'max': self.max, 'buckets': cumulative}
@@ -10,11 +10,16 @@ import cherrypy
 import thread
 
 import os
+import threading
+import time
 import urllib3
+from zstacklib.utils import evhttp
+from zstacklib.utils import histogram
 from zstacklib.utils import jsonobject
 from zstacklib.utils import log
 from zstacklib.utils import linux
 from zstacklib.utils import debug
+from zstacklib.utils import shell
 
 TASK_UUID = 'taskuuid'
 ERROR_CODE = 'error'
@@ -22,25 +27,111 @@ REQUEST_HEADER = 'header'
 REQUEST_BODY = 'body'
 CALLBACK_URI = 'callbackurl'
 
+# the callbacks to the management nodes share one keep-alive pool per host,
+# connections beyond POOL_MAXSIZE are opened on demand and closed after use
+POOL_NUM_HOSTS = 10
+POOL_MAXSIZE = 20
+POST_TIMEOUT = 120.0
+# connection failures retried within one attempt of json_post, the sleeps between them add
+# up to about a second; wait_callback_success() retries the attempts for the long run
+POST_RETRIES = 3
+POST_RETRY_BACKOFF = 0.2
+POST_RETRY_BACKOFF_MAX = 1.0
+
+# async requests are executed by bounded worker pools, a request is rejected
+# with 503 when the queue of its pool is full. ping has its own pool so that
+# it is never stuck behind long running requests like volume copies
+DEFAULT_ASYNC_POOL = 'default'
+FAST_ASYNC_POOL = 'fast'
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 10
+RETRY_AFTER_SECONDS = 5
+
+# handler/queue/callback time of every uri, as json
+DEBUG_STATS_PATH = '/debug/stats'
+# time of shell commands by executable and the slowest recent ones, as json. The request
+# body may give {"top": n, "endpoint": uri} to list the n slowest issued by the uri
+DEBUG_SHELL_PATH = '/debug/shell'
+
+# HTTP_SERVER_BACKEND selects the server of HttpServer. cherrypy holds a thread of its
+# POOLSIZE pool for every connection; eventloop serves all connections in one epoll loop
+# and runs sync handlers by a pool of POOLSIZE workers, except the inline ones like echo
+# which run on the loop. Raw uris need cherrypy, a server having them stays on cherrypy
+CHERRYPY_BACKEND = 'cherrypy'
+EVENT_LOOP_BACKEND = 'eventloop'
+
 logger = log.get_logger(__name__)
 debug.install_runtime_tracedumper()
 
+class UriStats(object):
+    '''
+    time requests of a uri spend waiting in the async pool, in the handler and posting the callback
+    '''
+    def __init__(self):
+        self.queue_time = histogram.Histogram()
+        self.handler_time = histogram.Histogram()
+        self.callback_time = histogram.Histogram()
+        self.in_flight = 0
+        self.errors = 0
+        self.callback_errors = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def enter(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def leave(self, failed=False):
+        with self.lock:
+            self.in_flight -= 1
+            if failed:
+                self.errors += 1
+
+    def reject(self):
+        with self.lock:
+            self.in_flight -= 1
+            self.rejected += 1
+
+    def callback_failed(self):
+        with self.lock:
+            self.callback_errors += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = {
+                'in_flight': self.in_flight,
+                'errors': self.errors,
+                'callback_errors': self.callback_errors,
+                'rejected': self.rejected,
+            }
+        stats['queue_time'] = self.queue_time.get_stats()
+        stats['handler_time'] = self.handler_time.get_stats()
+        stats['callback_time'] = self.callback_time.get_stats()
+        return stats
+
 class SyncUri(object):
     def __init__(self):
         self.uri = None
         self.func = None
         self.controller = None
+        self.stats = UriStats()
+        # the handler never blocks, the event loop backend runs it on the loop
+        self.inline = False
 
 class RawUri(object):
     def __init__(self):
         self.uri = None
         self.func = None
         self.controller = None
+        self.stats = UriStats()
 
 class AsyncUri(SyncUri):
     def __init__(self):
         super(AsyncUri, self).__init__()
         self.callback_uri = None
+        self.pool = None
+        self.priority = PRIORITY_NORMAL
 
 class Request(object):
     def __init__(self):
@@ -67,22 +158,40 @@ class SyncUriHandler(object):
         self.uri_obj = uri_obj
     
     def _do_index(self, req):
-        task_uuid = cherrypy.request.headers.get(TASK_UUID)
-        if task_uuid:
-            err = '[ERROR]: find async task uuid[%s] in header, did you wrongly register sync uri for async call???' % task_uuid
-            logger.debug(err)
-            raise Exception(err)
-
         entity = {REQUEST_HEADER : req.headers}
         entity[REQUEST_BODY] = req.body if req.body else None
-        return self.uri_obj.func(entity)     
+        with shell.trace_endpoint(self.uri_obj.uri):
+            return self.uri_obj.func(entity)     
+
+    def handle(self, req):
+        '''
+        serves a request for both backends
+
+        :return: (status, headers, body)
+        '''
+        logger.debug('sync http call: %s' % req.body)
+        stats = self.uri_obj.stats
+        stats.enter()
+        start = time.time()
+        failed = True
+        try:
+            task_uuid = req.headers.get(TASK_UUID)
+            if task_uuid:
+                err = '[ERROR]: find async task uuid[%s] in header, did you wrongly register sync uri for async call???' % task_uuid
+                logger.debug(err)
+                raise Exception(err)
+
+            rsp = self._do_index(req)
+            self._check_response(rsp)
+            failed = False
+            return 200, None, rsp
+        finally:
+            stats.handler_time.observe(time.time() - start)
+            stats.leave(failed)
     
     @cherrypy.expose
     def index(self):
-        req = Request.from_cherrypy_request(cherrypy.request)
-        logger.debug('sync http call: %s' % req.body)
-        rsp = self._do_index(req)
-        self._check_response(rsp)
+        _, _, rsp = self.handle(Request.from_cherrypy_request(cherrypy.request))
         return rsp
 
 class RawUriHandler(object):
@@ -93,13 +202,22 @@ class RawUriHandler(object):
     @cherrypy.expose
     def index(self):
         logger.debug('raw http handler: %s' % self.uri_obj.uri)
+        stats = self.uri_obj.stats
+        stats.enter()
+        start = time.time()
+        failed = False
         try:
-            return self.uri_obj.func(cherrypy.request)
+            with shell.trace_endpoint(self.uri_obj.uri):
+                return self.uri_obj.func(cherrypy.request)
         except Exception as e:
+            failed = True
             content = traceback.format_exc()
             logger.warn('[WARN]: %s]' % content)
             cherrypy.response.status = 500
             return str(e)
+        finally:
+            stats.handler_time.observe(time.time() - start)
+            stats.leave(failed)
 
 class AsyncUirHandler(SyncUriHandler):
     HANDLER_COUNTER = thread.AtomicInteger(0)
@@ -108,21 +226,34 @@ class AsyncUirHandler(SyncUriHandler):
     def __init__(self, uri_obj):
         super(AsyncUirHandler, self).__init__(uri_obj)
     
-    @thread.AsyncThread
-    def _run_index(self, task_uuid, request):
-        callback_uri = self._get_callback_uri(request)
-        headers = {TASK_UUID : task_uuid}
+    def _run_index(self, task_uuid, request, queued_at):
+        stats = self.uri_obj.stats
+        start = time.time()
+        stats.queue_time.observe(start - queued_at)
+        failed = False
         try:
-            content = super(AsyncUirHandler, self)._do_index(request)
-            self._check_response(content)
-        except Exception:
-            content = traceback.format_exc()
-            logger.warn('[WARN]: %s]' % content)
-            headers[ERROR_CODE] = content
-
-        try:
-            json_post(callback_uri, content, headers)
+            callback_uri = self._get_callback_uri(request)
+            headers = {TASK_UUID : task_uuid}
+            try:
+                content = super(AsyncUirHandler, self)._do_index(request)
+                self._check_response(content)
+            except Exception:
+                failed = True
+                content = traceback.format_exc()
+                logger.warn('[WARN]: %s]' % content)
+                headers[ERROR_CODE] = content
+            stats.handler_time.observe(time.time() - start)
+
+            callback_start = time.time()
+            try:
+                json_post(callback_uri, content, headers)
+            except Exception:
+                stats.callback_failed()
+                raise
+            finally:
+                stats.callback_time.observe(time.time() - callback_start)
         finally:
+            stats.leave(failed)
             self.HANDLER_COUNTER.dec()
         
     def _get_callback_uri(self, req):
@@ -137,23 +268,41 @@ class AsyncUirHandler(SyncUriHandler):
         
         return callback_uri
         
-    @cherrypy.expose
-    def index(self):
+    def handle(self, req):
         if self.STOP_WORLD:
             err = 'kvmagent is stopping'
             logger.warn(err)
-            raise cherrypy.HTTPError(400, err)
+            return 400, None, err
 
-        if not cherrypy.request.headers.has_key(TASK_UUID):
+        if not req.headers.has_key(TASK_UUID):
             err = 'taskUuid missing in request header'
             logger.warn(err)
-            raise cherrypy.HTTPError(400, err)
+            return 400, None, err
 
         self.HANDLER_COUNTER.inc()
-        task_uuid = cherrypy.request.headers[TASK_UUID]
-        req = Request.from_cherrypy_request(cherrypy.request)
+        self.uri_obj.stats.enter()
+        task_uuid = req.headers[TASK_UUID]
+        if not self.uri_obj.pool.submit(self._run_index, (task_uuid, req, time.time()), priority=self.uri_obj.priority):
+            self.HANDLER_COUNTER.dec()
+            self.uri_obj.stats.reject()
+            err = 'too many requests queued in pool[%s], rejected async http call[task uuid: %s, uri: %s]' % \
+                  (self.uri_obj.pool.name, task_uuid, self.uri_obj.uri)
+            logger.warn(err)
+            return 503, {'Retry-After': str(RETRY_AFTER_SECONDS)}, err
+
         logger.debug('async http call[task uuid: %s], body: %s' % (task_uuid, req.body))
-        self._run_index(task_uuid, req)
+        return 200, None, None
+
+    @cherrypy.expose
+    def index(self):
+        status, headers, body = self.handle(Request.from_cherrypy_request(cherrypy.request))
+        if status == 400:
+            raise cherrypy.HTTPError(400, body)
+
+        if status != 200:
+            cherrypy.response.status = status
+            cherrypy.response.headers.update(headers)
+        return body
 
 def tool_disable_multipart_preprocessing():
     """A cherrypy Tool extension to disable default multipart processing"""
@@ -178,22 +327,71 @@ class HttpServer(object):
         self.logfile_path = log.get_logfile_path()
         self.port = port
         self.mapper = None
-    
-    def register_async_uri(self, uri, func, callback_uri=None):
+        self.backend = os.getenv('HTTP_SERVER_BACKEND', CHERRYPY_BACKEND)
+        self.async_pools = {}
+        self.add_async_pool(DEFAULT_ASYNC_POOL, int(os.getenv('ASYNC_POOLSIZE', '100')),
+                            int(os.getenv('ASYNC_QUEUESIZE', '1000')))
+        self.add_async_pool(FAST_ASYNC_POOL, 10, 1000)
+        self.register_sync_uri(DEBUG_STATS_PATH, self._get_debug_stats, inline=True)
+        self.register_sync_uri(DEBUG_SHELL_PATH, self._get_debug_shell, inline=True)
+
+    def add_async_pool(self, name, max_workers, max_queue_size):
+        self.async_pools[name] = thread.WorkerPool(name, max_workers, max_queue_size)
+
+    def get_async_pool_stats(self):
+        return dict([(name, pool.get_stats()) for name, pool in self.async_pools.items()])
+
+    def get_uri_stats(self):
+        '''
+        :return: {uri: UriStats.get_stats()} of all registered uris
+        '''
+        stats = {}
+        for handlers in (self.async_uri_handlers, self.sync_uri_handlers, self.raw_uri_handlers):
+            for uri, uri_obj in handlers.items():
+                stats[uri] = uri_obj.stats.get_stats()
+        return stats
+
+    def _get_debug_stats(self, req):
+        return jsonobject.dumps({
+            'uris': self.get_uri_stats(),
+            'async_pools': self.get_async_pool_stats(),
+            'connection_pools': get_connection_pool_stats(),
+        }, pretty=True)
+
+    def _get_debug_shell(self, req):
+        cmd = jsonobject.loads(req[REQUEST_BODY]) if req[REQUEST_BODY] else None
+        top = cmd.top if cmd and cmd.top else shell.TOP_SLOWEST
+        return jsonobject.dumps({
+            'executables': shell.get_call_stats(),
+            'slowest': shell.get_slowest_commands(top, cmd.endpoint if cmd else None),
+        }, pretty=True)
+
+    def register_async_uri(self, uri, func, callback_uri=None, pool=None, priority=None):
+        if pool is None:
+            pool = FAST_ASYNC_POOL if uri.rstrip('/').endswith('/ping') else DEFAULT_ASYNC_POOL
+        if priority is None:
+            priority = PRIORITY_HIGH if pool == FAST_ASYNC_POOL else PRIORITY_NORMAL
+
         async_uri_obj = AsyncUri()
         async_uri_obj.callback_uri = callback_uri
         if async_uri_obj.callback_uri is None:
             async_uri_obj.callback_uri = self.async_callback_uri
         async_uri_obj.uri = uri
         async_uri_obj.func = func
+        async_uri_obj.pool = self.async_pools[pool]
+        async_uri_obj.priority = priority
         async_uri_obj.controller = AsyncUirHandler(async_uri_obj)
         
         self.async_uri_handlers[uri] = async_uri_obj
     
-    def register_sync_uri(self, uri, func):
+    def register_sync_uri(self, uri, func, inline=None):
+        if inline is None:
+            inline = uri.rstrip('/').endswith('/echo')
+
         sync_uri = SyncUri()
         sync_uri.func = func
         sync_uri.uri = uri 
+        sync_uri.inline = inline
         sync_uri.controller = SyncUriHandler(sync_uri)
         self.sync_uri_handlers[uri] = sync_uri
         
@@ -266,7 +464,32 @@ class HttpServer(object):
         self.server.log.access_log = logger
         self.server.log.error_log = logger
 
+    def _route(self, req):
+        path = req.path.rstrip('/')
+        uri_obj = self.async_uri_handlers.get(path) or self.async_uri_handlers.get(path + '/')
+        if uri_obj:
+            # only queues the request to its async pool
+            return uri_obj.controller.handle, True
+
+        uri_obj = self.sync_uri_handlers.get(path) or self.sync_uri_handlers.get(path + '/')
+        if uri_obj:
+            return uri_obj.controller.handle, uri_obj.inline
+
+        return None
+
+    def _start_event_loop(self):
+        self.server = evhttp.EventLoopServer(self.port, self._route, workers=int(os.getenv('POOLSIZE', '10')))
+        self.server.serve_forever()
+
     def start(self):
+        if self.backend == EVENT_LOOP_BACKEND and self.raw_uri_handlers:
+            logger.warn('raw uris %s need the cherrypy backend, not use the event loop backend' % self.raw_uri_handlers.keys())
+            self.backend = CHERRYPY_BACKEND
+
+        if self.backend == EVENT_LOOP_BACKEND:
+            self._start_event_loop()
+            return
+
         self._build()
         cherrypy.quickstart(self.server)
         
@@ -284,14 +507,61 @@ class HttpServer(object):
         return params
     
     def stop(self):
+        if self.backend == EVENT_LOOP_BACKEND:
+            self.server.stop()
+            return
+
         cherrypy.engine.exit()
 
-def json_post(uri, body=None, headers={}, method='POST', fail_soon=False):
+_pool_manager = None
+_pool_manager_lock = threading.Lock()
+
+def _get_pool_manager():
+    global _pool_manager
+    if _pool_manager is None:
+        with _pool_manager_lock:
+            if _pool_manager is None:
+                _pool_manager = urllib3.PoolManager(num_pools=POOL_NUM_HOSTS, maxsize=POOL_MAXSIZE, block=False)
+    return _pool_manager
+
+class _PostRetry(urllib3.util.retry.Retry):
+    # the default caps a sleep at 120 seconds
+    BACKOFF_MAX = POST_RETRY_BACKOFF_MAX
+
+def _post_retries(fail_soon):
+    # fail_soon callers get the error without sleeping between the retries
+    return _PostRetry(POST_RETRIES, backoff_factor=0 if fail_soon else POST_RETRY_BACKOFF)
+
+def get_connection_pool_stats():
+    """
+    :return: a dict of host url -> counters of the keep-alive pool to that host,
+             'reused' is the number of requests that didn't open a new connection
+    """
+    stats = {}
+    pools = _get_pool_manager().pools
+    for key in pools.keys():
+        try:
+            pool = pools[key]
+        except KeyError:
+            continue
+
+        scheme, host, port = key
+        stats['%s://%s:%s' % (scheme, host, port)] = {
+            'connections': pool.num_connections,
+            'requests': pool.num_requests,
+            'reused': max(pool.num_requests - pool.num_connections, 0),
+            # the queue is pre-filled with None placeholders, count real connections only
+            'idle': len([c for c in list(pool.pool.queue) if c]) if pool.pool else 0,
+        }
+    return stats
+
+def json_post(uri, body=None, headers={}, method='POST', fail_soon=False, timeout=POST_TIMEOUT):
     ret = []
     def post(_):
         try:
-            pool = urllib3.PoolManager(timeout=120.0, retries=urllib3.util.retry.Retry(15))
-            header = {'Content-Type': 'application/json', 'Connection': 'close'}
+            pool = _get_pool_manager()
+            retries = _post_retries(fail_soon)
+            header = {'Content-Type': 'application/json'}
             content = None
             for k in headers.keys():
                 header[k] = headers[k]
@@ -299,16 +569,14 @@ def json_post(uri, body=None, headers={}, method='POST', fail_soon=False):
             if body is not None:
                 assert isinstance(body, types.StringType)
                 header['Content-Length'] = str(len(body))
-                resp = pool.urlopen(method, uri, headers=header, body=str(body))
-                content = resp.data
-                resp.close()
+                resp = pool.urlopen(method, uri, headers=header, body=str(body), timeout=timeout, retries=retries)
             else:
                 header['Content-Length'] = '0'
-                resp = pool.urlopen(method, uri, headers=header)
-                content = resp.data
-                resp.close()
+                resp = pool.urlopen(method, uri, headers=header, timeout=timeout, retries=retries)
 
-            pool.clear()
+            # reading all data returns the connection to the pool for reuse
+            content = resp.data
+            resp.release_conn()
             ret.append(content)
             return True
         except Exception as e:
@@ -327,17 +595,17 @@ def json_post(uri, body=None, headers={}, method='POST', fail_soon=False):
     return ret[0]
 
 
-def json_dump_post(uri, body=None, headers={}, fail_soon=False):
+def json_dump_post(uri, body=None, headers={}, fail_soon=False, timeout=POST_TIMEOUT):
     content = None
     if body is not None:
         content = jsonobject.dumps(body)
-    return json_post(uri, content, headers, fail_soon=fail_soon)
+    return json_post(uri, content, headers, fail_soon=fail_soon, timeout=timeout)
 
-def json_dump_get(uri, body=None, headers={}, fail_soon=False):
+def json_dump_get(uri, body=None, headers={}, fail_soon=False, timeout=POST_TIMEOUT):
     content = None
     if body is not None:
         content = jsonobject.dumps(body)
-    return json_post(uri, content, headers, 'GET', fail_soon=fail_soon)
+    return json_post(uri, content, headers, 'GET', fail_soon=fail_soon, timeout=timeout)
 
 class LimitedSizedReader(cherrypy._cpreqbody.SizedReader):
     maxlinesize = 16 << 20 # 16 MB
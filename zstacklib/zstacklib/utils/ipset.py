@@ -3,16 +3,26 @@
 @author: MaJin
 '''
 import os
+import string
 import tempfile
+import time
 
 from zstacklib.utils import shell
 from zstacklib.utils import linux
 from zstacklib.utils import log
 from zstacklib.utils import ordered_set
-from pyparsing import *
 
 logger = log.get_logger(__name__)
 
+_ENTRY_ADDRESS_CHARS = frozenset(string.digits + './')
+
+# a cached view is trusted for this long, after that the set is swapped in fully again
+# in case it was changed behind us
+SET_VIEW_TTL = 600
+
+# (namespace, set name) -> SetView of what was restored to the kernel last time
+_set_views = {}
+
 
 class IPSetError(Exception):
     '''ipset error'''
@@ -85,6 +95,36 @@ class IPSet(object):
         option = ['', '--exist'][is_exist]
         return 'create %s %s family %s %s' % (self.name, self.type, self.ip_version, option)
 
+    def delta_cmd_list(self, view):
+        '''
+        :return: ipset restore commands turning the set described by view into this set
+        '''
+        match_ip = set(self.match_ip or [])
+        nomatch_ip = set(self.nomatch_ip or [])
+        cmds = ['del %s %s' % (self.name, ip) for ip in view.match_ip - match_ip]
+        cmds.extend(['del %s %s' % (self.name, ip) for ip in view.nomatch_ip - nomatch_ip])
+        cmds.extend(['add %s %s' % (self.name, ip) for ip in match_ip - view.match_ip])
+        cmds.extend(['add %s %s nomatch' % (self.name, ip) for ip in nomatch_ip - view.nomatch_ip])
+        return cmds
+
+    def swap_cmd_list(self):
+        '''
+        :return: ipset restore commands filling a temporary set and swapping it in, so the set
+                 is never seen empty or half filled like with flush and add
+        '''
+        # set names are up to 31 chars
+        tmp_name = '%s-t' % self.name[:29]
+        tmp = IPSet(tmp_name, self.type, self.ip_version)
+        tmp.match_ip = self.match_ip
+        tmp.nomatch_ip = self.nomatch_ip
+
+        cmds = [tmp._create_set_cmd(), 'flush %s' % tmp_name]
+        cmds.extend(tmp._add_ip_cmd_list())
+        cmds.append(self._create_set_cmd())
+        cmds.append('swap %s %s' % (tmp_name, self.name))
+        cmds.append('destroy %s' % tmp_name)
+        return cmds
+
     def _add_ip_cmd_list(self, is_exist=True):
         option = ['', '--exist'][is_exist]
         match_cmd = ['add %s %s %s' % (self.name, ip, option) for ip in self.match_ip]
@@ -94,6 +134,25 @@ class IPSet(object):
         return cmd
 
 
+class SetView(object):
+    '''
+    what a set holds in the kernel
+    '''
+    def __init__(self, ipset):
+        self.type = ipset.type
+        self.ip_version = ipset.ip_version
+        self.match_ip = frozenset(ipset.match_ip or [])
+        self.nomatch_ip = frozenset(ipset.nomatch_ip or [])
+        self.created = time.time()
+
+    def same_set(self, other):
+        return (self.type, self.ip_version, self.match_ip, self.nomatch_ip) == \
+               (other.type, other.ip_version, other.match_ip, other.nomatch_ip)
+
+    def size(self):
+        return len(self.match_ip) + len(self.nomatch_ip)
+
+
 class IPSetManager(object):
     LIST_SET = 'list:set'
     HASH_NET_IFACE = 'hash:net,iface'
@@ -114,7 +173,6 @@ class IPSetManager(object):
     def __init__(self, namespace=None):
         self.namespace = namespace
         self.sets = {}
-        self._parser = None
 
     def create_set(self, match_ips=None, nomatch_ips=None, name=DEFAULT_NAME, set_type=DEFAULT_TYPE,
                    ip_version=DEFAULT_IP_VERSION):
@@ -150,6 +208,10 @@ class IPSetManager(object):
 
     @staticmethod
     def clean_ipsets(ipset_names):
+        # the restore stops at the first set failed to destroy, forget all of them
+        for set_name in ipset_names:
+            _set_views.pop((None, set_name), None)
+
         destroy_cmds = ['destroy %s' % set_name for set_name in ipset_names]
         tmp = linux.write_to_temp_file('\n'.join(destroy_cmds))
         o = shell.ShellCmd('ipset restore -f %s' % tmp)
@@ -161,59 +223,36 @@ class IPSetManager(object):
         os.remove(tmp)
 
     def refresh_my_ipsets(self):
-        (tmp_fd, tmp_path) = tempfile.mkstemp()
-        tmp_fd = os.fdopen(tmp_fd, 'w')
-        for name, ipset in self.sets.items():
-            tmp_fd.write(ipset.transform_cmd())
-        tmp_fd.close()
-
-        execns = ''
-        if self.namespace:
-            execns = 'ip netns exec %s ' % self.namespace
-
-        o = shell.ShellCmd(execns + 'ipset restore -f %s' % tmp_path)
-        o(False)
-        os.remove(tmp_path)
-        if o.return_code != 0:
-            raise IPSetError('ipset restore failed, because %s' % o.stderr)
-        logger.debug('success restore ipset')
-
-    def _parse_set_action(self, tokens):
-        set_name = tokens[1]
-        set_type = '%s:%s' % (tokens[2], tokens[4])
-        ip_version = tokens[6]
-        self.create_set(name=set_name, set_type=set_type, ip_version=ip_version)
-
-    def _parse_entry_action(self, tokens):
-        set_name = tokens[1]
-        ip = tokens[2]
-        if set_name not in self.sets.keys():
-            self.create_set(name=set_name)
-        self.sets[set_name].add_match_ip(ip)
-
-    def _construct_pyparsing(self):
-        if self._parser:
-            return
-
-        set_name = Word(printables)
-        set_type = Word(alphas) + Word(':') + Word(alphas + ',')
-
-        sets = Literal('create') + set_name + set_type + Literal('family') + Word(alphanums) + restOfLine
-        sets.setParseAction(self._parse_set_action)
-
-        entry = Literal('add') + set_name + Word(nums + './')
-        entry.setParseAction(self._parse_entry_action)
-
-        self._parser = sets | entry
+        refresh_ipsets([self])
 
     def _from_ipset_save(self, txt):
         self.reset()
-        self._construct_pyparsing()
         for l in txt.splitlines():
-            l = l.strip('\n').strip('\r').strip('\t').strip()
-            if not l:
+            tokens = l.split()
+            if not tokens:
                 continue
-            self._parser.parseString(l)
+
+            if tokens[0] == 'add' and len(tokens) > 2:
+                ip = tokens[2]
+                # like the former pyparsing grammar, only the address part of entries like 10.0.0.1,tcp:80 is kept
+                end = 0
+                while end < len(ip) and ip[end] in _ENTRY_ADDRESS_CHARS:
+                    end += 1
+                if end:
+                    ip = ip[:end]
+
+                ipset = self.sets.get(tokens[1])
+                if ipset is None:
+                    self.create_set(name=tokens[1])
+                    ipset = self.sets[tokens[1]]
+                ipset.add_match_ip(ip)
+            elif tokens[0] == 'create' and len(tokens) > 2:
+                ip_version = self.DEFAULT_IP_VERSION
+                if 'family' in tokens[3:-1]:
+                    ip_version = tokens[tokens.index('family', 3) + 1]
+                self.create_set(name=tokens[1], set_type=tokens[2], ip_version=ip_version)
+            else:
+                raise IPSetError('unrecognized line in ipset save output: %s' % l)
 
 def from_ipset_save():
     logger.debug('start load ipset ...')
@@ -221,3 +260,85 @@ def from_ipset_save():
     ipset.ipset_save()
     logger.debug('success load ipset ...')
     return ipset
+
+def _make_refresh_cmd_list(ipset, view):
+    new_view = SetView(ipset)
+    if view is None or (view.type, view.ip_version) != (new_view.type, new_view.ip_version) \
+            or time.time() - view.created > SET_VIEW_TTL:
+        return ipset.swap_cmd_list(), new_view
+
+    if view.same_set(new_view):
+        # nothing changed, keep the age of the view
+        return [], view
+
+    cmds = ipset.delta_cmd_list(view)
+    if len(cmds) > new_view.size():
+        # the set is mostly replaced, filling a new one is cheaper
+        return ipset.swap_cmd_list(), new_view
+
+    new_view.created = view.created
+    return cmds, new_view
+
+def _restore_cmds(namespace, cmds):
+    '''
+    :return: stderr of ipset restore, or None if it succeeds
+    '''
+    (tmp_fd, tmp_path) = tempfile.mkstemp()
+    tmp_fd = os.fdopen(tmp_fd, 'w')
+    tmp_fd.write('\n'.join(cmds))
+    tmp_fd.write('\n')
+    tmp_fd.close()
+
+    execns = ''
+    if namespace:
+        execns = 'ip netns exec %s ' % namespace
+
+    o = shell.ShellCmd(execns + 'ipset restore -exist -f %s' % tmp_path)
+    o(False)
+    os.remove(tmp_path)
+    if o.return_code != 0:
+        return o.stderr
+    return None
+
+def refresh_ipsets(managers):
+    '''
+    restores the sets of all managers in one ipset restore, the managers must be in the same namespace.
+    Sets restored before only get the members added or deleted since then, others are filled
+    aside and swapped in
+    '''
+    namespace = managers[0].namespace if managers else None
+    cmds = []
+    views = {}
+    for mgr in managers:
+        for name, ipset in mgr.sets.items():
+            key = (namespace, name)
+            set_cmds, views[key] = _make_refresh_cmd_list(ipset, _set_views.get(key))
+            cmds.extend(set_cmds)
+
+    if not cmds:
+        logger.debug('no ipset changed, skip ipset restore')
+        return
+
+    err = _restore_cmds(namespace, cmds)
+    if err is not None:
+        # deltas are computed from the cached views
+        delta = bool([key for key in views.keys() if key in _set_views])
+        # part of the commands may have been applied, the views are unknown now
+        for key in views.keys():
+            _set_views.pop(key, None)
+        if not delta:
+            raise IPSetError('ipset restore failed, because %s' % err)
+
+        # a set was changed behind us, swap all of them in fully
+        logger.warn('failed to apply ipset changes, try swapping in all sets. %s' % err)
+        cmds = []
+        for mgr in managers:
+            for name, ipset in mgr.sets.items():
+                cmds.extend(ipset.swap_cmd_list())
+                views[(namespace, name)] = SetView(ipset)
+        err = _restore_cmds(namespace, cmds)
+        if err is not None:
+            raise IPSetError('ipset restore failed, because %s' % err)
+
+    _set_views.update(views)
+    logger.debug('success restore ipset with %s commands' % len(cmds))
@@ -2,17 +2,232 @@
 
 @author: frank
 '''
+import difflib
+import hashlib
 import os
 from zstacklib.utils import shell
 from zstacklib.utils import linux
 from zstacklib.utils import log
 from zstacklib.utils import ordered_set
-from pyparsing import *
 
 logger = log.get_logger(__name__)
 
 class IPTablesError(Exception):
     '''iptables error'''
+
+BUILTIN_CHAIN_NAMES = ['INPUT', 'FORWARD', 'OUTPUT', 'PREROUTING', 'POSTROUTING']
+
+# save command -> (fingerprint of the dump, snapshot parsed from it)
+_parsed_cache = {}
+
+def _fingerprint(txt):
+    # comments carry a timestamp and chain counters change all the time, neither is a rule change
+    md5 = hashlib.md5()
+    for l in txt.splitlines():
+        l = l.strip()
+        if not l or l.startswith('#'):
+            continue
+        if l.startswith(':'):
+            l = ' '.join(l.split()[:2])
+        md5.update(l)
+        md5.update('\n')
+    return md5.hexdigest()
+
+def _take_snapshot(ipt, rendered=True):
+    '''
+    :param rendered: rules rendered the same way as str(ipt), or as they are in the chains, i.e.
+                     the kernel order with duplicates right after parsing iptables-save
+    :return: [(table_name, [(chain_name, counter_str, [rule, ...]), ...]), ...]
+    '''
+    tables = []
+    for table in ipt.children:
+        chains = []
+        for chain in table.children:
+            if rendered:
+                cstr = str(chain)
+                rules = cstr.split('\n') if cstr else []
+            else:
+                rules = [str(r) for r in chain.children]
+            chains.append((chain.name, chain.counter_str, rules))
+        tables.append((table.name, chains))
+    return tables
+
+def _load_snapshot(ipt, snapshot):
+    ipt._reset()
+    for table_name, chains in snapshot:
+        ipt._create_table_if_not_exists(table_name)
+        table = ipt._current_table
+        for chain_name, counter_str, rules in chains:
+            chain = IPTableChain()
+            chain.name = chain_name
+            chain.identity = chain_name
+            chain.counter_str = counter_str
+            table.add_child(chain)
+            for r in rules:
+                rule = IPTableRule()
+                rule.name = r
+                rule.identity = r
+                chain.add_child(rule)
+    ipt._current_table = None
+
+def _refresh_counters(ipt, txt):
+    # the cached model has the counters of the dump it was parsed from
+    table = None
+    for l in txt.split('\n'):
+        l = l.strip()
+        if l.startswith('*'):
+            table = ipt.get_child_by_name(l[1:].strip())
+        elif l.startswith(':') and table:
+            name = l[1:].split(None, 1)[0]
+            chain = table.get_child_by_name(name)
+            if chain:
+                chain.counter_str = ':%s %s' % (name, l.expandtabs()[1 + len(name):])
+
+def _chain_policy(counter_str):
+    # ':INPUT ACCEPT [0:0]' -> 'ACCEPT'
+    parts = counter_str.split() if counter_str else []
+    return parts[1] if len(parts) > 1 else '-'
+
+def _diff_chain_rules(chain_name, old_rules, new_rules):
+    prefix = '-A %s ' % chain_name
+    deletes = []
+    inserts = []
+    sm = difflib.SequenceMatcher(None, old_rules, new_rules, autojunk=False)
+    for tag, i1, i2, j1, j2 in sm.get_opcodes():
+        if tag in ('replace', 'delete'):
+            deletes.extend(range(i1, i2))
+        if tag in ('replace', 'insert'):
+            inserts.extend([(j, new_rules[j]) for j in range(j1, j2)])
+
+    if len(deletes) + len(inserts) > len(new_rules) or len(set(old_rules)) != len(old_rules):
+        # rewriting the chain is cheaper; or the kernel has duplicate rules, which a full
+        # restore drops and '-D rule' can't tell apart
+        return ['-F %s' % chain_name] + new_rules
+
+    # deleting by number from the end keeps the numbers of the rules before valid. After
+    # deleting, the chain holds the common rules in order; inserting in ascending order of
+    # the new position then rebuilds the new chain
+    ops = ['-D %s %s' % (chain_name, i + 1) for i in sorted(deletes, reverse=True)]
+    ops.extend(['-I %s %s %s' % (chain_name, j + 1, r[len(prefix):]) for j, r in inserts])
+    return ops
+
+def make_noflush_diff(old_snapshot, new_snapshot):
+    '''
+    :return: lines in iptables-restore format which turn old_snapshot into new_snapshot when
+             applied with --noflush, only changed chains and rules are touched. An empty list
+             means nothing changed
+    '''
+    old_tables = dict([(t, dict([(c[0], c) for c in chains])) for t, chains in old_snapshot])
+
+    lines = []
+    for table_name, chains in new_snapshot:
+        old_chains = old_tables.get(table_name, {})
+        declares = []
+        updates = []
+        for chain_name, counter_str, rules in chains:
+            old = old_chains.get(chain_name)
+            if old is None:
+                # declaring a chain creates it, or sets the policy of a builtin chain
+                declares.append(counter_str)
+                updates.extend(rules)
+                continue
+
+            if chain_name in BUILTIN_CHAIN_NAMES and _chain_policy(old[1]) != _chain_policy(counter_str):
+                declares.append(':%s %s [0:0]' % (chain_name, _chain_policy(counter_str)))
+
+            if old[2] != rules:
+                updates.extend(_diff_chain_rules(chain_name, old[2], rules))
+
+        new_chain_names = set([c[0] for c in chains])
+        removed = [name for name in old_chains.keys()
+                   if name not in new_chain_names and name not in BUILTIN_CHAIN_NAMES]
+
+        if not declares and not updates and not removed:
+            continue
+
+        lines.append('*%s' % table_name)
+        lines.extend(declares)
+        lines.extend(updates)
+        # flush all before deleting any, removed chains may jump to each other
+        lines.extend(['-F %s' % name for name in removed])
+        lines.extend(['-X %s' % name for name in removed])
+        lines.append('COMMIT')
+
+    return lines
+
+def _parse_iptables_save(ipt, txt):
+    '''
+    line oriented parser of iptables-save/ip6tables-save output, builds the same
+    table/chain/rule nodes in one pass
+    '''
+    def new_chain(name, counter_str=None):
+        # chains are looked up in the dict, _create_chain_if_not_exists scans all chains of the table
+        ch = IPTableChain()
+        ch.name = ch.identity = name
+        ch.counter_str = counter_str or ':%s - [0:0]' % name
+        table.add_child(ch)
+        chains[name] = ch
+        return ch
+
+    ipt._reset()
+    table = None
+    chains = None
+    chain = None
+    for l in txt.split('\n'):
+        l = l.strip()
+        if not l:
+            continue
+
+        c = l[0]
+        if c == '-':
+            tokens = l.split()
+            if tokens[0] != '-A' or len(tokens) < 2 or table is None:
+                raise IPTablesError('unrecognized line in iptables-save output: %s' % l)
+            # rules of a chain are dumped together, most of time the chain is the last one
+            if chain is None or chain.name != tokens[1]:
+                chain = chains.get(tokens[1]) or new_chain(tokens[1])
+
+            rule = IPTableRule()
+            rule.name = rule.identity = ' '.join(tokens)
+            rule.parent = chain
+            chain.children.append(rule)
+        elif c == ':':
+            if table is None:
+                raise IPTablesError('unrecognized line in iptables-save output: %s' % l)
+            name = l[1:].split(None, 1)[0]
+            if name not in chains:
+                # keep the counter string the way the former pyparsing grammar did
+                rest = l.expandtabs()[1 + len(name):]
+                new_chain(name, ':%s %s' % (name, rest))
+        elif c == '*':
+            ipt._create_table_if_not_exists(l[1:].strip())
+            table = ipt._current_table
+            chains = dict([(ch.name, ch) for ch in table.children])
+            chain = None
+        elif l.startswith('COMMIT'):
+            ipt._current_table = table = chains = chain = None
+        elif c != '#':
+            raise IPTablesError('unrecognized line in iptables-save output: %s' % l)
+
+    ipt._current_table = None
+
+def _restore(restore_cmd, content, noflush=False):
+    f = linux.write_to_temp_file(content)
+    try:
+        shell.call('%s -w %s< %s' % (restore_cmd, '--noflush ' if noflush else '', f))
+    except Exception as e:
+        res = shell.call('lsof /run/xtables.lock')
+        err ='''Failed to apply rules by %s:
+shell error description:
+%s
+result of lsof /run/xtables.lock
+%s
+rules:
+%s
+''' % (restore_cmd, str(e), str(res), content)
+        raise IPTablesError(err)
+    finally:
+        os.remove(f)
     
 class Node(object):
     def __init__(self):
@@ -198,13 +413,14 @@ class IPTables(Node):
 
     def __init__(self):
         super(IPTables, self).__init__()
-        self._parser = None
         self._current_table = None
         self._filter_table = None
         self._nat_table = None
         self._mangle_table = None
         self._raw_table = None
         self._security_table = None
+        # what the kernel has according to the last iptables-save, used to compute incremental changes
+        self._snapshot = None
     
     def get_table(self, table_name=FILTER_TABLE_NAME):
         return self.get_child_by_name(table_name)
@@ -241,13 +457,6 @@ class IPTables(Node):
         else:
             assert 0, 'unknown table name: %s' % table_name
         
-    def _parse_table_action(self, tokens):
-        table_name = tokens[1]
-        self._create_table_if_not_exists(table_name)
-    
-    def _parse_commit_action(self, tokens):
-        self._current_table = None
-    
     def _create_chain_if_not_exists(self, chain_name, counter_str=None):
         chain = self._current_table.get_child_by_name(chain_name)
         if not chain:
@@ -261,14 +470,6 @@ class IPTables(Node):
             self._current_table.add_child(chain)
         return chain
         
-    def _parse_counter_action(self, tokens):
-        chain_name = tokens[1]
-        prefix = ':%s' % chain_name
-        lst = [prefix]
-        lst.extend(tokens[2:])
-        counter_str = ' '.join(lst)
-        self._create_chain_if_not_exists(chain_name, counter_str)
-    
     def _add_rule(self, chain_name, rule_identity, order=0):
         chain = self._create_chain_if_not_exists(chain_name)
         rule = IPTableRule()
@@ -279,32 +480,6 @@ class IPTables(Node):
         rule.order = order
         chain.add_child(rule)
         
-    def _parse_rule_action(self, tokens):
-        chain_name = tokens[1]
-        self._add_rule(chain_name, ' '.join(tokens))
-    
-    def _construct_pyparsing(self):
-        if self._parser:
-            return
-        
-        table = Literal('*') + Word(alphas)
-        table.setParseAction(self._parse_table_action)
-        
-        chain_name = Word(printables + '.-_+=%$#')
-        
-        counter = Literal(':') + chain_name + restOfLine
-        counter.setParseAction(self._parse_counter_action)
-        
-        comment = Literal('#') + restOfLine
-        
-        rule = Literal('-A') + chain_name + restOfLine
-        rule.setParseAction(self._parse_rule_action)
-        
-        commit = Literal('COMMIT')
-        commit.setParseAction(self._parse_commit_action)
-        
-        self._parser = table | counter | comment | rule | commit
-        
     @staticmethod
     def find_target_in_rule(rule):
         #TODO: find pyparsing way
@@ -383,19 +558,23 @@ class IPTables(Node):
         self._mangle_table = None
         
     def _from_iptables_save(self, txt):
-        self._reset()
-        self._construct_pyparsing()
-        for l in txt.split('\n'):
-            l = l.strip('\n').strip('\r').strip('\t').strip()
-            if not l:
-                continue
-            
-            self._parser.parseString(l)
-    
+        _parse_iptables_save(self, txt)
+        self._snapshot = _take_snapshot(self, rendered=False)
+
     def iptables_save(self):
         out = shell.call('/sbin/iptables-save')
+        fingerprint = _fingerprint(out)
+        cached = _parsed_cache.get('/sbin/iptables-save')
+        if cached and cached[0] == fingerprint:
+            # nothing changed since last parsing, skip parsing the dump again
+            _load_snapshot(self, cached[1])
+            _refresh_counters(self, out)
+            self._snapshot = cached[1]
+            return
+
         self._from_iptables_save(out)
-    
+        _parsed_cache['/sbin/iptables-save'] = (fingerprint, self._snapshot)
+
     def __str__(self):
         lst = []
         for table in self.children:
@@ -536,23 +715,26 @@ class IPTables(Node):
 
     def iptable_restore(self, marshall_func=None, sort_nat_func=None, sort_filter_func=None, sort_mangle_func=None):
         content = self._to_iptables_string(marshall_func, sort_nat_func, sort_filter_func, sort_mangle_func)
-        f = linux.write_to_temp_file(content)
+        if self._snapshot is None or marshall_func:
+            _restore('/sbin/iptables-restore', content)
+            self._snapshot = None
+            return
+
+        snapshot = _take_snapshot(self)
+        diff = make_noflush_diff(self._snapshot, snapshot)
+        if not diff:
+            logger.debug('no rule changed, skip /sbin/iptables-restore')
+            return
+
         try:
-            shell.call('/sbin/iptables-restore -w < %s' % f)
-        except Exception as e:
-            res = shell.call('lsof /run/xtables.lock')
-            err ='''Failed to apply iptables rules:
-shell error description:
-%s
-result of lsof /run/xtables.lock
-%s
-iptable rules:
-%s
-''' % (str(e), str(res), content)
-            raise IPTablesError(err)
-        finally:
-            os.remove(f)
-            
+            _restore('/sbin/iptables-restore', '\n'.join(diff) + '\n', noflush=True)
+        except IPTablesError as e:
+            # the kernel may have been changed behind us, apply the whole tables instead
+            logger.warn('failed to apply incremental changes, try applying all rules. %s' % str(e))
+            _restore('/sbin/iptables-restore', content)
+
+        self._snapshot = snapshot
+
     @staticmethod
     def from_iptables_save():
         ipt = IPTables()
@@ -566,11 +748,12 @@ iptable rules:
         if table_name not in [self.FILTER_TABLE_NAME, self.NAT_TABLE_NAME, self.MANGLE_TABLE_NAME]:
             raise IPTablesError('unknown table name[%s]' % table_name)
         
+        tokens = rule.split()
+        if len(tokens) < 2 or tokens[0] != '-A':
+            raise IPTablesError('invalid rule[%s], it must start with -A chain_name' % rule)
+
         self._create_table_if_not_exists(table_name)
-        chain_name = Word(printables + '-_+=%$#')
-        rule_p = Literal('-A') + chain_name + restOfLine
-        res = rule_p.parseString(rule)
-        self._add_rule(res[1], rule, order)
+        self._add_rule(tokens[1], rule, order)
     
     def remove_rule(self, rule_str):
         rule_str = self._normalize_rule(rule_str)
@@ -590,6 +773,19 @@ iptable rules:
             return
         table.delete_child_by_name(chain_name)
 
+    def delete_chains(self, chain_names, table_name=FILTER_TABLE_NAME):
+        '''
+        delete chains and all rules jumping to them, in one pass over the table
+        '''
+        table = self.get_child_by_name(table_name)
+        if not table:
+            return
+
+        chain_names = set(chain_names)
+        table.children = [c for c in table.children if c.name not in chain_names]
+        for c in table.children:
+            c.children = [r for r in c.children if self.find_target_in_rule(r) not in chain_names]
+
 class IP6Tables(Node):
     NAT_TABLE_NAME = 'nat'
     FILTER_TABLE_NAME = 'filter'
@@ -599,13 +795,14 @@ class IP6Tables(Node):
 
     def __init__(self):
         super(IP6Tables, self).__init__()
-        self._parser = None
         self._current_table = None
         self._filter_table = None
         self._nat_table = None
         self._mangle_table = None
         self._raw_table = None
         self._security_table = None
+        # what the kernel has according to the last iptables-save, used to compute incremental changes
+        self._snapshot = None
 
     def get_table(self, table_name=FILTER_TABLE_NAME):
         return self.get_child_by_name(table_name)
@@ -642,13 +839,6 @@ class IP6Tables(Node):
         else:
             assert 0, 'unknown table name: %s' % table_name
 
-    def _parse_table_action(self, tokens):
-        table_name = tokens[1]
-        self._create_table_if_not_exists(table_name)
-
-    def _parse_commit_action(self, tokens):
-        self._current_table = None
-
     def _create_chain_if_not_exists(self, chain_name, counter_str=None):
         chain = self._current_table.get_child_by_name(chain_name)
         if not chain:
@@ -662,14 +852,6 @@ class IP6Tables(Node):
             self._current_table.add_child(chain)
         return chain
 
-    def _parse_counter_action(self, tokens):
-        chain_name = tokens[1]
-        prefix = ':%s' % chain_name
-        lst = [prefix]
-        lst.extend(tokens[2:])
-        counter_str = ' '.join(lst)
-        self._create_chain_if_not_exists(chain_name, counter_str)
-
     def _add_rule(self, chain_name, rule_identity, order=0):
         chain = self._create_chain_if_not_exists(chain_name)
         rule = IPTableRule()
@@ -680,32 +862,6 @@ class IP6Tables(Node):
         rule.order = order
         chain.add_child(rule)
 
-    def _parse_rule_action(self, tokens):
-        chain_name = tokens[1]
-        self._add_rule(chain_name, ' '.join(tokens))
-
-    def _construct_pyparsing(self):
-        if self._parser:
-            return
-
-        table = Literal('*') + Word(alphas)
-        table.setParseAction(self._parse_table_action)
-
-        chain_name = Word(printables + '.-_+=%$#')
-
-        counter = Literal(':') + chain_name + restOfLine
-        counter.setParseAction(self._parse_counter_action)
-
-        comment = Literal('#') + restOfLine
-
-        rule = Literal('-A') + chain_name + restOfLine
-        rule.setParseAction(self._parse_rule_action)
-
-        commit = Literal('COMMIT')
-        commit.setParseAction(self._parse_commit_action)
-
-        self._parser = table | counter | comment | rule | commit
-
     @staticmethod
     def find_target_in_rule(rule):
         # TODO: find pyparsing way
@@ -783,18 +939,22 @@ class IP6Tables(Node):
         self._mangle_table = None
 
     def _from_iptables_save(self, txt):
-        self._reset()
-        self._construct_pyparsing()
-        for l in txt.split('\n'):
-            l = l.strip('\n').strip('\r').strip('\t').strip()
-            if not l:
-                continue
-
-            self._parser.parseString(l)
+        _parse_iptables_save(self, txt)
+        self._snapshot = _take_snapshot(self, rendered=False)
 
     def iptables_save(self):
         out = shell.call('/sbin/ip6tables-save')
+        fingerprint = _fingerprint(out)
+        cached = _parsed_cache.get('/sbin/ip6tables-save')
+        if cached and cached[0] == fingerprint:
+            # nothing changed since last parsing, skip parsing the dump again
+            _load_snapshot(self, cached[1])
+            _refresh_counters(self, out)
+            self._snapshot = cached[1]
+            return
+
         self._from_iptables_save(out)
+        _parsed_cache['/sbin/ip6tables-save'] = (fingerprint, self._snapshot)
 
     def __str__(self):
         lst = []
@@ -936,22 +1096,25 @@ class IP6Tables(Node):
 
     def iptable_restore(self, marshall_func=None, sort_nat_func=None, sort_filter_func=None, sort_mangle_func=None):
         content = self._to_iptables_string(marshall_func, sort_nat_func, sort_filter_func, sort_mangle_func)
-        f = linux.write_to_temp_file(content)
+        if self._snapshot is None or marshall_func:
+            _restore('/sbin/ip6tables-restore', content)
+            self._snapshot = None
+            return
+
+        snapshot = _take_snapshot(self)
+        diff = make_noflush_diff(self._snapshot, snapshot)
+        if not diff:
+            logger.debug('no rule changed, skip /sbin/ip6tables-restore')
+            return
+
         try:
-            shell.call('/sbin/ip6tables-restore -w < %s' % f)
-        except Exception as e:
-            res = shell.call('lsof /run/xtables.lock')
-            err = '''Failed to apply ip6tables rules:
-shell error description:
-%s
-result of lsof /run/xtables.lock
-%s
-ip6table rules:
-%s
-''' % (str(e), str(res), content)
-            raise IPTablesError(err)
-        finally:
-            os.remove(f)
+            _restore('/sbin/ip6tables-restore', '\n'.join(diff) + '\n', noflush=True)
+        except IPTablesError as e:
+            # the kernel may have been changed behind us, apply the whole tables instead
+            logger.warn('failed to apply incremental changes, try applying all rules. %s' % str(e))
+            _restore('/sbin/ip6tables-restore', content)
+
+        self._snapshot = snapshot
 
     @staticmethod
     def from_iptables_save():
@@ -966,11 +1129,12 @@ ip6table rules:
         if table_name not in [self.FILTER_TABLE_NAME, self.NAT_TABLE_NAME, self.MANGLE_TABLE_NAME]:
             raise IPTablesError('unknown table name[%s]' % table_name)
 
+        tokens = rule.split()
+        if len(tokens) < 2 or tokens[0] != '-A':
+            raise IPTablesError('invalid rule[%s], it must start with -A chain_name' % rule)
+
         self._create_table_if_not_exists(table_name)
-        chain_name = Word(printables + '-_+=%$#')
-        rule_p = Literal('-A') + chain_name + restOfLine
-        res = rule_p.parseString(rule)
-        self._add_rule(res[1], rule, order)
+        self._add_rule(tokens[1], rule, order)
 
     def remove_rule(self, rule_str):
         rule_str = self._normalize_rule(rule_str)
@@ -990,6 +1154,19 @@ ip6table rules:
             return
         table.delete_child_by_name(chain_name)
 
+    def delete_chains(self, chain_names, table_name=FILTER_TABLE_NAME):
+        '''
+        delete chains and all rules jumping to them, in one pass over the table
+        '''
+        table = self.get_child_by_name(table_name)
+        if not table:
+            return
+
+        chain_names = set(chain_names)
+        table.children = [c for c in table.children if c.name not in chain_names]
+        for c in table.children:
+            c.children = [r for r in c.children if self.find_target_in_rule(r) not in chain_names]
+
 def from_iptables_save():
     return IPTables.from_iptables_save()
 
@@ -106,17 +106,18 @@ def _parse_dict(d):
         
     return dobj
             
+def _to_json_object(d):
+    # called by the decoder for every json object, innermost first. The decoded dict
+    # becomes the attribute dict as is, there is nothing left to walk afterwards
+    obj = JsonObject()
+    obj.__dict__ = d
+    return obj
+
 def loads(jstr):
     try:
-        root = simplejson.loads(jstr)
+        return simplejson.loads(jstr, object_hook=_to_json_object)
     except Exception as e:
         raise  NoneSupportedTypeError("Cannot compile string: %s to a jsonobject" % jstr)
-    if isinstance(root, types.DictType):
-        return _parse_dict(root)
-    if isinstance(root, types.ListType):
-        return _parse_list(root)
-    else:
-        return root
 
 def _new_json_object():
     return JsonObject()
@@ -133,9 +134,20 @@ def _is_unsupported_type(obj):
 def _is_primitive_types(obj):
     return isinstance(obj, (types.BooleanType, types.LongType, types.IntType, types.FloatType, types.StringType, types.UnicodeType))
 
+# exact types checked by a set lookup before the isinstance() checks above
+_PRIMITIVE_TYPES = frozenset([types.BooleanType, types.LongType, types.IntType, types.FloatType, types.StringType, types.UnicodeType])
+
 def _dump_list(lst):
     nlst = []
     for val in lst:
+        t = type(val)
+        if t in _PRIMITIVE_TYPES or t is types.DictType:
+            nlst.append(val)
+            continue
+        elif t is JsonObject:
+            nlst.append(_dump(val))
+            continue
+
         if _is_unsupported_type(val):
             raise NoneSupportedTypeError('Cannot dump val: %s, type: %s, list dump: %s' % (val, type(val), lst))
         
@@ -165,7 +177,17 @@ def _dump(obj):
     #items = inspect.getmembers(obj)
     for key, val in items:
         if key.startswith('_'): continue
-        
+
+        t = type(val)
+        if t in _PRIMITIVE_TYPES or t is types.DictType:
+            ret[key] = val
+            continue
+        elif t is types.ListType:
+            ret[key] = _dump_list(val)
+            continue
+        elif val is None:
+            continue
+
         if _is_unsupported_type(obj):
             raise NoneSupportedTypeError('cannot dump %s, type:%s, object dict: %s' % (val, type(val), obj.__dict__))
         
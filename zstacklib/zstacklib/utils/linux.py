@@ -18,9 +18,11 @@ import threading
 import re
 import platform
 import mmap
+import collections
 
 from zstacklib.utils import shell
 from zstacklib.utils import log
+from zstacklib.utils import waiter
 
 
 logger = log.get_logger(__name__)
@@ -613,7 +615,207 @@ def sftp_get(hostname, sshkey, filename, download_to, timeout=0, interval=1, cal
         if batch_file_path:
             os.remove(batch_file_path)
 
+QCOW2_MAGIC = 'QFI\xfb'
+QCOW2_VERSIONS = [2, 3]
+QCOW2_V2_HEADER_LENGTH = 72
+QCOW2_V3_HEADER_LENGTH = 104
+# the limits qemu puts on cluster bits and backing file names
+QCOW2_CLUSTER_BITS = (9, 21)
+QCOW2_MAX_BACKING_FILE_SIZE = 1023
+QCOW2_EXT_END = 0
+QCOW2_EXT_BACKING_FORMAT = 0xE2792ACA
+# headers of formats qemu-img tells from raw, such files are left to qemu-img
+OTHER_IMG_MAGICS = ['KDMV', '# Disk DescriptorFile', 'COWD', 'conectix', 'vhdxfile', 'QED\x00', 'LUKS\xba\xbe',
+                    'WithoutFreeSpace', 'WithouFreSpacExt', 'Bochs Virtual HD Image', '#!/bin/sh\n#V2.0 Format']
+ISO_MAGIC_OFFSET = 0x8001
+ISO_MAGIC = 'CD001'
+# a raw image is told by an MBR, a zeroed first sector or an ISO 9660 volume, what has none
+# of them is left to qemu-img, which knows more formats (vdi, dmg, parallels...)
+MBR_SIGNATURE_OFFSET = 510
+MBR_SIGNATURE = '\x55\xaa'
+IMG_INFO_CACHE_SIZE = 4096
+
+class ImgInfo(object):
+    def __init__(self):
+        # qcow2 or raw
+        self.format = None
+        self.virtual_size = None
+        self.cluster_size = None
+        # as recorded in the header, a relative path is relative to the directory of the image
+        self.backing_file = None
+        self.backing_format = None
+        self.iso = False
+
+class _ImgInfoCache(object):
+    '''
+    LRU cache of parsed image headers, keyed by (device, inode, mtime, size) so a rewritten,
+    rebased or resized image is parsed again
+    '''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.infos = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            info = self.infos.pop(key, None)
+            if info is None:
+                self.misses += 1
+                return None
+
+            self.infos[key] = info
+            self.hits += 1
+            return info
+
+    def put(self, key, info):
+        with self.lock:
+            self.infos.pop(key, None)
+            self.infos[key] = info
+            while len(self.infos) > self.capacity:
+                self.infos.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.infos.clear()
+
+_img_info_cache = _ImgInfoCache(IMG_INFO_CACHE_SIZE)
+
+def _parse_qcow2_header(f, info):
+    '''
+    :return: False if it is not a qcow2 image of version 2 or 3
+    '''
+    header = f.read(QCOW2_V3_HEADER_LENGTH)
+    if len(header) < QCOW2_V2_HEADER_LENGTH:
+        return False
+
+    version, backing_file_offset, backing_file_size, cluster_bits, size = struct.unpack('>IQIIQ', header[4:32])
+    if version not in QCOW2_VERSIONS:
+        return False
+    if not QCOW2_CLUSTER_BITS[0] <= cluster_bits <= QCOW2_CLUSTER_BITS[1]:
+        return False
+    if backing_file_size > QCOW2_MAX_BACKING_FILE_SIZE:
+        return False
+
+    if version >= 3:
+        if len(header) < QCOW2_V3_HEADER_LENGTH:
+            return False
+        header_length = struct.unpack('>I', header[100:104])[0]
+        if header_length < QCOW2_V3_HEADER_LENGTH or header_length % 8:
+            return False
+        ext_offset = header_length
+    else:
+        ext_offset = QCOW2_V2_HEADER_LENGTH
+
+    info.format = 'qcow2'
+    info.virtual_size = long(size)
+    info.cluster_size = 1 << cluster_bits
+
+    if backing_file_offset:
+        f.seek(backing_file_offset)
+        info.backing_file = f.read(backing_file_size)
+
+    # header extensions end at the first cluster, or the backing file name stored after them
+    ext_end = info.cluster_size
+    if backing_file_offset:
+        ext_end = min(ext_end, backing_file_offset)
+
+    f.seek(ext_offset)
+    while ext_offset + 8 <= ext_end:
+        ext = f.read(8)
+        if len(ext) < 8:
+            break
+
+        ext_type, ext_len = struct.unpack('>II', ext)
+        if ext_type == QCOW2_EXT_END:
+            break
+
+        data = f.read(ext_len)
+        if ext_type == QCOW2_EXT_BACKING_FORMAT:
+            info.backing_format = data
+        # extension data is padded to 8 bytes
+        ext_offset += 8 + ((ext_len + 7) & ~7)
+        f.seek(ext_offset)
+    return True
+
+def _parse_raw(f, head, size, info):
+    '''
+    :return: False if it is not clearly a raw image
+    '''
+    if size > ISO_MAGIC_OFFSET + len(ISO_MAGIC):
+        f.seek(ISO_MAGIC_OFFSET)
+        info.iso = f.read(len(ISO_MAGIC)) == ISO_MAGIC
+
+    if not info.iso and head.strip('\0') and \
+            head[MBR_SIGNATURE_OFFSET:MBR_SIGNATURE_OFFSET + len(MBR_SIGNATURE)] != MBR_SIGNATURE:
+        return False
+
+    info.format = 'raw'
+    info.virtual_size = long(size)
+    return True
+
+def read_img_info(path):
+    '''
+    reads format, virtual size, cluster size and backing file from the image header without
+    forking qemu-img, results are cached until the file changes.
+
+    :return: ImgInfo, or None if path is not a regular file or not clearly a qcow2(v2/v3) or
+             raw image, callers should turn to qemu-img then
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    if not os.path.isfile(path):
+        return None
+
+    key = (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+    info = _img_info_cache.get(key)
+    if info:
+        return info
+
+    info = ImgInfo()
+    with open(path, 'rb') as f:
+        head = f.read(512)
+        if head[:4] == QCOW2_MAGIC:
+            f.seek(0)
+            if not _parse_qcow2_header(f, info):
+                return None
+        elif [m for m in OTHER_IMG_MAGICS if head.startswith(m)]:
+            return None
+        elif not _parse_raw(f, head, st.st_size, info):
+            return None
+
+    _img_info_cache.put(key, info)
+    return info
+
+def get_img_info_cache_stats():
+    return {'size': len(_img_info_cache.infos), 'hits': _img_info_cache.hits, 'misses': _img_info_cache.misses}
+
+def _resolve_backing_file(path, backing_file):
+    # the same way qemu combines them, the result is not normalized
+    if os.path.isabs(backing_file) or ':' in backing_file:
+        return backing_file
+    return os.path.join(os.path.dirname(path), backing_file)
+
+def _read_img_file_chain(path):
+    chain = []
+    while path:
+        info = read_img_info(path)
+        if not info or path in chain:
+            return None
+        chain.append(path)
+        if not info.backing_file:
+            return chain
+        path = _resolve_backing_file(path, info.backing_file)
+
 def qcow2_size_and_actual_size(file_path):
+    info = read_img_info(file_path)
+    if info:
+        return info.virtual_size, get_local_file_disk_usage(file_path)
+
     cmd = shell.ShellCmd('''set -o pipefail; qemu-img info %s |  awk '{if (/^virtual size:/) {vs=substr($4,2)}; if (/^disk size:/) {ds=$3} } END{print vs?vs:"null", ds?ds:"null"}' ''' % file_path)
     cmd(False)
     if cmd.return_code != 0:
@@ -646,6 +848,10 @@ def qcow2_size_and_actual_size(file_path):
      FusionStack-1.5.iso: # ISO 9660 CD-ROM filesystem data 'ZS' (bootable) 
 '''
 def get_img_file_fmt(src):
+    info = read_img_info(src)
+    if info:
+        return 'iso' if info.iso else info.format
+
     fmt = get_img_fmt(src)
     if fmt == "raw":
         result = shell.call("set -o pipefail; file %s | awk '{print $2, $3}'" % src)
@@ -654,6 +860,10 @@ def get_img_file_fmt(src):
     return fmt
 
 def get_img_fmt(src):
+    info = read_img_info(src)
+    if info:
+        return info.format
+
     fmt = shell.call("set -o pipefail; /usr/bin/qemu-img info %s | grep -w '^file format' | awk '{print $3}'" % src)
     fmt = fmt.strip(' \t\r\n')
     if fmt != 'raw' and fmt != 'qcow2':
@@ -753,6 +963,10 @@ def qcow2_rebase_no_check(backing_file, target):
     shell.call('/usr/bin/qemu-img rebase -F %s -u -f qcow2 -b %s %s' % (fmt, backing_file, target))
 
 def qcow2_virtualsize(file_path):
+    info = read_img_info(file_path)
+    if info:
+        return info.virtual_size
+
     file_path = shellquote(file_path)
     cmd = shell.ShellCmd("set -o pipefail; qemu-img info %s | grep -w 'virtual size' | awk -F '(' '{print $2}' | awk '{print $1}'" % file_path)
     cmd(False)
@@ -800,6 +1014,10 @@ def qcow2_direct_get_backing_file(path):
 
 # Get derived file and all its backing files
 def qcow2_get_file_chain(path):
+    chain = _read_img_file_chain(path)
+    if chain:
+        return chain
+
     out = shell.call("qemu-img info --backing-chain %s | grep 'image:' | awk '{print $2}'" % path)
     return out.splitlines()
 
@@ -1026,7 +1244,7 @@ def get_exception_stacktrace():
     return traceback.format_exc()
 
 def wait_callback_success(callback, callback_data=None, timeout=60,
-        interval=1, ignore_exception_in_callback = False):
+        interval=1, ignore_exception_in_callback = False, events=None):
     '''
     Wait for callback(callback_data) return none 'False' result, until the
     timeout. After each 'False' return, will sleep for an interval, before
@@ -1035,7 +1253,17 @@ def wait_callback_success(callback, callback_data=None, timeout=60,
 
     If callback meets exception, it will defaultly directly return False,
     unless exception_result is set to True.
+
+    events is an event source from zstacklib.utils.waiter, e.g. waiter.watch_file(path).
+    Instead of sleeping, it waits at most an interval for the source to report a
+    change, so callback is called again as soon as the condition may hold.
     '''
+    def wait_next_try():
+        if events:
+            events.wait(min(interval, timeout - time.time()))
+        else:
+            time.sleep(interval)
+
     count = time.time()
     timeout = timeout + count
     while count <= timeout:
@@ -1043,12 +1271,12 @@ def wait_callback_success(callback, callback_data=None, timeout=60,
             rsp = callback(callback_data)
             if rsp:
                 return rsp
-            time.sleep(interval)
+            wait_next_try()
         except Exception as e:
             if not ignore_exception_in_callback:
                 logger.debug('Meet exception when call %s through wait_callback_success: %s' % (callback.__name__, get_exception_stacktrace()))
                 raise e
-            time.sleep(interval)
+            wait_next_try()
         finally:
             count = time.time()
 
@@ -1506,16 +1734,17 @@ def kill_process(pid, timeout=5):
     if check(None):
         return
 
-    logger.debug("kill -15 process[pid %s]" % pid)
-    os.kill(int(pid), 15)
+    with waiter.watch_process(pid) as events:
+        logger.debug("kill -15 process[pid %s]" % pid)
+        os.kill(int(pid), 15)
 
-    if wait_callback_success(check, None, timeout):
-        return
+        if wait_callback_success(check, None, timeout, events=events):
+            return
 
-    logger.debug("kill -9 process[pid %s]" % pid)
-    os.kill(int(pid), 9)
-    if not wait_callback_success(check, None, timeout):
-        raise Exception('cannot kill -9 process[pid:%s];the process still exists after %s seconds' % (pid, timeout))
+        logger.debug("kill -9 process[pid %s]" % pid)
+        os.kill(int(pid), 9)
+        if not wait_callback_success(check, None, timeout, events=events):
+            raise Exception('cannot kill -9 process[pid:%s];the process still exists after %s seconds' % (pid, timeout))
 
 def get_gateway_by_default_route():
     cmd = shell.ShellCmd("ip route | grep default | head -n 1 | cut -d ' ' -f 3")
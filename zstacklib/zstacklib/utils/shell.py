@@ -2,31 +2,311 @@
 
 @author: frank
 '''
+import collections
+import marshal
+import os
+import re
+import shutil
+import socket
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+from zstacklib.utils import histogram
 from zstacklib.utils import log
 
 logcmd = True
+# traces keep the command text only if set, besides logcmd; otherwise the executable only,
+# commands may carry passwords and the traces are served by /debug/shell
+tracecmd = False
+
+# commands in INLINE_COMMANDS are served in this process without forking if set, only with
+# plain arguments: no options, globs, variables, quotes or redirections
+inlinecmd = False
+INLINE_COMMANDS = ['cat', 'ls']
+_INLINE_CMD = re.compile(r'^\s*(\w+)((?:[ \t]+[\w./+@:,=-]+)+)\s*$')
+_EXECUTABLE = re.compile(r'\s*(?:set -o pipefail;\s*)?(?:\w+=\S*\s+)*([^\s;|&()<>]+)')
+
+FORK_SERVER_START_TIMEOUT = 10
+
+# how the command ran
+INLINE = 'inline'
+FORK_SERVER = 'forkserver'
+FORK = 'fork'
+
+_fork_server = None
+_fork_server_lock = threading.Lock()
+
+# the latest commands kept for finding the slow ones
+TRACE_BUFFER_SIZE = 4096
+TRACE_CMD_LENGTH = 256
+TOP_SLOWEST = 20
+
+# executable -> {'calls': n, INLINE: n, FORK_SERVER: n, FORK: n, 'failures': n, 'time': Histogram}
+_call_stats = {}
+_call_stats_lock = threading.Lock()
+_traces = collections.deque(maxlen=TRACE_BUFFER_SIZE)
+# the agent endpoint a thread is serving, see trace_endpoint()
+_trace_context = threading.local()
 
 class ShellError(Exception):
     '''shell error'''
-    
+
+class _Finished(object):
+    # stands for the process of a command not forked by this process
+    def __init__(self, returncode=None):
+        self.returncode = returncode
+        self.pid = None
+
+class _ForkServer(object):
+    def __init__(self):
+        self.dir = tempfile.mkdtemp(prefix='zstack-forkserver-')
+        self.path = os.path.join(self.dir, 'sock')
+        # run as a module of the zstacklib found here, not the utils directory as a script
+        # whose modules would shadow the standard library
+        env = dict(os.environ)
+        env['FORK_SERVER_PYTHONPATH'] = env.get('PYTHONPATH', '')
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.process = subprocess.Popen([sys.executable, '-m', 'zstacklib.utils.forkserver', self.path, str(os.getpid())],
+                                        close_fds=True, env=env)
+
+        deadline = time.time() + FORK_SERVER_START_TIMEOUT
+        while not os.path.exists(self.path):
+            if self.process.poll() is not None or time.time() > deadline:
+                self.stop()
+                raise ShellError('fork server does not start in %s seconds' % FORK_SERVER_START_TIMEOUT)
+            time.sleep(0.01)
+
+    def run(self, argv, cwd, stdin):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            sock.sendall(marshal.dumps((argv, cwd, stdin)))
+            sock.shutdown(socket.SHUT_WR)
+            chunks = []
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                chunks.append(data)
+        finally:
+            sock.close()
+
+        return_code, stdout, stderr, error = marshal.loads(''.join(chunks))
+        if error:
+            raise OSError(error)
+        return return_code, stdout, stderr
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+def enable_fork_server():
+    '''
+    runs commands through a small helper process instead of forking this process
+    '''
+    global _fork_server
+    with _fork_server_lock:
+        if _fork_server and _fork_server.process.poll() is None:
+            return
+        _fork_server = _ForkServer()
+        log.get_logger(__name__).debug('shell commands run through fork server[pid:%s]' % _fork_server.process.pid)
+
+def disable_fork_server():
+    global _fork_server
+    with _fork_server_lock:
+        if _fork_server:
+            _fork_server.stop()
+            _fork_server = None
+
+def _run_by_fork_server(argv, cwd, stdin):
+    '''
+    :return: (return code, stdout, stderr), or None if the fork server is not enabled or broken
+    '''
+    server = _fork_server
+    if not server:
+        return None
+
+    try:
+        return server.run(argv, cwd, stdin)
+    except (socket.error, EOFError, ValueError) as e:
+        # EOFError and ValueError come from a truncated reply of a server dying in the middle
+        log.get_logger(__name__).warn('fork server is broken, fork commands by this process, %s' % e)
+        disable_fork_server()
+        return None
+
+def _c_collation():
+    for name in ('LC_ALL', 'LC_COLLATE', 'LANG'):
+        value = os.environ.get(name)
+        if value:
+            return value in ('C', 'POSIX')
+    return True
+
+def _run_inline(cmd, workdir=None):
+    '''
+    :return: (return code, stdout, stderr), or None if the command has to run by bash.
+             Anything unusual, e.g. a missing file, goes to bash for the same error output
+    '''
+    if not inlinecmd:
+        return None
+
+    m = _INLINE_CMD.match(cmd)
+    if not m or m.group(1) not in INLINE_COMMANDS:
+        return None
+
+    args = m.group(2).split()
+    if [a for a in args if a.startswith('-')]:
+        return None
+    paths = [os.path.join(workdir, a) if workdir else a for a in args]
+
+    if m.group(1) == 'cat':
+        out = []
+        for path in paths:
+            if not os.path.isfile(path):
+                return None
+            try:
+                with open(path, 'rb') as fd:
+                    out.append(fd.read())
+            except IOError:
+                return None
+        return 0, ''.join(out), ''
+
+    # ls sorts names by the collation of the locale, which only matches in C
+    if len(paths) != 1 or not _c_collation():
+        return None
+    path = paths[0]
+    if os.path.isdir(path):
+        try:
+            names = sorted([n for n in os.listdir(path) if not n.startswith('.')])
+        except OSError:
+            return None
+        return 0, ''.join([n + '\n' for n in names]), ''
+    if os.path.lexists(path):
+        return 0, args[0] + '\n', ''
+    return None
+
+def _executable(cmd):
+    m = _EXECUTABLE.match(cmd)
+    return os.path.basename(m.group(1)) if m else ''
+
+class trace_endpoint(object):
+    '''
+    commands run in the block are traced as issued by endpoint, e.g. the uri of an http handler
+    '''
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.outer = None
+
+    def __enter__(self):
+        self.outer = getattr(_trace_context, 'endpoint', None)
+        _trace_context.endpoint = self.endpoint
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _trace_context.endpoint = self.outer
+
+def _record_call(cmd, mode, start, return_code):
+    seconds = time.time() - start
+    exe = _executable(cmd)
+    with _call_stats_lock:
+        stats = _call_stats.get(exe)
+        if stats is None:
+            stats = _call_stats[exe] = {'calls': 0, 'failures': 0, INLINE: 0, FORK_SERVER: 0, FORK: 0,
+                                        'time': histogram.Histogram()}
+        stats['calls'] += 1
+        stats[mode] += 1
+        if return_code != 0:
+            stats['failures'] += 1
+        _traces.append({
+            'executable': exe,
+            'cmd': cmd[:TRACE_CMD_LENGTH] if tracecmd and logcmd else exe,
+            'start': start,
+            'seconds': seconds,
+            'return_code': return_code,
+            'mode': mode,
+            'endpoint': getattr(_trace_context, 'endpoint', None),
+        })
+    stats['time'].observe(seconds)
+
+def get_call_stats():
+    '''
+    :return: {executable: {'calls', 'failures', INLINE, FORK_SERVER, FORK, 'time': Histogram.get_stats()}}
+             of commands run so far
+    '''
+    with _call_stats_lock:
+        items = _call_stats.items()
+    ret = {}
+    for exe, stats in items:
+        ret[exe] = dict(stats)
+        ret[exe]['time'] = stats['time'].get_stats()
+    return ret
+
+def get_slowest_commands(top=TOP_SLOWEST, endpoint=None):
+    '''
+    :return: the slowest of the latest TRACE_BUFFER_SIZE commands, slowest first. Each is a dict
+             of executable, cmd, start, seconds, return_code, mode and endpoint; cmd is the
+             executable unless tracecmd is set
+    '''
+    with _call_stats_lock:
+        traces = list(_traces)
+    if endpoint:
+        traces = [t for t in traces if t['endpoint'] == endpoint]
+    traces.sort(key=lambda t: t['seconds'], reverse=True)
+    return traces[:top]
+
+def run_script(script):
+    '''
+    feeds script to the stdin of bash
+
+    :return: (return code, stdout, stderr)
+    '''
+    start = time.time()
+    ret = _run_inline(script)
+    mode = INLINE
+    if ret is None:
+        ret = _run_by_fork_server(['/bin/bash'], None, script)
+        mode = FORK_SERVER
+    if ret is None:
+        p = subprocess.Popen('/bin/bash', stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+        o, e = p.communicate(script)
+        ret = (p.returncode, o, e)
+        mode = FORK
+
+    _record_call(script, mode, start, ret[0])
+    return ret
+
 class ShellCmd(object):
     '''
     classdocs
     '''
-    
+
     def __init__(self, cmd, workdir=None, pipe=True):
         '''
         Constructor
         '''
         self.cmd = cmd
-        if pipe:
+        self.workdir = workdir
+        self.pipe = pipe
+        self.start_time = time.time()
+        self.result = _run_inline(cmd, workdir)
+        if self.result is not None:
+            self.mode = INLINE
+            self.process = _Finished()
+        elif _fork_server:
+            # runs when called
+            self.mode = FORK_SERVER
+            self.process = _Finished()
+        elif pipe:
+            self.mode = FORK
             self.process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stdin=subprocess.PIPE,
                                             stderr=subprocess.PIPE, close_fds=True, executable='/bin/bash', cwd=workdir)
         else:
+            self.mode = FORK
             self.process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                                             close_fds=True, executable='/bin/bash', cwd=workdir)
-            
+
         self.stdout = None
         self.stderr = None
         self.return_code = None
@@ -38,12 +318,28 @@ class ShellCmd(object):
         err.append('stdout: %s' % self.stdout)
         err.append('stderr: %s' % self.stderr)
         raise ShellError('\n'.join(err))
-        
+
+    def _communicate(self):
+        if self.mode == FORK_SERVER:
+            self.result = _run_by_fork_server(['/bin/bash', '-c', self.cmd], self.workdir, '' if self.pipe else None)
+            if self.result is None:
+                # the fork server is gone
+                self.mode = FORK
+                self.process = subprocess.Popen(self.cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                                stdin=subprocess.PIPE if self.pipe else None, close_fds=True,
+                                                executable='/bin/bash', cwd=self.workdir)
+
+        if self.result is not None:
+            self.process.returncode, self.stdout, self.stderr = self.result
+        else:
+            (self.stdout, self.stderr) = self.process.communicate()
+        _record_call(self.cmd, self.mode, self.start_time, self.process.returncode)
+
     def __call__(self, is_exception=True):
         if logcmd:
             log.get_logger(__name__).debug(self.cmd)
-            
-        (self.stdout, self.stderr) = self.process.communicate()
+
+        self._communicate()
         if is_exception and self.process.returncode != 0:
             self.raise_error()
 
@@ -3,9 +3,11 @@
 @author: frank
 '''
 
+import Queue
 import threading
 import inspect
 import pprint
+import time
 import traceback
 import log
 import functools
@@ -90,3 +92,92 @@ class AtomicInteger(object):
     def get(self):
         with self._lock:
             return self._value
+
+class WorkerPool(object):
+    '''
+    a bounded pool of worker threads fed by a priority queue, tasks with a lower
+    priority value run first. submit() returns False instead of queueing when
+    max_queue_size tasks are already waiting.
+    '''
+
+    def __init__(self, name, max_workers, max_queue_size):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.queue = Queue.PriorityQueue()
+        self.workers = 0
+        self.busy = 0
+        # workers waiting for a task none is reserved to, and tasks queued no worker is
+        # reserved to; counted by the lock, a worker holding a task taken from the queue
+        # is not idle even before it runs the task
+        self.idle = 0
+        self.unassigned = 0
+        self.seq = 0
+        self._lock = threading.Lock()
+
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.queue_time_total = 0.0
+        self.queue_time_max = 0.0
+
+    def submit(self, func, args=(), kwargs={}, priority=0):
+        with self._lock:
+            if self.queue.qsize() >= self.max_queue_size:
+                self.rejected += 1
+                return False
+
+            self.seq += 1
+            self.submitted += 1
+            # seq keeps FIFO order among tasks of the same priority
+            self.queue.put((priority, self.seq, time.time(), func, args, kwargs))
+
+            if self.idle > 0:
+                self.idle -= 1
+            elif self.workers < self.max_workers:
+                # the new worker takes the task
+                self.workers += 1
+                t = threading.Thread(target=self._work, name='%s-worker-%s' % (self.name, self.workers))
+                t.daemon = True
+                t.start()
+            else:
+                self.unassigned += 1
+
+        return True
+
+    def _work(self):
+        while True:
+            _, _, queued_at, func, args, kwargs = self.queue.get()
+            wait = time.time() - queued_at
+            with self._lock:
+                self.busy += 1
+                self.queue_time_total += wait
+                self.queue_time_max = max(self.queue_time_max, wait)
+
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                content = traceback.format_exc()
+                err = '%s\n%s\nargs:%s' % (str(e), content, pprint.pformat([args, kwargs]))
+                logger.warn(err)
+            finally:
+                with self._lock:
+                    self.busy -= 1
+                    self.completed += 1
+                    if self.unassigned > 0:
+                        self.unassigned -= 1
+                    else:
+                        self.idle += 1
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'busy': self.busy,
+                'queued': self.queue.qsize(),
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'completed': self.completed,
+                'queue_time_total': self.queue_time_total,
+                'queue_time_max': self.queue_time_max,
+            }
@@ -0,0 +1,242 @@
+'''
+
+@author: frank
+'''
+import ctypes
+import errno
+import os
+import platform
+import select
+import socket
+import struct
+import threading
+import time
+
+from zstacklib.utils import log
+
+logger = log.get_logger(__name__)
+
+# event sources to wait on instead of sleeping between polls, see linux.wait_callback_success.
+# Every source has wait(timeout), which returns when something might have changed or the
+# timeout passed, and close(). When the kernel can't watch the event, a Backoff is returned
+# instead, which polls with growing intervals.
+
+# the first interval of backoff polling, doubled after each try
+MIN_INTERVAL = 0.01
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+FILE_CHANGE_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+
+# pidfd_open exists since linux 5.3, the number is shared by these architectures
+_PIDFD_OPEN_ARCHS = ['x86_64', 'aarch64', 'i386', 'i686', 'ppc64le', 's390x', 'riscv64']
+_NR_PIDFD_OPEN = 434
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    return _libc
+
+class _Source(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        pass
+
+class Backoff(_Source):
+    '''
+    polls with exponentially growing intervals, callers give the largest interval as the timeout
+    '''
+    def __init__(self, min_interval=MIN_INTERVAL):
+        self.interval = min_interval
+
+    def wait(self, timeout):
+        time.sleep(max(min(self.interval, timeout), 0))
+        self.interval *= 2
+        return False
+
+class _FdSource(_Source):
+    def __init__(self, fd):
+        self.fd = fd
+
+    def _drain(self):
+        data = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+                if not buf:
+                    return ''.join(data)
+                data.append(buf)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return ''.join(data)
+                raise
+
+    def _matches(self, data):
+        return True
+
+    def wait(self, timeout):
+        deadline = time.time() + max(timeout, 0)
+        while True:
+            readable, _, _ = select.select([self.fd], [], [], max(deadline - time.time(), 0))
+            if not readable:
+                return False
+            if self._matches(self._drain()):
+                return True
+
+class _Inotify(_FdSource):
+    _EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, fd, name):
+        super(_Inotify, self).__init__(fd)
+        self.name = name
+
+    def _matches(self, data):
+        # other files in the directory may change all the time, e.g. logs
+        offset = 0
+        while offset + self._EVENT_HEADER.size <= len(data):
+            _, _, _, length = self._EVENT_HEADER.unpack_from(data, offset)
+            offset += self._EVENT_HEADER.size
+            if data[offset:offset + length].rstrip('\0') == self.name:
+                return True
+            offset += length
+        return False
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class _ProcessExit(_FdSource):
+    def __init__(self, fd):
+        super(_ProcessExit, self).__init__(fd)
+        self.backoff = None
+
+    def wait(self, timeout):
+        if self.backoff:
+            return self.backoff.wait(timeout)
+
+        readable, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        if not readable:
+            return False
+        # a pidfd stays readable after the exit, e.g. the process is a zombie not reaped yet
+        self.backoff = Backoff()
+        return True
+
+class _NetlinkSource(_Source):
+    def __init__(self, sock):
+        self.sock = sock
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.sock], [], [], max(timeout, 0))
+        if not readable:
+            return False
+        while True:
+            try:
+                self.sock.recv(65536)
+            except socket.error as e:
+                if e.errno == errno.EAGAIN:
+                    return True
+                # ENOBUFS: events overflowed, which still tells something changed
+                if e.errno != errno.ENOBUFS:
+                    raise
+
+    def close(self):
+        self.sock.close()
+
+def watch_file(path):
+    '''
+    wakes on creating, deleting, renaming or writing path, by watching its directory
+    '''
+    try:
+        libc = _get_libc()
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+    except (OSError, AttributeError) as e:
+        logger.debug('inotify is not available, poll %s, %s' % (path, e))
+        return Backoff()
+
+    path = os.path.abspath(path)
+    source = _Inotify(fd, os.path.basename(path))
+    if libc.inotify_add_watch(fd, os.path.dirname(path), FILE_CHANGE_MASK) < 0:
+        logger.debug('cannot watch %s, poll it, %s' % (path, os.strerror(ctypes.get_errno())))
+        source.close()
+        return Backoff()
+    return source
+
+def watch_process(pid):
+    '''
+    wakes when the process exits
+    '''
+    if platform.machine() in _PIDFD_OPEN_ARCHS:
+        try:
+            fd = _get_libc().syscall(_NR_PIDFD_OPEN, int(pid), 0)
+            if fd >= 0:
+                return _ProcessExit(fd)
+            logger.debug('cannot open pidfd of process[pid:%s], poll it, %s' % (pid, os.strerror(ctypes.get_errno())))
+        except (OSError, AttributeError) as e:
+            logger.debug('pidfd_open is not available, poll process[pid:%s], %s' % (pid, e))
+    return Backoff()
+
+def watch_links(groups=RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR):
+    '''
+    wakes on link and address changes reported by rtnetlink, in the network namespace of the caller
+    '''
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, 0)
+        sock.bind((0, groups))
+        sock.setblocking(0)
+        return _NetlinkSource(sock)
+    except (socket.error, AttributeError) as e:
+        logger.debug('cannot listen to rtnetlink, poll instead, %s' % e)
+        return Backoff()
+
+class Notifier(object):
+    '''
+    wakes listeners on notify(), for events delivered by callbacks, e.g. libvirt domain events.
+    A notify() between two waits of a listener is not lost
+    '''
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.generation = 0
+
+    def notify(self):
+        with self.cond:
+            self.generation += 1
+            self.cond.notify_all()
+
+    def listen(self):
+        return _Listener(self)
+
+class _Listener(_Source):
+    def __init__(self, notifier):
+        self.notifier = notifier
+        self.generation = notifier.generation
+
+    def wait(self, timeout):
+        cond = self.notifier.cond
+        with cond:
+            if self.notifier.generation == self.generation:
+                cond.wait(max(timeout, 0))
+            changed = self.notifier.generation != self.generation
+            self.generation = self.notifier.generation
+            return changed